@@ -0,0 +1,138 @@
+"""
+Admission control, so that when the server is overloaded programs slow down
+instead of timing out.
+
+Every kidmuseum program that's waiting for a text polls the server, and
+every poll and picture turns into calls to Twilio, Face++ and the renderer.
+These pieces decide whether a request gets that work done now, or gets told
+how long to wait before trying again:
+
+    polls = RateLimiter(rate=1, burst=3)
+    wait = polls.wait_time('+15555550100')     # 0 if the poll can go ahead
+
+    pictures = Limit(32)
+    with pictures.admit():                     # raises Overloaded if 32 are in progress
+        ...
+
+    backoff(1, 30, load=0.5)                   # seconds to tell programs to wait
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Overloaded(Exception):
+    """
+    Raised when there's no room for more work.
+
+    :param wait_for_seconds: How long to wait before trying again
+    """
+    def __init__(self, message, wait_for_seconds):
+        super(Overloaded, self).__init__(message)
+        self.wait_for_seconds = wait_for_seconds
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests a second on average, and bursts of up to `burst` requests.
+
+    :param rate: Tokens added each second
+    :param burst: Most tokens the bucket holds (it starts full)
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token if there is one and return 0, otherwise return the seconds until there will be one."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+    """
+    A token bucket for each key (e.g. each phone number).  Only the most recently used
+    `max_keys` buckets are kept, so the keys don't need cleaning up.
+    """
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def wait_time(self, key):
+        """Return 0 if a request for the key can go ahead now, otherwise the seconds to wait."""
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+            self.buckets[key] = bucket
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return bucket.take()
+
+
+class Limit(object):
+    """
+    At most `capacity` pieces of work in progress at once.  Work that doesn't fit is turned
+    away straight away rather than queued, since whoever asked can try again later.
+
+    :param wait_for_seconds: Returns how long to tell turned away work to wait
+    """
+    def __init__(self, capacity, wait_for_seconds=lambda: 1.0):
+        self.capacity = capacity
+        self.wait_for_seconds = wait_for_seconds
+        self.in_progress = 0
+        self.lock = threading.Lock()
+
+    @property
+    def load(self):
+        """How full the limit is, from 0 (idle) to 1 (full)."""
+        return float(self.in_progress) / self.capacity
+
+    @contextmanager
+    def admit(self):
+        with self.lock:
+            admitted = self.in_progress < self.capacity
+            if admitted:
+                self.in_progress += 1
+        if not admitted:
+            raise Overloaded("{} requests are already in progress".format(self.capacity), self.wait_for_seconds())
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_progress -= 1
+
+
+class MovingAverage(object):
+    """An exponentially weighted moving average, e.g. of how long requests to a dependency take."""
+    def __init__(self, weight=0.2, initial=0.0):
+        self.weight = weight
+        self.value = initial
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        with self.lock:
+            self.value += self.weight * (value - self.value)
+
+
+def backoff(minimum, maximum, load):
+    """
+    Seconds to tell programs to wait before polling again: `minimum` when the server is idle,
+    rising to `maximum` as the load (0 idle, 1 or more overloaded) goes up.  It rises slowly
+    at first, so a little load doesn't make programs feel sluggish.
+    """
+    load = max(0.0, min(load, 1.0))
+    return minimum + (maximum - minimum) * load * load
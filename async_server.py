@@ -0,0 +1,40 @@
+"""
+Serves server.py with gevent instead of a thread per request.
+
+Every socket is patched to be non-blocking, so while a request waits on
+Twilio, Face++, S3 or a picture download (through urllib2, the Twilio client
+and boto, unchanged) other requests carry on.  That lets one process hold
+thousands of kidmuseum programs polling for replies.  Rendering pictures
+needs the CPU rather than the network, so it's handed to a small pool of real
+threads (OpenCV lets go of the GIL while it works):
+
+    python async_server.py
+
+It serves exactly the same URLs as `python server.py`.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from gevent.threadpool import ThreadPool
+
+import server
+
+# Most requests handled at once (each waiting request only costs a greenlet)
+MAX_CONNECTIONS = int(os.environ.get('MAX_CONNECTIONS', 10000))
+# Threads rendering pictures, usually about the number of CPU cores
+RENDER_THREADS = int(os.environ.get('RENDER_THREADS', 4))
+
+
+def make_server(host="0.0.0.0", port=server.PORT):
+    server.render_pool = ThreadPool(RENDER_THREADS)
+    return WSGIServer((host, port), server.app, spawn=Pool(MAX_CONNECTIONS), log=None)
+
+
+if __name__ == '__main__':
+    server.setup_logging()
+    server.get_state_journal()
+    make_server().serve_forever()
@@ -0,0 +1,401 @@
+"""
+Offline benchmarks for the image pipeline.
+
+Times resize_image, make_detection_file, Face++ detection, add_moustache, add_glasses,
+transform_image and encode_image on synthetic pictures at several resolutions
+(plus any local pictures you give it), using canned Face++ landmarks and a fake
+Face++ transport so Twilio, Face++ and S3 are never called.
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+
+Local pictures are read from --images; each one can have Face++ detection
+results saved next to it as <picture>.json, otherwise the canned landmarks
+are used.
+
+Scaling each accessory from its pyramid is timed against scaling the
+full-size accessory, with the PSNR of the two results to show what it costs
+in quality.
+
+Decoding phone photos (synthetic ones, plus any JPEGs in --photos) is timed
+with decode_image, which decodes JPEGs at a fraction of their size, against
+decoding the whole photo and shrinking it afterwards.  The peak memory each
+one needs is measured in a forked process.
+
+It also times how long a fresh Python process takes to import server.py, and
+fails if that's over the --import-budget.
+"""
+import os
+import sys
+import json
+import glob
+import argparse
+import ctypes
+import ctypes.util
+import platform
+import struct
+import timeit
+import subprocess
+from datetime import datetime
+
+import cv2
+import numpy
+import psutil
+
+import facepp
+import jpegheader
+import server
+from fakes import CANNED_DETECTION
+
+# Answers detection requests with the canned landmarks, so the benchmark measures only
+# the time spent in the Face++ SDK (building the request, decoding the response, ...)
+fake_facepp_api = facepp.API('benchmark', 'benchmark', transport=facepp.FakeTransport(
+    lambda request: json.dumps(CANNED_DETECTION)))
+
+# Resolutions (width, height) of the synthetic pictures
+RESOLUTIONS = [(320, 240), (640, 480), (1280, 960), (3264, 2448)]
+
+# Synthetic phone photos (width, height, EXIF orientation) to time decoding
+PHOTOS = [(3264, 2448, 1), (4032, 3024, 6)]
+
+# Widths the accessories are scaled to, from a small face to one filling a big picture
+ACCESSORY_WIDTHS = [40, 120, 400]
+
+process = psutil.Process(os.getpid())
+
+
+def make_synthetic_picture(width, height):
+    """A noisy gradient, so encoders have some detail to work with."""
+    random_state = numpy.random.RandomState(width * height)
+    gradient = numpy.linspace(0, 255, width, dtype=numpy.float32)[numpy.newaxis, :, numpy.newaxis]
+    picture = numpy.repeat(numpy.repeat(gradient, height, axis=0), 3, axis=2)
+    picture += random_state.normal(0, 20, picture.shape).astype(numpy.float32)
+    return numpy.clip(picture, 0, 255).astype(numpy.uint8)
+
+
+def load_pictures(images_directory):
+    """Returns a list of (name, picture, detection data) to benchmark."""
+    pictures = []
+    for width, height in RESOLUTIONS:
+        pictures.append(("synthetic_{}x{}".format(width, height), make_synthetic_picture(width, height),
+                         CANNED_DETECTION))
+    if images_directory:
+        for path in sorted(glob.glob(os.path.join(images_directory, '*'))):
+            if path.endswith('.json'):
+                continue
+            picture = cv2.imread(path)
+            if picture is None:
+                continue
+            detection = CANNED_DETECTION
+            if os.path.exists(path + '.json'):
+                with open(path + '.json') as detection_file:
+                    detection = json.load(detection_file)
+            pictures.append((os.path.basename(path), picture, detection))
+    return pictures
+
+
+def make_synthetic_photo(width, height, orientation):
+    """A synthetic picture saved as a JPEG the way a phone would, with an EXIF orientation."""
+    picture = cv2.GaussianBlur(make_synthetic_picture(width, height), (5, 5), 0)
+    jpeg = cv2.imencode('.jpg', picture, [cv2.IMWRITE_JPEG_QUALITY, 92])[1].tostring()
+    # A big-endian TIFF header and a directory holding just the orientation tag
+    tiff = b'MM\x00\x2a' + struct.pack('>IH', 8, 1) + \
+        struct.pack('>HHIHH', jpegheader.ORIENTATION_TAG, 3, 1, orientation, 0) + struct.pack('>I', 0)
+    exif = b'Exif\x00\x00' + tiff
+    return jpeg[:2] + b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif + jpeg[2:]
+
+
+def load_photos(photos_directory):
+    """Returns a list of (name, JPEG data) to time decoding."""
+    photos = []
+    for width, height, orientation in PHOTOS:
+        photos.append(("synthetic_photo_{}x{}_orientation_{}".format(width, height, orientation),
+                       make_synthetic_photo(width, height, orientation)))
+    if photos_directory:
+        for path in sorted(glob.glob(os.path.join(photos_directory, '*'))):
+            if os.path.splitext(path)[1].lower() in ('.jpg', '.jpeg'):
+                with open(path, 'rb') as photo_file:
+                    photos.append((os.path.basename(path), photo_file.read()))
+    return photos
+
+
+def measure(function, iterations, setup=None):
+    """
+    Run the function a number of times and return the time (in seconds) each run took,
+    along with how much the process's memory grew while running it.
+    """
+    timings = []
+    rss_before = process.memory_info().rss
+    for _ in range(iterations):
+        argument = setup() if setup else None
+        start_time = timeit.default_timer()
+        function(argument)
+        timings.append(timeit.default_timer() - start_time)
+    rss_after = process.memory_info().rss
+    return timings, rss_after - rss_before
+
+
+def summarize(stage, picture_name, picture, timings, rss_growth, accessory=None):
+    timings = sorted(timings)
+    megapixels = picture.shape[0] * picture.shape[1] / 1000000.0
+    mean = sum(timings) / len(timings)
+    return {
+        'stage': stage,
+        'picture': picture_name,
+        'resolution': "{}x{}".format(picture.shape[1], picture.shape[0]),
+        'accessory': accessory,
+        'iterations': len(timings),
+        'mean_ms': mean * 1000,
+        'median_ms': timings[len(timings) // 2] * 1000,
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        'min_ms': timings[0] * 1000,
+        'ops_per_second': 1.0 / mean if mean else None,
+        'megapixels_per_second': megapixels / mean if mean else None,
+        'rss_growth_kb': rss_growth / 1024,
+    }
+
+
+def benchmark_picture(picture_name, original, detection, iterations):
+    results = []
+
+    timings, rss_growth = measure(lambda _: server.resize_image(original), iterations)
+    results.append(summarize('resize_image', picture_name, original, timings, rss_growth))
+
+    picture = server.resize_image(original)
+    face_features = server.DetectedFace(None, picture, data=detection)
+
+    timings, rss_growth = measure(lambda _: server.make_detection_file(picture), iterations)
+    result = summarize('make_detection_file', picture_name, picture, timings, rss_growth)
+    result['output_bytes'] = len(server.make_detection_file(picture).content)
+    results.append(result)
+
+    picture_file = server.make_detection_file(picture)
+    timings, rss_growth = measure(
+        lambda _: fake_facepp_api.detection.detect(img=picture_file, mode="oneface"), iterations)
+    results.append(summarize('detect', picture_name, picture, timings, rss_growth))
+
+    for moustache_name in server.accessory_catalog.names('moustache'):
+        timings, rss_growth = measure(
+            lambda image: server.add_moustache(image, face_features, moustache_name), iterations, picture.copy)
+        results.append(summarize('add_moustache', picture_name, picture, timings, rss_growth, moustache_name))
+
+    for glasses_name in server.accessory_catalog.names('glasses'):
+        timings, rss_growth = measure(
+            lambda image: server.add_glasses(image, face_features, glasses_name), iterations, picture.copy)
+        results.append(summarize('add_glasses', picture_name, picture, timings, rss_growth, glasses_name))
+
+    for moustache_name in server.accessory_catalog.names('moustache'):
+        for glasses_name in server.accessory_catalog.names('glasses'):
+            transform_info = {'moustache': moustache_name, 'glasses': glasses_name}
+            timings, rss_growth = measure(
+                lambda image: server.transform_image(image, transform_info, face_features), iterations, picture.copy)
+            results.append(summarize('transform_image', picture_name, picture, timings, rss_growth,
+                                     "{}+{}".format(moustache_name, glasses_name)))
+
+    transformed = picture.copy()
+    server.transform_image(transformed, {'moustache': 'handlebar', 'glasses': 'shades'}, face_features)
+    for format_name in sorted(server.encoding_formats):
+        if server.encoding_formats[format_name]['quality_flag'] is None:
+            continue
+        # Clear the cached encoding parameters so every run does the full quality search
+        timings, rss_growth = measure(
+            lambda _: server.encode_image(transformed, format_name=format_name), iterations,
+            server._encoding_cache.clear)
+        result = summarize('encode_image', picture_name, transformed, timings, rss_growth, format_name)
+        result['output_bytes'] = len(server.encode_image(transformed, format_name=format_name).data)
+        results.append(result)
+
+    return results
+
+
+def benchmark_accessories(iterations):
+    """
+    Time scaling every accessory to a few widths from its pyramid, against scaling the full-size
+    picture's colors and masks separately (how it used to be done), and measure how close the
+    pyramid's result is to resizing the full-size picture directly (PSNR in dB, higher is closer).
+    """
+    results = []
+    paths = [server.get_moustache_path(name) for name in server.accessory_catalog.names('moustache')]
+    paths += [server.get_glasses_path(name) for name in server.accessory_catalog.names('glasses')]
+    for path in paths:
+        name = os.path.splitext(os.path.relpath(path, 'images'))[0]
+        original = cv2.imread(path, -1)
+        pyramid = server.load_accessory(path)
+        for width in ACCESSORY_WIDTHS:
+            height = int(pyramid.height * (float(width) / pyramid.width))
+            size = "{}x{}".format(width, height)
+
+            timings, rss_growth = measure(lambda _: pyramid.scaled(width, height), iterations)
+            result = summarize('scale_accessory', name, original, timings, rss_growth, size)
+            reference = cv2.resize(pyramid.levels[0], (width, height), interpolation=cv2.INTER_AREA)
+            result['psnr_db'] = cv2.PSNR(reference, pyramid.scaled(width, height))
+            results.append(result)
+
+            def scale_full_size(_):
+                mask = original[:, :, 3]
+                cv2.resize(original[:, :, 0:3], (width, height), interpolation=cv2.INTER_AREA)
+                cv2.resize(mask, (width, height), interpolation=cv2.INTER_AREA)
+                cv2.resize(cv2.bitwise_not(mask), (width, height), interpolation=cv2.INTER_AREA)
+            timings, rss_growth = measure(scale_full_size, iterations)
+            results.append(summarize('scale_accessory_full_size', name, original, timings, rss_growth, size))
+    return results
+
+
+def measure_peak_memory(function):
+    """
+    Run the function once in a forked process, and return how much more memory (in bytes) the
+    process needed at its peak than when it started (or None if Linux's /proc isn't there).
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            # Hand memory freed by earlier benchmarks back to the system first, or the function
+            # could reuse it without it counting, then start the peak from here
+            ctypes.CDLL(ctypes.util.find_library('c')).malloc_trim(0)
+            with open('/proc/self/clear_refs', 'w') as clear_refs:
+                clear_refs.write('5')
+            rss_before = process_memory('VmRSS')
+            function()
+            os.write(write_end, str(process_memory('VmHWM') - rss_before))
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    os.waitpid(pid, 0)
+    growth = os.read(read_end, 64)
+    os.close(read_end)
+    return max(0, int(growth)) if growth else None
+
+
+def process_memory(field):
+    """Read a memory size (like VmRSS, or VmHWM for the peak) of this process from /proc, in bytes."""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+
+
+def decode_full_size(image_data):
+    """How pictures used to be decoded: the whole picture, then shrunk to the size it's rendered at."""
+    return server.resize_image(cv2.imdecode(numpy.frombuffer(image_data, numpy.uint8), cv2.IMREAD_COLOR))
+
+
+def benchmark_decode(photo_name, image_data, iterations):
+    results = []
+    header = jpegheader.read_jpeg_header(image_data)
+    for stage, decode in [('decode_full_size', decode_full_size), ('decode_image', server.decode_image)]:
+        timings, rss_growth = measure(lambda _: decode(image_data), iterations)
+        decoded = decode(image_data)
+        result = summarize(stage, photo_name, decoded, timings, rss_growth)
+        peak_memory = measure_peak_memory(lambda: decode(image_data))
+        result.update({
+            'source_resolution': "{}x{}".format(header.width, header.height) if header else None,
+            'orientation': header.orientation if header else None,
+            'input_bytes': len(image_data),
+            'peak_memory_kb': peak_memory / 1024 if peak_memory is not None else None,
+        })
+        results.append(result)
+    return results
+
+
+def benchmark_import(module, iterations):
+    """Time importing the module in fresh Python processes, not counting Python's own startup."""
+    script = "import timeit; start = timeit.default_timer(); import {}; print(timeit.default_timer() - start)"
+    timings = [float(subprocess.check_output([sys.executable, '-c', script.format(module)]))
+               for _ in range(iterations)]
+    timings.sort()
+    return {
+        'stage': 'import',
+        'picture': None,
+        'accessory': module,
+        'iterations': len(timings),
+        'mean_ms': sum(timings) / len(timings) * 1000,
+        'median_ms': timings[len(timings) // 2] * 1000,
+        'min_ms': timings[0] * 1000,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print how much slower or faster each stage got compared to an earlier run."""
+    key = lambda result: (result['stage'], result['picture'], result['accessory'])
+    baseline_results = dict((key(result), result) for result in baseline['results'])
+    regressions = 0
+    for result in results:
+        previous = baseline_results.get(key(result))
+        if previous is None or not previous['median_ms']:
+            continue
+        ratio = result['median_ms'] / previous['median_ms']
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  <-- slower"
+            regressions += 1
+        sys.stderr.write("{:<16} {:<24} {:<28} {:8.2f}ms -> {:8.2f}ms ({:+.0%}){}\n".format(
+            result['stage'], result['picture'] or "", result['accessory'] or "",
+            previous['median_ms'], result['median_ms'], ratio - 1, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image pipeline without any network services.")
+    parser.add_argument('--iterations', type=int, default=20, help="Runs of each stage per picture")
+    parser.add_argument('--images', help="Directory of extra pictures to benchmark")
+    parser.add_argument('--photos', help="Directory of phone photos (JPEGs) to time decoding")
+    parser.add_argument('--output', help="Write the results as JSON to this file instead of stdout")
+    parser.add_argument('--compare', help="Results from an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Flag stages that got slower than this fraction when comparing (default 0.1)")
+    parser.add_argument('--import-budget', type=float, default=1.0,
+                        help="Most seconds importing server.py may take (default 1.0)")
+    args = parser.parse_args()
+
+    sys.stderr.write("Benchmarking import server...\n")
+    import_result = benchmark_import('server', min(args.iterations, 5))
+    results = [import_result]
+    sys.stderr.write("Benchmarking accessories...\n")
+    results.extend(benchmark_accessories(args.iterations))
+    for photo_name, image_data in load_photos(args.photos):
+        sys.stderr.write("Benchmarking decoding {}...\n".format(photo_name))
+        results.extend(benchmark_decode(photo_name, image_data, args.iterations))
+    for picture_name, picture, detection in load_pictures(args.images):
+        sys.stderr.write("Benchmarking {}...\n".format(picture_name))
+        results.extend(benchmark_picture(picture_name, picture, detection, args.iterations))
+
+    report = {
+        'meta': {
+            'time': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': numpy.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'iterations': args.iterations,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    failed = False
+    if import_result['median_ms'] > args.import_budget * 1000:
+        sys.stderr.write("Importing server took {:.0f}ms, over the {:.0f}ms budget\n".format(
+            import_result['median_ms'], args.import_budget * 1000))
+        failed = True
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        if regressions:
+            sys.stderr.write("{} stages got slower by more than {:.0%}\n".format(regressions, args.threshold))
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -28,33 +28,44 @@ example:
 api = API(key, secret)
 api.detection.detect(img = File('/tmp/test.jpg'))"""
 
-__all__ = ['File', 'APIError', 'API']
+__all__ = ['File', 'APIError', 'CircuitOpenError', 'CircuitBreaker',
+        'Transport', 'UrllibTransport', 'PooledTransport', 'FakeTransport',
+        'Batch', 'API']
 
 
 DEBUG_LEVEL = 1
 
 import sys
+import abc
 import socket
 import urllib
 import urllib2
+import httplib
+import urlparse
 import json
 import os
 import os.path
-import itertools
 import mimetools
 import mimetypes
 import time
+import random
+import threading
 import tempfile
 from collections import Iterable
 from cStringIO import StringIO
+from concurrent import futures
 
 class File(object):
-    """an object representing a local file"""
+    """an object representing a local file, or image content already in memory
+    (in which case path is only used as the uploaded file's name)"""
     path = None
     content = None
-    def __init__(self, path):
+    def __init__(self, path, content = None):
         self.path = path
-        self._get_content()
+        if content is None:
+            self._get_content()
+        else:
+            self.content = content
 
     def _resize_cv2(self, ftmp):
         try:
@@ -127,6 +138,206 @@ class APIError(Exception):
     __repr__ = __str__
 
 
+class CircuitOpenError(APIError):
+    """raised without contacting the server while the circuit breaker is
+    open"""
+
+
+class CircuitBreaker(object):
+    """stops sending requests to an unhealthy server
+
+    After `failure_threshold` failed calls in a row (each counted once,
+    after its retries) the breaker opens, and requests fail fast with
+    :class:`CircuitOpenError`. Once `reset_timeout` seconds have passed, a
+    single trial call is let through (half-open): if it succeeds the
+    breaker closes again, otherwise it stays open for another
+    `reset_timeout` seconds."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold = 5, reset_timeout = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.rejected = 0
+        """number of requests failed fast while the breaker was open"""
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_request(self, url = None):
+        """raise :class:`CircuitOpenError` if the request shouldn't be sent"""
+        with self._lock:
+            if self.state == self.OPEN and \
+                    time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(-1, url, 'circuit breaker is {0}'.format(self.state))
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+            self._trial_running = False
+
+
+class Transport(object):
+    """sends requests to the server
+
+    Subclasses implement :meth:`send`, which returns the response body,
+    raises urllib2.HTTPError for error responses, and raises socket.error or
+    urllib2.URLError when the server can't be reached (those get retried);
+    it's abstract, so a transport without one can't be created."""
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def send(self, request, timeout):
+        """:param request: the urllib2.Request, after API.update_request
+        :param timeout: seconds to wait for the server, or None"""
+
+    def close(self):
+        """close any open connections"""
+        pass
+
+
+class UrllibTransport(Transport):
+    """opens a new connection for every request with urllib2"""
+
+    def send(self, request, timeout):
+        return urllib2.urlopen(request, timeout = timeout).read()
+
+
+class PooledTransport(Transport):
+    """keeps connections open after each request (HTTP keep-alive) and
+    reuses them, so requests don't pay for TCP and TLS setup every time;
+    safe to share between threads"""
+
+    def __init__(self, max_idle_per_host = 10):
+        """:param max_idle_per_host: the most open connections to keep for
+            each host while they're not being used"""
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def send(self, request, timeout):
+        key = (request.get_type(), request.get_host())
+        conn, reused = self._acquire(key, timeout)
+        try:
+            response = self._request(conn, request, timeout)
+        except (socket.error, httplib.HTTPException) as e:
+            conn.close()
+            if not reused:
+                raise urllib2.URLError(e)
+            # the server may have closed the connection while it was idle,
+            # so try once more on a new one
+            conn = self._connect(key, timeout)
+            try:
+                response = self._request(conn, request, timeout)
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+
+        if response.status >= 400:
+            raise urllib2.HTTPError(request.get_full_url(), response.status,
+                    response.reason, response.msg, StringIO(response.body))
+        return response.body
+
+    def preconnect(self, url, connections = 1, timeout = None):
+        """open connections to the server in the url ahead of time"""
+        parsed = urlparse.urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        for i in range(connections):
+            conn = self._connect(key, timeout)
+            conn.connect()
+            self._release(key, conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _request(self, conn, request, timeout):
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        headers = dict(request.header_items())
+        headers.setdefault('Connection', 'keep-alive')
+        body = request.get_data()
+        if hasattr(body, 'seek'):
+            # a streamed form may have been partly sent on a connection that
+            # then turned out to be closed
+            body.seek(0)
+        conn.request(request.get_method(), request.get_selector(), body,
+                headers)
+        response = conn.getresponse()
+        response.body = response.read()
+        return response
+
+    def _acquire(self, key, timeout):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key, timeout), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _connect(self, key, timeout):
+        scheme, host = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout = timeout)
+        return httplib.HTTPConnection(host, timeout = timeout)
+
+
+class FakeTransport(Transport):
+    """answers requests without any network, for tests and benchmarks
+
+    example:
+    api = API(key, secret, transport = FakeTransport(
+        lambda request: json.dumps({'face': []})))"""
+
+    def __init__(self, handler):
+        """:param handler: called with each urllib2.Request; returns the
+            response body, or raises like :meth:`Transport.send` does"""
+        self.handler = handler
+        self.requests = []
+
+    def send(self, request, timeout):
+        self.requests.append(request)
+        return self.handler(request)
+
+
 class API(object):
     key = None
     secret = None
@@ -136,16 +347,33 @@ class API(object):
     timeout = None
     max_retries = None
     retry_delay = None
+    max_retry_delay = None
+    deadline = None
+    circuit_breaker = None
+    transport = None
+
+    retries = 0
+    """number of times a request has been retried"""
 
     def __init__(self, key, secret, srv = None,
-            decode_result = True, timeout = 30, max_retries = 10,
-            retry_delay = 5):
+            decode_result = True, timeout = 30, max_retries = 3,
+            retry_delay = 0.5, max_retry_delay = 5, deadline = None,
+            circuit_breaker = None, transport = None):
         """:param srv: The API server address
         :param decode_result: whether to json_decode the result
         :param timeout: HTTP request timeout in seconds
         :param max_retries: maximal number of retries after catching URL error
             or socket error
-        :param retry_delay: time to sleep before retrying"""
+        :param retry_delay: time to sleep before the first retry; it doubles
+            for every retry after that, and a random part of it is used
+            (jitter) so many clients don't retry all at once
+        :param max_retry_delay: the most time to sleep before any retry
+        :param deadline: default number of seconds a call may take, including
+            retries; can be overridden per call with the `budget` argument
+        :param circuit_breaker: :class:`CircuitBreaker` shared by every
+            request made with this object; one is created if not given
+        :param transport: :class:`Transport` that sends the requests; a
+            :class:`PooledTransport` is created if not given"""
         self.key = key
         self.secret = secret
         if srv:
@@ -156,38 +384,142 @@ class API(object):
         self.timeout = timeout
         self.max_retries = max_retries
         self.retry_delay = retry_delay
-
-        _setup_apiobj(self, self, [])
-
-    def wait_async(self, session_id, referesh_interval = 2):
-        """wait for asynchronous operations to complete"""
+        self.max_retry_delay = max_retry_delay
+        self.deadline = deadline
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.transport = transport or PooledTransport()
+
+    def __getattr__(self, name):
+        return _get_apiobj(self, self, [], name)
+
+    def wait_async(self, session_id, referesh_interval = 2,
+            initial_interval = 0.2, timeout = None):
+        """wait for asynchronous operations to complete; the session is
+        checked quickly at first, then less and less often
+        :param referesh_interval: the longest time to wait between checks
+        :param initial_interval: time to wait before the second check
+        :param timeout: seconds to wait before raising APIError, or None to
+            wait forever"""
+        start_time = time.time()
+        interval = initial_interval
         while True:
             rst = self.info.get_session(session_id = session_id)
             if rst['status'] != u'INQUEUE':
                 return rst
             _print_debug(rst)
-            time.sleep(referesh_interval)
+            if timeout is not None and \
+                    time.time() - start_time + interval > timeout:
+                raise APIError(-1, None,
+                        'session {0} still in queue'.format(session_id))
+            time.sleep(interval)
+            interval = min(referesh_interval, interval * 2)
+
+    def batch(self, max_workers = 4, max_per_second = None):
+        """return a :class:`Batch` for making many calls at once"""
+        return Batch(self, max_workers, max_per_second)
 
     def update_request(self, request):
         """overwrite this function to update the request before sending it to
         server"""
         pass
 
+    def request_finished(self, name, elapsed, error):
+        """overwrite this function to observe finished requests
+        :param name: the API name, e.g. 'detection/detect'
+        :param elapsed: seconds spent on the request, including retries
+        :param error: the exception raised by the request, or None"""
+        pass
+
+    def request_retried(self, name, attempt, error):
+        """overwrite this function to observe retries
+        :param name: the API name, e.g. 'detection/detect'
+        :param attempt: which retry this is, starting at 1
+        :param error: the exception that caused the retry"""
+        pass
 
-def _setup_apiobj(self, api, path):
-    if self is not api:
-        self._api = api
-        self._urlbase = api.server + '/'.join(path)
-
-    lvl = len(path)
-    done = set()
-    for i in _APIS:
-        if len(i) <= lvl:
-            continue
-        cur = i[lvl]
-        if i[:lvl] == path and cur not in done:
-            done.add(cur)
-            setattr(self, cur, _APIProxy(api, i[:lvl + 1]))
+
+class Batch(object):
+    """makes many API calls at once on a bounded pool of threads, and hands
+    back futures for their results
+
+    example:
+    with api.batch(max_workers = 4) as batch:
+        jobs = [batch.submit(api.detection.detect, img = File(path))
+                for path in paths]
+        for job in batch.as_completed(jobs):
+            print job.result()"""
+
+    def __init__(self, api, max_workers = 4, max_per_second = None):
+        """:param max_workers: the most calls in progress at once
+        :param max_per_second: the most calls started each second, to stay
+            within the API's quota; None for no limit"""
+        self.api = api
+        self.max_per_second = max_per_second
+        self._executor = futures.ThreadPoolExecutor(max_workers)
+        self._next_start = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, **kargs):
+        """call an API (e.g. `api.detection.detect`) with the keyword
+        arguments on the pool
+        :return: a concurrent.futures.Future for the call's result"""
+        return self._executor.submit(self._run, func, kargs)
+
+    def submit_async(self, func, **kargs):
+        """call an API asynchronously (`async = 'true'`) on the pool and wait
+        for its session to finish
+        :return: a concurrent.futures.Future for the session's result"""
+        return self._executor.submit(self._run_async, func, kargs)
+
+    def map(self, func, kargs_list):
+        """call an API once for each dict of keyword arguments
+        :return: the futures, in the same order"""
+        return [self.submit(func, **kargs) for kargs in kargs_list]
+
+    @staticmethod
+    def as_completed(jobs, timeout = None):
+        """yield the futures as their calls finish"""
+        return futures.as_completed(jobs, timeout)
+
+    def shutdown(self, wait = True):
+        self._executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def _run(self, func, kargs):
+        self._throttle()
+        return func(**kargs)
+
+    def _run_async(self, func, kargs):
+        kargs = dict(kargs)
+        kargs['async'] = 'true'
+        session = self._run(func, kargs)
+        return self.api.wait_async(session['session_id'])
+
+    def _throttle(self):
+        if not self.max_per_second:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_start)
+            self._next_start = start + 1. / self.max_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+def _get_apiobj(self, api, path, name):
+    """create the proxy for a sub-API the first time it's looked up, and
+    keep it as an attribute so later lookups don't come back here"""
+    path = path + [name]
+    if tuple(path) not in _API_PATHS:
+        raise AttributeError(name)
+    proxy = _APIProxy(api, path)
+    setattr(self, name, proxy)
+    return proxy
 
 class _APIProxy(object):
     _api = None
@@ -195,10 +527,23 @@ class _APIProxy(object):
 
     _urlbase = None
 
+    _name = None
+    """API name, e.g. 'detection/detect'"""
+
+    _path = None
+
     def __init__(self, api, path):
-        _setup_apiobj(self, api, path)
+        self._api = api
+        self._path = path
+        self._name = '/'.join(path)
+        self._urlbase = api.server + self._name
 
-    def __call__(self, post = False, *args, **kargs):
+    def __getattr__(self, name):
+        return _get_apiobj(self, self._api, self._path, name)
+
+    def __call__(self, post = False, budget = None, *args, **kargs):
+        """:param budget: the most seconds this call may take, including
+            retries; defaults to the API's deadline"""
         if len(args):
             raise TypeError('Only keyword arguments are allowed')
         if type(post) is not bool:
@@ -220,26 +565,23 @@ class _APIProxy(object):
 
         request = urllib2.Request(url)
         if add_form:
-            body = str(form)
+            body = form.get_body()
             request.add_header('Content-type', form.get_content_type())
             request.add_header('Content-length', str(len(body)))
             request.add_data(body)
 
         self._api.update_request(request)
 
-        retry = self._api.max_retries
-        while True:
-            retry -= 1
-            try:
-                ret = urllib2.urlopen(request, timeout = self._api.timeout).read()
-                break
-            except urllib2.HTTPError as e:
-                raise APIError(e.code, url, e.read())
-            except (socket.error, urllib2.URLError) as e:
-                if retry < 0:
-                    raise e
-                _print_debug('caught error: {}; retrying'.format(e))
-                time.sleep(self._api.retry_delay)
+        start_time = time.time()
+        if budget is None:
+            budget = self._api.deadline
+        deadline = start_time + budget if budget is not None else None
+        try:
+            ret = self._send(request, url, deadline)
+        except Exception as e:
+            self._api.request_finished(self._name, time.time() - start_time, e)
+            raise
+        self._api.request_finished(self._name, time.time() - start_time, None)
 
         if self._api.decode_result:
             try:
@@ -248,6 +590,66 @@ class _APIProxy(object):
                 raise APIError(-1, url, 'json decode error, value={0!r}'.format(ret))
         return ret
 
+    def _send(self, request, url, deadline):
+        """send the request through the circuit breaker, which hears how
+        the call went once, after any retries
+        :return: the response body"""
+        breaker = self._api.circuit_breaker
+        breaker.before_request(url)
+        try:
+            ret = self._send_with_retries(request, url, deadline)
+        except APIError as e:
+            # only server errors (and giving up) mean the service is
+            # unhealthy
+            if 0 < e.code < 500:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+            raise
+        except BaseException:
+            # anything else (socket errors after the last retry, a bad
+            # response, a timeout raised from outside, ...) still has to be
+            # recorded, or a half-open breaker would wait for its trial
+            # request forever
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return ret
+
+    def _send_with_retries(self, request, url, deadline):
+        """send the request, retrying after URL or socket errors with
+        exponential backoff until the deadline
+        :return: the response body"""
+        api = self._api
+        attempt = 0
+        while True:
+            timeout = api.timeout
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise APIError(-1, url, 'deadline exceeded')
+                timeout = remaining if timeout is None else min(timeout, remaining)
+
+            body = request.get_data()
+            if hasattr(body, 'seek'):
+                # start streaming the form from the beginning again on retries
+                body.seek(0)
+            try:
+                return api.transport.send(request, timeout)
+            except urllib2.HTTPError as e:
+                raise APIError(e.code, url, e.read())
+            except (socket.error, urllib2.URLError) as e:
+                delay = random.uniform(0, min(api.max_retry_delay,
+                    api.retry_delay * 2 ** attempt))
+                if attempt >= api.max_retries or (deadline is not None and
+                        time.time() + delay >= deadline):
+                    raise e
+                attempt += 1
+                api.retries += 1
+                api.request_retried(self._name, attempt, e)
+                _print_debug('caught error: {}; retrying in {:.2f}s'.format(e, delay))
+                time.sleep(delay)
+
     def _mkarg(self, kargs):
         """change the argument list (encode value, add api key/secret)
         :return: the new argument list"""
@@ -298,49 +700,110 @@ class _MultiPartForm(object):
         return
 
     def add_file(self, fieldname, filename, content, mimetype = None):
-        """Add a file to be uploaded."""
+        """Add a file to be uploaded.  The content can be a string or anything
+        supporting the buffer protocol.  Strings, bytearrays and other flat
+        buffers of bytes are sent straight from there without being copied;
+        anything else (e.g. a numpy array, even the one cv2.imencode returns)
+        is copied into a string first."""
         if mimetype is None:
             mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
         self.files.append((fieldname, filename, mimetype, content))
         return
-    
+
+    def get_body(self):
+        """Return the form data as a :class:`_MultiPartBody`, which knows its
+        length up front and is read in pieces, so the files are never copied
+        into one big string."""
+        part_boundary = '--' + self.boundary
+        parts = []
+        for name, value in self.form_fields:
+            parts.append('\r\n'.join([
+                part_boundary,
+                'Content-Disposition: form-data; name="%s"' % name,
+                '',
+                value,
+                '']))
+        for field_name, filename, content_type, body in self.files:
+            parts.append('\r\n'.join([
+                part_boundary,
+                'Content-Disposition: file; name="%s"; filename="%s"' % \
+                   (field_name, filename),
+                'Content-Type: %s' % content_type,
+                '',
+                '']))
+            parts.append(_as_memoryview(body))
+            parts.append('\r\n')
+        parts.append(part_boundary + '--\r\n')
+        return _MultiPartBody(parts)
+
     def __str__(self):
         """Return a string representing the form data, including attached files."""
-        # Build a list of lists, each containing "lines" of the
-        # request.  Each part is separated by a boundary string.
-        # Once the list is built, return a string where each
-        # line is separated by '\r\n'.  
-        parts = []
-        part_boundary = '--' + self.boundary
-        
-        # Add the form fields
-        parts.extend(
-            [ part_boundary,
-              'Content-Disposition: form-data; name="%s"' % name,
-              '',
-              value,
-            ]
-            for name, value in self.form_fields
-            )
-        
-        # Add the files to upload
-        parts.extend(
-            [ part_boundary,
-              'Content-Disposition: file; name="%s"; filename="%s"' % \
-                 (field_name, filename),
-              'Content-Type: %s' % content_type,
-              '',
-              body,
-            ]
-            for field_name, filename, content_type, body in self.files
-            )
-        
-        # Flatten the list and add closing boundary marker,
-        # then return CR+LF separated data
-        flattened = list(itertools.chain(*parts))
-        flattened.append('--' + self.boundary + '--')
-        flattened.append('')
-        return '\r\n'.join(flattened)
+        return str(self.get_body())
+
+
+class _MultiPartBody(object):
+    """Multipart form data that's read in pieces, like a file.  httplib
+    streams anything with a read method, and :meth:`seek` lets the body be
+    sent again when a request is retried."""
+
+    def __init__(self, parts):
+        self._parts = parts
+        self._length = sum(len(part) for part in parts)
+        self.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def seek(self, offset):
+        if offset != 0:
+            raise ValueError('can only seek to the start of the form')
+        self._index = 0
+        self._offset = 0
+
+    def read(self, size = -1):
+        """Return up to `size` bytes, never more than what's left of the
+        current part; files are returned as memoryview slices of the content
+        they were added with."""
+        if size is None or size < 0:
+            rest = []
+            while True:
+                chunk = self.read(64 * 1024)
+                if not len(chunk):
+                    return ''.join(_as_bytes(i) for i in rest)
+                rest.append(chunk)
+        while self._index < len(self._parts):
+            part = self._parts[self._index]
+            if self._offset >= len(part):
+                self._index += 1
+                self._offset = 0
+                continue
+            chunk = part[self._offset:self._offset + size]
+            self._offset += len(chunk)
+            return chunk
+        return ''
+
+    def __str__(self):
+        self.seek(0)
+        return self.read()
+
+
+def _as_memoryview(content):
+    try:
+        view = memoryview(content)
+    except TypeError:
+        # e.g. old-style buffer objects, which slice into small copies
+        return content
+    if view.ndim != 1 or view.itemsize != 1:
+        # the length and slices of a memoryview count items, not bytes (and
+        # only along the first dimension), so it can't be sent as it is
+        return view.tobytes()
+    return view
+
+
+def _as_bytes(chunk):
+    if isinstance(chunk, memoryview):
+        return chunk.tobytes()
+    return str(chunk)
 
 
 def _print_debug(msg):
@@ -392,3 +855,6 @@ _APIS = [
 ]
 
 _APIS = [i.split('/')[1:] for i in _APIS]
+
+# every API and the groups they're in, e.g. ('detection',) and ('detection', 'detect')
+_API_PATHS = set(tuple(i[:lvl]) for i in _APIS for lvl in range(1, len(i) + 1))
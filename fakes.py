@@ -0,0 +1,338 @@
+"""
+Local stand-ins for Twilio, Face++ and S3.
+
+They speak just enough of each service's HTTP API for server.py to run
+against them, so the server can be load tested (or poked at) without
+sending real texts, spending Face++ quota or filling the S3 bucket:
+
+    services = FakeServices(latency={'facepp_detect': 0.5})
+    services.start()
+    # Start server.py with the variables from services.server_environment()
+    services.twilio.receive('+15555550100', 'hipster')
+    services.twilio.receive('+15555550100', '', picture=open('selfie.jpg', 'rb').read())
+    ...
+    services.stop()
+"""
+import json
+import random
+import re
+import threading
+import time
+import urllib
+import urlparse
+from collections import defaultdict
+from email.utils import formatdate
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+# Face++ detection results for a face looking straight at the camera in the middle of the
+# picture.  Positions are percentages of the picture's width and height.
+CANNED_DETECTION = {
+    'face': [{
+        'position': {
+            'center': {'x': 50.0, 'y': 50.0},
+            'width': 40.0,
+            'height': 40.0,
+            'eye_left': {'x': 41.0, 'y': 42.0},
+            'eye_right': {'x': 59.0, 'y': 42.0},
+            'nose': {'x': 50.0, 'y': 52.0},
+            'mouth_left': {'x': 43.0, 'y': 60.0},
+            'mouth_right': {'x': 57.0, 'y': 60.0},
+        },
+    }],
+}
+
+
+def make_sid(prefix):
+    return "{}{:032x}".format(prefix, random.getrandbits(128))
+
+
+class FakeTwilio(object):
+    """Keeps the messages sent to and from the SMS Playground's phone number."""
+    def __init__(self, account_sid, phone_number):
+        self.account_sid = account_sid
+        self.phone_number = phone_number
+        self.messages = []
+        self.media = {}
+        self.listeners = {}
+        self.lock = threading.Lock()
+
+    @property
+    def messages_uri(self):
+        return "/2010-04-01/Accounts/{}/Messages".format(self.account_sid)
+
+    def receive(self, from_, body, picture=None):
+        """A user texts the SMS Playground, optionally with a picture."""
+        return self._add_message(from_, self.phone_number, body, picture, 'inbound')
+
+    def listen(self, phone_number, callback):
+        """Call callback(message) whenever the SMS Playground texts the phone number."""
+        with self.lock:
+            self.listeners[phone_number] = callback
+
+    def create_message(self, params):
+        message = self._add_message(params['From'], params['To'], params.get('Body', ""), None, 'outbound-api',
+                                    params.get('MediaUrl'))
+        listener = self.listeners.get(message['to'])
+        if listener:
+            listener(message)
+        return message
+
+    def list_messages(self, params):
+        with self.lock:
+            messages = list(reversed(self.messages))
+        if 'From' in params:
+            messages = [message for message in messages if message['from'] == params['From']]
+        if 'DateSent' in params:
+            messages = [message for message in messages if message['date'] == params['DateSent']]
+        if 'DateSent>' in params:
+            messages = [message for message in messages if message['date'] >= params['DateSent>']]
+        if 'DateSent<' in params:
+            messages = [message for message in messages if message['date'] <= params['DateSent<']]
+        page = int(params.get('Page', 0))
+        page_size = int(params.get('PageSize', 50))
+        return messages[page * page_size:(page + 1) * page_size], len(messages) > (page + 1) * page_size
+
+    def list_media(self, message_sid):
+        with self.lock:
+            return [media for media in self.media.values() if media['parent_sid'] == message_sid]
+
+    def get_media(self, media_sid):
+        return self.media.get(media_sid)
+
+    def _add_message(self, from_, to, body, picture, direction, media_url=None):
+        now = time.time()
+        message = {
+            'sid': make_sid('MM'),
+            'account_sid': self.account_sid,
+            'from': from_,
+            'to': to,
+            'body': body,
+            'num_media': "1" if picture or media_url else "0",
+            'direction': direction,
+            'status': 'received' if direction == 'inbound' else 'queued',
+            'date_created': formatdate(now),
+            'date_sent': formatdate(now),
+            'date_updated': formatdate(now),
+            'date': time.strftime('%Y-%m-%d', time.gmtime(now)),
+            'media_url': media_url,
+        }
+        message['uri'] = "{}/{}.json".format(self.messages_uri, message['sid'])
+        with self.lock:
+            self.messages.append(message)
+            if picture is not None:
+                media_sid = make_sid('ME')
+                self.media[media_sid] = {
+                    'sid': media_sid,
+                    'account_sid': self.account_sid,
+                    'parent_sid': message['sid'],
+                    'content_type': 'image/jpeg',
+                    'content': picture,
+                    'date_created': message['date_created'],
+                    'date_updated': message['date_created'],
+                    'uri': "{}/{}/Media/{}.json".format(self.messages_uri, message['sid'], media_sid),
+                }
+        return message
+
+
+class FakeS3(object):
+    """Keeps objects put into buckets."""
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put(self, bucket, key, content, content_type):
+        with self.lock:
+            self.objects[(bucket, key)] = (content, content_type)
+
+    def get(self, bucket, key):
+        return self.objects.get((bucket, key))
+
+
+class FakeServices(object):
+    """
+    Serves fake Twilio, Face++ and S3 APIs from one local HTTP server.
+
+    :param detection: The Face++ detection results returned for every picture
+    :param latency: Seconds each kind of request takes, e.g. {'facepp_detect': 0.5}, to
+        make the fakes behave more like the real services
+    """
+    def __init__(self, host='127.0.0.1', port=0, account_sid='ACfake', phone_number='+15550000000',
+                 bucket='sms-playground', detection=None, latency=None):
+        self.twilio = FakeTwilio(account_sid, phone_number)
+        self.s3 = FakeS3()
+        self.bucket = bucket
+        self.detection = detection or CANNED_DETECTION
+        self.latency = latency or {}
+        self.request_counts = defaultdict(int)
+        self.counts_lock = threading.Lock()
+        self.httpd = _ThreadingHTTPServer((host, port), _FakeServicesHandler)
+        self.httpd.services = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.httpd.server_address)
+
+    def server_environment(self):
+        """Environment variables that point server.py at these fakes."""
+        return {
+            'TWILIO_ACCOUNT_SID': self.twilio.account_sid,
+            'TWILIO_AUTH_TOKEN': 'fake',
+            'TWILIO_BASE_URL': self.url,
+            'TWILIO_PHONE_NUMBER': self.twilio.phone_number,
+            'FACEPP_API_KEY': 'fake',
+            'FACEPP_API_SECRET': 'fake',
+            'FACEPP_SERVER': self.url + "/",
+            'AWS_ACCESS_KEY_ID': 'fake',
+            'AWS_SECRET_ACCESS_KEY': 'fake',
+            'S3_ENDPOINT_URL': self.url,
+            'S3_BUCKET': self.bucket,
+            'S3_PUBLIC_URL': "{}/{}".format(self.url, self.bucket),
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-services')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count_request(self, endpoint):
+        with self.counts_lock:
+            self.request_counts[endpoint] += 1
+        delay = self.latency.get(endpoint)
+        if delay:
+            time.sleep(delay)
+
+    def reset_counts(self):
+        with self.counts_lock:
+            counts = dict(self.request_counts)
+            self.request_counts.clear()
+        return counts
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _FakeServicesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    twilio_messages = re.compile(r'^/2010-04-01/Accounts/[^/]+/Messages(\.json)?$')
+    twilio_media_list = re.compile(r'^/2010-04-01/Accounts/[^/]+/Messages/([^/]+)/Media(\.json)?$')
+    twilio_media = re.compile(r'^/2010-04-01/Accounts/[^/]+/Messages/[^/]+/Media/([^/.]+)(\.json)?$')
+    facepp_detect = re.compile(r'^/+detection/detect$')
+
+    @property
+    def services(self):
+        return self.server.services
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path, params = self._parse_path()
+
+        if self.twilio_messages.match(path):
+            self.services.count_request('twilio_messages_list')
+            messages, more = self.services.twilio.list_messages(params)
+            page = int(params.get('Page', 0))
+            next_page_uri = None
+            if more:
+                next_page_uri = "{}?{}".format(path, urllib.urlencode(sorted(dict(params, Page=page + 1).items())))
+            return self._send_json(200, {
+                'messages': messages,
+                'page': page,
+                'page_size': len(messages),
+                'next_page_uri': next_page_uri,
+                'uri': path,
+            })
+
+        match = self.twilio_media_list.match(path)
+        if match:
+            self.services.count_request('twilio_media_list')
+            media_list = [dict((key, value) for key, value in media.items() if key != 'content')
+                          for media in self.services.twilio.list_media(match.group(1))]
+            return self._send_json(200, {'media_list': media_list, 'next_page_uri': None, 'uri': path})
+
+        match = self.twilio_media.match(path)
+        if match:
+            self.services.count_request('twilio_media_download')
+            media = self.services.twilio.get_media(match.group(1))
+            if media is None:
+                return self._send(404, "", 'text/plain')
+            return self._send(200, media['content'], media['content_type'])
+
+        if self.facepp_detect.match(path):
+            self.services.count_request('facepp_detect')
+            return self._send_json(200, self.services.detection)
+
+        bucket, key = self._s3_key(path)
+        if bucket:
+            self.services.count_request('s3_get')
+            stored = self.services.s3.get(bucket, key)
+            if stored is None:
+                return self._send(404, "", 'text/plain')
+            return self._send(200, stored[0], stored[1])
+
+        self._send(404, "", 'text/plain')
+
+    def do_POST(self):
+        path, params = self._parse_path()
+
+        if self.twilio_messages.match(path):
+            self.services.count_request('twilio_messages_create')
+            form = urlparse.parse_qs(self._read_body())
+            message = self.services.twilio.create_message(dict((key, values[0]) for key, values in form.items()))
+            return self._send_json(201, message)
+
+        if self.facepp_detect.match(path):
+            self.services.count_request('facepp_detect')
+            self._read_body()
+            return self._send_json(200, self.services.detection)
+
+        self._send(404, "", 'text/plain')
+
+    def do_PUT(self):
+        path, params = self._parse_path()
+        bucket, key = self._s3_key(path)
+        if not bucket:
+            return self._send(404, "", 'text/plain')
+
+        # boto waits for permission before sending the file
+        if self.headers.get('Expect', '').lower() == '100-continue':
+            self.wfile.write("HTTP/1.1 100 Continue\r\n\r\n")
+
+        self.services.count_request('s3_put')
+        self.services.s3.put(bucket, key, self._read_body(), self.headers.get('Content-Type'))
+        self._send(200, "", 'text/plain', {'ETag': '"{:032x}"'.format(random.getrandbits(128))})
+
+    def _parse_path(self):
+        parsed = urlparse.urlparse(self.path)
+        params = dict((key, values[0]) for key, values in urlparse.parse_qs(parsed.query).items())
+        return parsed.path, params
+
+    def _s3_key(self, path):
+        parts = path.lstrip('/').split('/', 1)
+        if len(parts) == 2 and parts[0] == self.services.bucket:
+            return parts
+        return None, None
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data), 'application/json')
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
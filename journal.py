@@ -0,0 +1,127 @@
+"""
+An append-only journal of changes to in-memory state, so it survives restarts.
+
+Each change is appended to the journal file as a line of JSON, which only
+costs a write to the operating system's buffers (no fsync), so the journal
+is safe from the server process dying but not from the machine losing power.
+On startup the changes are replayed to rebuild the state, and the journal is
+compacted down to a single snapshot record of that state (one big JSON
+document decodes far faster than thousands of small ones):
+
+    journal = Journal('state.jsonl', snapshot=lambda: {'type': 'snapshot', 'handled': list(handled)})
+    for record in journal.replay():
+        if record['type'] == 'snapshot':
+            handled.update(record['handled'])
+        elif record['type'] == 'claimed':
+            handled.add(record['sid'])
+    journal.compact()
+    ...
+    handled.add(message.sid)
+    journal.append({'type': 'claimed', 'sid': message.sid})
+
+The journal is also compacted, on a background thread, whenever it grows
+past `compact_every` records.  Appending carries on while the snapshot is
+made and written; the records appended meanwhile are copied after it before
+it replaces the journal.  Since those records can also be in the snapshot,
+applying a record twice has to leave the state the same as applying it
+once.
+"""
+import json
+import os
+import threading
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+class Journal(object):
+    """
+    :param path: The journal file (created if it doesn't exist)
+    :param snapshot: Returns a record that rebuilds the current state, for compacting
+    :param compact_every: Records appended since the last compaction that trigger another one
+    """
+    def __init__(self, path, snapshot, compact_every=100000):
+        self.path = path
+        self.snapshot = snapshot
+        self.compact_every = compact_every
+        self.appended = 0
+        self.skipped = 0
+        self.file = None
+        self.lock = threading.Lock()
+        # Only one compaction at a time; lines appended while one is running are kept here too
+        self.compact_lock = threading.Lock()
+        self.compacting = None
+        self.appended_while_compacting = None
+
+    def replay(self):
+        """
+        Yield the records in the journal, oldest first.  Records that can't be read (most likely
+        the last one, cut off by a crash while it was being written) are skipped and counted.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    self.skipped += 1
+
+    def append(self, record):
+        line = _encoder.encode(record) + '\n'
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write(line)
+            self.file.flush()
+            self.appended += 1
+            if self.appended_while_compacting is not None:
+                self.appended_while_compacting.append(line)
+            elif self.appended >= self.compact_every and self.compacting is None:
+                self.compacting = threading.Thread(target=self._compact_in_background, name='journal-compact')
+                self.compacting.daemon = True
+                self.compacting.start()
+
+    def compact(self):
+        """Replace the journal with a snapshot of the current state."""
+        with self.compact_lock:
+            with self.lock:
+                self.appended_while_compacting = []
+            try:
+                # Write the snapshot next to the journal (without holding up appends), then the
+                # records appended since, and rename it over the top, so there's a whole journal
+                # (the old or the new one) whenever the server stops
+                temporary_path = self.path + '.compacting'
+                snapshot_file = open(temporary_path, 'w')
+                try:
+                    snapshot_file.write(_encoder.encode(self.snapshot()) + '\n')
+                    snapshot_file.flush()
+                    os.fsync(snapshot_file.fileno())
+                    with self.lock:
+                        snapshot_file.writelines(self.appended_while_compacting)
+                        snapshot_file.close()
+                        if self.file is not None:
+                            self.file.close()
+                        os.rename(temporary_path, self.path)
+                        self.file = open(self.path, 'a')
+                        self.appended = len(self.appended_while_compacting)
+                finally:
+                    snapshot_file.close()
+            finally:
+                with self.lock:
+                    self.appended_while_compacting = None
+
+    def close(self):
+        compacting = self.compacting
+        if compacting is not None:
+            compacting.join()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        finally:
+            with self.lock:
+                self.compacting = None
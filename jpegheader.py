@@ -0,0 +1,73 @@
+"""
+Reads a JPEG's dimensions and EXIF orientation from its header, without
+decoding the picture.
+
+    header = read_jpeg_header(picture_data)
+    if header is not None:
+        print header.width, header.height, header.orientation
+
+The orientation is the EXIF Orientation tag (1 to 8, 1 meaning the picture
+is already the right way up).  Phones save pictures the way the camera
+sensor sees them and set this tag to say how they should be turned.
+"""
+import struct
+from collections import namedtuple
+
+JpegHeader = namedtuple('JpegHeader', ['width', 'height', 'orientation'])
+
+ORIENTATION_TAG = 0x0112
+
+# Start of frame markers, which hold the dimensions (C4, C8 and CC are other markers)
+_START_OF_FRAME = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers that aren't followed by a length
+_STANDALONE = set(range(0xD0, 0xD9)) | {0x01}
+
+
+def read_jpeg_header(data):
+    """Return the JpegHeader of the JPEG, or None if it isn't a JPEG (or its header is broken)."""
+    if data[:2] != b'\xff\xd8':
+        return None
+    orientation = 1
+    offset = 2
+    try:
+        while offset < len(data):
+            if data[offset:offset + 1] != b'\xff':
+                return None
+            marker = ord(data[offset + 1:offset + 2])
+            offset += 2
+            if marker == 0xFF:
+                # Padding
+                offset -= 1
+                continue
+            if marker in _STANDALONE:
+                continue
+            if marker == 0xDA:
+                # The compressed picture starts here, without there having been a start of frame
+                return None
+            length, = struct.unpack('>H', data[offset:offset + 2])
+            segment = data[offset + 2:offset + length]
+            if marker == 0xE1 and segment[:6] == b'Exif\x00\x00':
+                orientation = _read_exif_orientation(segment[6:]) or orientation
+            elif marker in _START_OF_FRAME:
+                height, width = struct.unpack('>HH', segment[1:5])
+                return JpegHeader(width, height, orientation)
+            offset += length
+    except (struct.error, TypeError):
+        pass
+    return None
+
+
+def _read_exif_orientation(tiff):
+    # EXIF data is a little TIFF file: a byte order, the offset of the first directory of tags,
+    # then 12 bytes for each tag (tag, type, count, value)
+    byte_order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if byte_order is None:
+        return None
+    directory_offset, = struct.unpack(byte_order + 'I', tiff[4:8])
+    count, = struct.unpack(byte_order + 'H', tiff[directory_offset:directory_offset + 2])
+    for index in range(count):
+        entry = tiff[directory_offset + 2 + index * 12:directory_offset + 14 + index * 12]
+        tag, value_type, _, value = struct.unpack(byte_order + 'HHIH', entry[:10])
+        if tag == ORIENTATION_TAG and value_type == 3:
+            return value if 1 <= value <= 8 else None
+    return None
@@ -3,9 +3,10 @@ import time
 import json
 from datetime import datetime
 try:
-    from urllib2 import Request, urlopen, HTTPError
+    from urllib2 import Request, urlopen, HTTPError, URLError
 except:
-    from urllib.request import Request, urlopen, HTTPError
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
 
 
 def handle_server_down(exctype, value, traceback):
@@ -24,6 +25,52 @@ send_message_url = "http://sms-playground.com/conversation/{}/message/send"
 get_response_message_url = "http://sms-playground.com/conversation/{}/message/response/{}"
 add_to_picture_url = "http://sms-playground.com/conversation/{}/picture/{}/{}"
 get_transformed_picture_url = "http://sms-playground.com/conversation/{}/picture/{}/"
+get_picture_variants_url = "http://sms-playground.com/conversation/{}/picture/{}/variants"
+catalog_url = "http://sms-playground.com/catalog"
+
+
+def _open_url(request):
+    """
+    Sends a request to the SMS Playground server.  If the server is too busy to handle it right
+    now, it says how long to wait, so wait that long and send it again.
+    """
+    while (True):
+        try:
+            return urlopen(request)
+        except HTTPError as error:
+            if error.code != 503 or error.info().get('Content-Type') != 'application/json':
+                raise
+            time.sleep(json.loads(error.read().decode('utf8'))['wait_for_seconds'])
+
+
+# The moustaches and glasses the server has, and the ETag it sent with them
+_catalog = {'accessories': None, 'etag': None}
+
+
+def _check_accessory(kind, name, message):
+    """
+    Stops the program if the server doesn't have the moustache or glasses, without having to ask
+    the server to add it first.  The list of them is only fetched again if the name isn't in it
+    (in case it was added since).
+    """
+    for refresh in [False, True]:
+        if refresh or _catalog['accessories'] is None:
+            request = Request(catalog_url)
+            if _catalog['etag']:
+                request.add_header('If-None-Match', _catalog['etag'])
+            try:
+                response = urlopen(request)
+                _catalog['accessories'] = json.loads(response.read().decode('utf8'))
+                _catalog['etag'] = response.info().get('ETag')
+            except HTTPError as error:
+                # 304 means it hasn't changed.  Anything else, leave it to the server to check.
+                if error.code != 304:
+                    return
+            except (URLError, ValueError):
+                return
+        if name in _catalog['accessories'][kind]:
+            return
+    raise Exception(message.format(name, ", ".join(sorted(_catalog['accessories'][kind]))))
 
 
 class TxtConversation(object):
@@ -287,11 +334,15 @@ class Picture(object):
 
     def add_moustache(self, moustache_name):
         """
-        Adds a moustache to the image if there's a face on it.  Valid moustaches are "moustache1", "moustache2",
-        "moustache3", "moustache4", "moustache5", "moustache6", and "moustache7".
+        Adds a moustache to the image if there's a face on it.  Valid moustaches are "curly", "handlebar",
+        "horseshoe", "imperial", "reynolds", "walrus" and "yosemite_sam" (all of them are listed at
+        http://sms-playground.com/catalog).
 
         :param moustache_name: The name of the moustache. See list of valid moustache above.
         """
+        # Make sure there's a moustache with that name before asking for it
+        _check_accessory('moustaches', moustache_name, "There isn't a moustache with the name {}. Try one of these: {}")
+
         # Tell the server to send a text message to the user in the conversation
         request = Request(add_to_picture_url.format(self.conversation_code, self.picture_code, "moustache"), json.dumps({
             'moustache_name': moustache_name,
@@ -305,11 +356,14 @@ class Picture(object):
 
     def add_glasses(self, glasses_name):
         """
-        Adds glasses to the image if there's a face on it.  Valid glasses are "glasses1", "glasses2",
-        "glasses3", "glasses4", and "glasses5".
+        Adds glasses to the image if there's a face on it.  Valid glasses are "aviators", "glasses", "kanye",
+        "rectangle_glasses" and "shades" (all of them are listed at http://sms-playground.com/catalog).
 
         :param moustache_name: The name of the glasses. See list of valid glasses above.
         """
+        # Make sure there are glasses with that name before asking for them
+        _check_accessory('glasses', glasses_name, "There aren't glasses with the name {}. Try one of these: {}")
+
         # Tell the server to send a text message to the user in the conversation
         request = Request(add_to_picture_url.format(self.conversation_code, self.picture_code, "glasses"), json.dumps({
             'glasses_name': glasses_name,
@@ -321,11 +375,53 @@ class Picture(object):
             # If the server told us something was wrong with our request, stop the program
             raise Exception("Failed to add glasses: {}".format(error.read()))
 
+    def get_variants(self, variants, contact_sheet=False):
+        """
+        Makes a copy of the picture for each combination of moustache and glasses you list, all at
+        once, and returns the URLs for the copies.  Each one can be sent with `send_picture`.
+
+        Examples:
+
+        urls = picture.get_variants([("handlebar", "shades"), ("walrus", "aviators"), ("curly", None)])
+        for url in urls:
+            conversation.send_picture(url)
+
+        urls, contact_sheet_url = picture.get_variants([("handlebar", None), ("walrus", None)], contact_sheet=True)
+        conversation.send_picture(contact_sheet_url, "Which moustache do you like best?")
+
+        :param variants: A list of (moustache name, glasses name) pairs. Use None to leave one out.
+        :param contact_sheet: If True, also make one picture with all the copies side by side,
+            and return its URL along with the list of URLs.
+        :return: The list of URLs, in the same order as the variants.
+        """
+        for moustache_name, glasses_name in variants:
+            if moustache_name:
+                _check_accessory('moustaches', moustache_name,
+                                 "There isn't a moustache with the name {}. Try one of these: {}")
+            if glasses_name:
+                _check_accessory('glasses', glasses_name, "There aren't glasses with the name {}. Try one of these: {}")
+
+        request = Request(get_picture_variants_url.format(self.conversation_code, self.picture_code), json.dumps({
+            'variants': [{'moustache': moustache_name, 'glasses': glasses_name}
+                         for moustache_name, glasses_name in variants],
+            'contact_sheet': contact_sheet,
+        }).encode('utf-8'), {'Content-Type': 'application/json'})
+
+        try:
+            response_data = json.loads(_open_url(request).read().decode('utf8'))
+        except HTTPError as error:
+            # If the server told us something was wrong with our request, stop the program
+            raise Exception("Failed to make the picture variants: {}".format(error.read()))
+
+        if contact_sheet:
+            return response_data['urls'], response_data['contact_sheet_url']
+        return response_data['urls']
+
     def _get_url(self):
         """
         Asks the server for the URL for the picture with all the modifications defined (glasses, moustache, etc).
         :return: The URL for the modified picture.
         """
         request = Request(get_transformed_picture_url.format(self.conversation_code, self.picture_code))
-        response_data = json.loads(urlopen(request).read().decode('utf8'))
+        response_data = json.loads(_open_url(request).read().decode('utf8'))
         return response_data['url']
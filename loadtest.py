@@ -0,0 +1,308 @@
+"""
+End-to-end load test for server.py.
+
+Starts server.py against local fake Twilio, Face++ and S3 services (see
+fakes.py), then runs simulated users at increasing concurrency.  Every user
+texts a keyword to a kidmuseum program, replies with their name and a selfie,
+and waits for the selfie to come back with a moustache and glasses:
+
+    python loadtest.py --levels 1,5,10,25 --think-time 3
+
+For each concurrency level it reports throughput, p50/p95/p99 reply latency
+(from the user's text to the program's next text) and the request rate of
+every server and fake service endpoint.
+
+To load test the gevent serving mode instead:
+
+    python loadtest.py --server-command "python async_server.py"
+"""
+import os
+import re
+import sys
+import json
+import time
+import Queue
+import shutil
+import argparse
+import threading
+import subprocess
+import tempfile
+import urllib2
+from collections import defaultdict
+
+import cv2
+import numpy
+
+import kidmuseum
+import fakes
+
+NAME_PROMPT = "What's your name?"
+PICTURE_PROMPT = "Send me a selfie!"
+
+# Twilio message times are whole seconds (and twilio-python can't parse fractions of one), so a
+# reply sent less than a second after a program starts waiting can look older than the wait and
+# be ignored.  Programs also start waiting a little after the user gets their text.
+MIN_THINK_TIME = 2.0
+
+# Used to group requests made by kidmuseum by which server endpoint they hit
+server_endpoints = [
+    ('conversation_start', re.compile(r'/conversation/start$')),
+    ('message_send', re.compile(r'/conversation/[^/]+/message/send$')),
+    ('message_response', re.compile(r'/conversation/[^/]+/message/response/[^/]+$')),
+    ('picture_variants', re.compile(r'/conversation/[^/]+/picture/[^/]+/variants$')),
+    ('picture_add', re.compile(r'/conversation/[^/]+/picture/[^/]+/[^/]+$')),
+    ('picture_get', re.compile(r'/conversation/[^/]+/picture/[^/]+/$')),
+    ('catalog', re.compile(r'/catalog$')),
+]
+
+
+class ServerRequestCounter(object):
+    """Wraps kidmuseum's urlopen to count the requests made to each server endpoint."""
+    def __init__(self, urlopen):
+        self.urlopen = urlopen
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def __call__(self, request, *args, **kwargs):
+        url = request.get_full_url() if hasattr(request, 'get_full_url') else request
+        for name, pattern in server_endpoints:
+            if pattern.search(url):
+                with self.lock:
+                    self.counts[name] += 1
+                break
+        return self.urlopen(request, *args, **kwargs)
+
+    def reset_counts(self):
+        with self.lock:
+            counts = dict(self.counts)
+            self.counts.clear()
+        return counts
+
+
+def run_program(keyword, errors):
+    """The kidmuseum program each simulated user talks to."""
+    try:
+        conversation = kidmuseum.TxtConversation(keyword, timeout=120)
+        conversation.send_message("Welcome to the load test!")
+        name = conversation.get_string(NAME_PROMPT)
+        selfie = conversation.get_picture(PICTURE_PROMPT)
+        selfie.add_moustache("handlebar")
+        selfie.add_glasses("shades")
+        conversation.send_picture(selfie, "Looking good, {}".format(name))
+    except Exception as e:
+        errors.append("program {}: {}".format(keyword, e))
+
+
+class SimulatedUser(object):
+    """A person texting a program from their phone."""
+    def __init__(self, number, services, picture, think_time):
+        self.phone_number = "+1555{:07d}".format(number)
+        self.keyword = "loadtest {}".format(number)
+        self.services = services
+        self.picture = picture
+        self.think_time = think_time
+        self.inbox = Queue.Queue()
+        self.text_reply_seconds = []
+        self.picture_reply_seconds = []
+        self.conversation_seconds = None
+        services.twilio.listen(self.phone_number, self.inbox.put)
+
+    def run(self, errors, timeout=180):
+        start_time = time.time()
+        replied_at = self._reply(self.keyword)
+        replied_with_picture = False
+        try:
+            while True:
+                message = self.inbox.get(timeout=max(0, timeout - (time.time() - start_time)))
+                if replied_at is not None:
+                    latency = time.time() - replied_at
+                    if not replied_with_picture:
+                        self.text_reply_seconds.append(latency)
+                    elif message['media_url']:
+                        self.picture_reply_seconds.append(latency)
+                    if not replied_with_picture or message['media_url']:
+                        replied_at = None
+
+                if message['media_url']:
+                    self.conversation_seconds = time.time() - start_time
+                    return
+                elif message['body'] == NAME_PROMPT:
+                    replied_at = self._reply("Load Tester")
+                elif message['body'] == PICTURE_PROMPT:
+                    replied_at = self._reply("", self.picture)
+                    replied_with_picture = True
+        except Queue.Empty:
+            errors.append("user {} timed out".format(self.phone_number))
+
+    def _reply(self, body, picture=None):
+        # Give the program time to start waiting for the reply, like a real person typing would
+        time.sleep(self.think_time)
+        self.services.twilio.receive(self.phone_number, body, picture)
+        return time.time()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize_latencies(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 0.50),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': max(values) if values else None,
+    }
+
+
+def run_level(concurrency, services, server_requests, picture, think_time, first_user_number):
+    users = [SimulatedUser(first_user_number + i, services, picture, think_time) for i in range(concurrency)]
+    errors = []
+    threads = []
+    services.reset_counts()
+    server_requests.reset_counts()
+
+    start_time = time.time()
+    for user in users:
+        threads.append(threading.Thread(target=run_program, args=(user.keyword, errors)))
+        threads.append(threading.Thread(target=user.run, args=(errors,)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start_time
+
+    rates = lambda counts: dict((name, count / duration) for name, count in sorted(counts.items()))
+    completed = [user for user in users if user.conversation_seconds is not None]
+    return {
+        'concurrency': concurrency,
+        'duration_seconds': duration,
+        'completed_conversations': len(completed),
+        'conversations_per_second': len(completed) / duration,
+        'errors': errors,
+        'conversation_seconds': summarize_latencies([user.conversation_seconds for user in completed]),
+        'text_reply_seconds': summarize_latencies(sum((user.text_reply_seconds for user in users), [])),
+        'picture_reply_seconds': summarize_latencies(sum((user.picture_reply_seconds for user in users), [])),
+        'server_requests_per_second': rates(server_requests.reset_counts()),
+        'service_requests_per_second': rates(services.reset_counts()),
+    }
+
+
+def start_server(command, environment, port, startup_timeout=30):
+    process = subprocess.Popen(command, env=environment)
+    deadline = time.time() + startup_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise Exception("server.py exited with code {}".format(process.returncode))
+        try:
+            urllib2.urlopen("http://127.0.0.1:{}/metrics".format(port), timeout=1)
+            return process
+        except Exception:
+            time.sleep(0.25)
+    process.terminate()
+    raise Exception("server.py didn't start within {} seconds".format(startup_timeout))
+
+
+def point_kidmuseum_at(server_url):
+    kidmuseum.start_conversation_url = server_url + "/conversation/start"
+    kidmuseum.send_message_url = server_url + "/conversation/{}/message/send"
+    kidmuseum.get_response_message_url = server_url + "/conversation/{}/message/response/{}"
+    kidmuseum.add_to_picture_url = server_url + "/conversation/{}/picture/{}/{}"
+    kidmuseum.get_transformed_picture_url = server_url + "/conversation/{}/picture/{}/"
+    kidmuseum.get_picture_variants_url = server_url + "/conversation/{}/picture/{}/variants"
+    kidmuseum.catalog_url = server_url + "/catalog"
+
+
+def load_picture(path):
+    if path:
+        with open(path, 'rb') as picture_file:
+            return picture_file.read()
+    # A 1600x1200 noisy gradient, about the size of a phone selfie after MMS compression
+    random_state = numpy.random.RandomState(0)
+    gradient = numpy.linspace(0, 255, 1600).astype(numpy.float32)[numpy.newaxis, :, numpy.newaxis]
+    picture = numpy.repeat(numpy.repeat(gradient, 1200, axis=0), 3, axis=2)
+    picture += random_state.normal(0, 20, picture.shape).astype(numpy.float32)
+    return cv2.imencode('.jpg', numpy.clip(picture, 0, 255).astype(numpy.uint8))[1].tostring()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test server.py against fake Twilio, Face++ and S3 services.")
+    parser.add_argument('--levels', default="1,5,10,25", help="Comma separated numbers of concurrent users")
+    parser.add_argument('--think-time', type=float, default=3.0,
+                        help="Seconds a user waits before replying (at least {:g}, because "
+                             "Twilio times are rounded to the second)".format(MIN_THINK_TIME))
+    parser.add_argument('--picture', help="Selfie the users send (a synthetic picture is used by default)")
+    parser.add_argument('--port', type=int, default=5050, help="Port to run server.py on")
+    parser.add_argument('--server-command', default="{} server.py".format(sys.executable),
+                        help="Command that starts the server")
+    parser.add_argument('--twilio-latency', type=float, default=0.1, help="Seconds each fake Twilio request takes")
+    parser.add_argument('--facepp-latency', type=float, default=0.5, help="Seconds each fake Face++ request takes")
+    parser.add_argument('--s3-latency', type=float, default=0.1, help="Seconds each fake S3 request takes")
+    parser.add_argument('--output', help="Write the results as JSON to this file instead of stdout")
+    args = parser.parse_args()
+    if args.think_time < MIN_THINK_TIME:
+        parser.error("--think-time must be at least {:g} seconds".format(MIN_THINK_TIME))
+
+    services = fakes.FakeServices(latency={
+        'twilio_messages_list': args.twilio_latency,
+        'twilio_messages_create': args.twilio_latency,
+        'twilio_media_list': args.twilio_latency,
+        'twilio_media_download': args.twilio_latency,
+        'facepp_detect': args.facepp_latency,
+        's3_put': args.s3_latency,
+    })
+    services.start()
+
+    environment = dict(os.environ)
+    environment.update(services.server_environment())
+    environment['PORT'] = str(args.port)
+    environment.setdefault('LOG_PATH', os.devnull)
+    # A fresh journal and media cache, so runs don't replay or reuse each other's state
+    data_directory = tempfile.mkdtemp(prefix='loadtest-')
+    environment['STATE_JOURNAL_PATH'] = os.path.join(data_directory, 'state.jsonl')
+    environment['MEDIA_CACHE_PATH'] = os.path.join(data_directory, 'media-cache')
+    try:
+        server_process = start_server(args.server_command.split(), environment, args.port)
+    except Exception:
+        shutil.rmtree(data_directory, ignore_errors=True)
+        services.stop()
+        raise
+
+    point_kidmuseum_at("http://127.0.0.1:{}".format(args.port))
+    server_requests = ServerRequestCounter(kidmuseum.urlopen)
+    kidmuseum.urlopen = server_requests
+    picture = load_picture(args.picture)
+
+    results = []
+    try:
+        next_user_number = 0
+        for concurrency in [int(level) for level in args.levels.split(',')]:
+            sys.stderr.write("Running {} concurrent users...\n".format(concurrency))
+            result = run_level(concurrency, services, server_requests, picture, args.think_time, next_user_number)
+            next_user_number += concurrency
+            results.append(result)
+            sys.stderr.write("  {:.2f} conversations/s, picture reply p50 {} p95 {} p99 {}, {} errors\n".format(
+                result['conversations_per_second'], result['picture_reply_seconds']['p50'],
+                result['picture_reply_seconds']['p95'], result['picture_reply_seconds']['p99'],
+                len(result['errors'])))
+    finally:
+        server_process.terminate()
+        server_process.wait()
+        services.stop()
+        shutil.rmtree(data_directory, ignore_errors=True)
+
+    report = {'think_time': args.think_time, 'levels': results}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
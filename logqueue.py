@@ -0,0 +1,91 @@
+"""
+Non-blocking logging through a bounded queue.
+
+Request threads only put log records on a queue with a `QueueHandler`, and a
+`QueueListener` thread in the background formats them and hands them to the
+slow handlers (files, the console, ...).  If the queue fills up, new records
+are dropped and counted instead of making the request wait:
+
+    log_queue = Queue.Queue(maxsize=10000)
+    queue_handler = QueueHandler(log_queue)
+    logger.addHandler(queue_handler)
+    listener = QueueListener(log_queue, file_handler, stream_handler)
+    listener.start()
+
+Python 3 ships these in logging.handlers; this is the same idea for Python 2.
+"""
+import json
+import logging
+import Queue
+import threading
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts log records on a queue without waiting.  Records are left unformatted
+    so formatting happens on the listener's thread, which means arguments
+    passed to the logger shouldn't be changed after they've been logged.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+
+class QueueListener(object):
+    """Takes records off a queue in a background thread and passes them to handlers."""
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._monitor, name='log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Write out any records still on the queue and stop the background thread."""
+        if self.thread is None:
+            return
+        # Wait for room on the queue so the sentinel can't get dropped
+        self.queue.put(self._sentinel)
+        self.thread.join()
+        self.thread = None
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            self.handle(record)
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats each record as one compact line of JSON."""
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'))
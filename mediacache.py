@@ -0,0 +1,133 @@
+"""
+A cache of downloaded media on local disk, keyed by a hash of the content.
+
+Pictures kids send are downloaded as soon as they arrive and kept here
+until they're rendered, so rendering doesn't have to wait on the download.
+Identical pictures (the same selfie sent twice) are only stored once, and
+the least recently used pictures are removed once the cache gets bigger
+than `max_bytes`:
+
+    cache = MediaCache('media-cache', max_bytes=500 * 1024 * 1024)
+    key = cache.put(picture_data)
+    ...
+    picture_data = cache.get(key)    # None if it's been removed since
+
+What's in the cache is found again when it's created, so it survives
+restarts.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class MediaCache(object):
+    """
+    :param directory: Where the media is stored (created if it doesn't exist)
+    :param max_bytes: Most space the media can take up
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self.evicted = 0
+        # Sizes of the media in the cache, least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._scan()
+
+    def put(self, data):
+        """Store the media (unless it's already stored) and return its key."""
+        key = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = self.entries.pop(key)
+                self.deduplicated += 1
+                return key
+
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Another thread made it first
+                pass
+        # Write to a temporary file and rename it into place, so a half-written file is never read
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(descriptor, 'wb') as media_file:
+            media_file.write(data)
+        os.rename(temporary_path, path)
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = len(data)
+                self.total_bytes += len(data)
+            evicted = self._evict()
+        for evicted_key in evicted:
+            self._remove(evicted_key)
+        return key
+
+    def get(self, key):
+        """Return the media stored with the key, or None if it isn't in the cache."""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries[key] = self.entries.pop(key)
+        try:
+            with open(self._path(key), 'rb') as media_file:
+                data = media_file.read()
+            # Remember it was used, for when the cache is scanned again after a restart
+            os.utime(self._path(key), None)
+        except (IOError, OSError):
+            # Removed by another thread since
+            with self.lock:
+                if key in self.entries:
+                    self.total_bytes -= self.entries.pop(key)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def _evict(self):
+        # Called with the lock held.  The newest media is kept even if it's bigger than max_bytes.
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evicted += 1
+            evicted.append(key)
+        return evicted
+
+    def _remove(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _scan(self):
+        found = []
+        for subdirectory in os.listdir(self.directory):
+            subdirectory_path = os.path.join(self.directory, subdirectory)
+            if not os.path.isdir(subdirectory_path):
+                continue
+            for key in os.listdir(subdirectory_path):
+                if re.match(r'^[0-9a-f]{64}$', key):
+                    stat = os.stat(os.path.join(subdirectory_path, key))
+                    found.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+        for key in self._evict():
+            self._remove(key)
@@ -0,0 +1,198 @@
+"""
+Lightweight metrics that can be scraped by Prometheus.
+
+Metrics register themselves with a registry when they're created, and
+`render` turns everything registered into the Prometheus text format:
+
+    requests = Counter('requests_total', 'Requests handled.', ['route'])
+    requests.inc('index')
+    print render()
+
+Recording a value only takes a dict lookup and a lock, so it's cheap
+enough to leave on in production.
+"""
+import abc
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Registry(object):
+    """A collection of metrics that get rendered together."""
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type_name))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+default_registry = Registry()
+
+
+def render(registry=None):
+    """Render every metric in the registry in the Prometheus text format."""
+    return (registry or default_registry).render()
+
+
+class _Metric(object):
+    """
+    The base of every kind of metric.  Subclasses set `type_name` to the Prometheus type and
+    implement `samples`.
+    """
+    __metaclass__ = abc.ABCMeta
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        (registry or default_registry).register(self)
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError("{} expects labels {}".format(self.name, self.labelnames))
+        return tuple(str(value) for value in labelvalues)
+
+    def _format_labels(self, labelvalues, extra=()):
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+    @abc.abstractmethod
+    def samples(self):
+        """Return the metric's lines in the Prometheus text format, without its HELP and TYPE lines."""
+
+
+class Counter(_Metric):
+    """A value that only goes up, like the number of requests made."""
+    type_name = 'counter'
+
+    def inc(self, *labelvalues, **kwargs):
+        key = self._key(labelvalues)
+        amount = kwargs.get('amount', 1)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, *labelvalues):
+        return self.values.get(self._key(labelvalues), 0)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ["{}{} {}".format(self.name, self._format_labels(key), _format_number(value))
+                for key, value in values]
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down.  If a function is given, it's called
+    to get the current value whenever the metrics are rendered (the gauge
+    is left out if it returns None).
+    """
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, function=None, labelnames=(), registry=None):
+        super(Gauge, self).__init__(name, documentation, labelnames, registry)
+        self.function = function
+
+    def set(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, *labelvalues, **kwargs):
+        key = self._key(labelvalues)
+        amount = kwargs.get('amount', 1)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, *labelvalues, **kwargs):
+        self.inc(*labelvalues, amount=-kwargs.get('amount', 1))
+
+    def get(self, *labelvalues):
+        if self.function is not None:
+            return self.function()
+        return self.values.get(self._key(labelvalues), 0)
+
+    def samples(self):
+        if self.function is not None:
+            value = self.function()
+            return [] if value is None else ["{} {}".format(self.name, _format_number(value))]
+        with self.lock:
+            values = sorted(self.values.items())
+        return ["{}{} {}".format(self.name, self._format_labels(key), _format_number(value))
+                for key, value in values]
+
+
+class Histogram(_Metric):
+    """Counts observations (usually durations in seconds) into buckets."""
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts = self.values[key]
+            counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """Observe how long the block of code inside the `with` statement takes."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start_time, *labelvalues)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts[0]), counts[1], counts[2])) for key, counts in self.values.items())
+        lines = []
+        for key, (bucket_counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, self._format_labels(key, [('le', _format_number(bound))]), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, self._format_labels(key), _format_number(total)))
+            lines.append("{}_count{} {}".format(self.name, self._format_labels(key), count))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,272 @@
+"""
+Renders every moustache and glasses combination onto a set of pictures, for
+tuning where and how big the accessories get drawn (the width_multi options
+in server.py) without clicking through them one at a time.
+
+    python placement_report.py selfies/ --output placement/
+    python placement_report.py selfies/ --width-multi walrus=1.8 --width-multi shades=2.2
+
+Pictures can be directories, image files or URLs.  Each picture is detected
+once: Face++ results saved next to a local picture as <picture>.json are
+used if they're there, otherwise Face++ is called (for all the pictures in
+parallel), or the canned landmarks are used with --canned.  Then every
+combination is rendered across all the CPU cores.
+
+For each picture it writes a contact sheet (a row per moustache, a column per
+glasses) to the output directory, and report.json with the landmarks, where
+each accessory ended up and how long each stage took.
+"""
+import os
+import re
+import sys
+import json
+import glob
+import argparse
+import multiprocessing
+import timeit
+from datetime import datetime
+
+import cv2
+import numpy
+
+import server
+from fakes import CANNED_DETECTION
+
+# The pictures, landmarks and options being rendered (along with the width_multi changes made
+# to server.py's options).  Filled in before the worker processes are forked, so the workers
+# get them without them having to be pickled.
+_pictures = []
+_options = {}
+
+
+def find_pictures(sources):
+    """Returns a list of (name, path or URL) for the pictures to render."""
+    pictures = []
+    for source in sources:
+        if re.match(r'https?://', source):
+            pictures.append((re.sub(r'[^A-Za-z0-9_.-]+', '_', source.split('://', 1)[1])[-80:], source))
+        elif os.path.isdir(source):
+            for path in sorted(glob.glob(os.path.join(source, '*'))):
+                if not path.endswith('.json') and os.path.isfile(path):
+                    pictures.append((os.path.basename(path), path))
+        else:
+            pictures.append((os.path.basename(source), source))
+    return pictures
+
+
+def load_picture(source):
+    """Decode a picture and shrink it to the size server.py renders at, timing it."""
+    start_time = timeit.default_timer()
+    if re.match(r'https?://', source):
+        picture = server.get_image(source)
+    else:
+        with open(source, 'rb') as picture_file:
+            picture = server.decode_image(picture_file.read())
+        if picture is None:
+            raise IOError("Couldn't read the picture {}".format(source))
+    return picture, timeit.default_timer() - start_time
+
+
+def detect_faces(pictures, canned):
+    """
+    Returns (detection results, where they came from, seconds taken) for each picture, only
+    calling Face++ (in parallel) for pictures without saved results.
+    """
+    detections = [None] * len(pictures)
+    to_detect = []
+    for index, (name, source, picture) in enumerate(pictures):
+        if os.path.exists(source + '.json'):
+            with open(source + '.json') as detection_file:
+                detections[index] = (json.load(detection_file), 'file', 0.0)
+        elif canned:
+            detections[index] = (CANNED_DETECTION, 'canned', 0.0)
+        else:
+            to_detect.append(index)
+
+    if to_detect:
+        facepp_api = server.get_facepp_api()
+        with facepp_api.batch(max_workers=4) as batch:
+            jobs = []
+            for index in to_detect:
+                start_time = timeit.default_timer()
+                future = batch.submit(facepp_api.detection.detect, img=server.make_detection_file(pictures[index][2]),
+                                      mode="oneface")
+                jobs.append((index, start_time, future))
+            for index, start_time, future in jobs:
+                detections[index] = (future.result(), 'facepp', timeit.default_timer() - start_time)
+    return detections
+
+
+def render_row(job):
+    """
+    Render one picture with one moustache and every pair of glasses.  Runs in a worker process.
+    Returns the row of contact sheet tiles and what happened for each combination.
+    """
+    picture_index, moustache_name = job
+    name, source, picture, detection = _pictures[picture_index]
+
+    tiles = []
+    combinations = []
+    for glasses_name in server.accessory_catalog.names('glasses'):
+        image = picture.copy()
+        face_features = server.DetectedFace(None, image, data=detection)
+
+        start_time = timeit.default_timer()
+        moustache_area = server.add_moustache(image, face_features, moustache_name)
+        moustache_seconds = timeit.default_timer() - start_time
+
+        start_time = timeit.default_timer()
+        glasses_area = server.add_glasses(image, face_features, glasses_name)
+        glasses_seconds = timeit.default_timer() - start_time
+
+        combinations.append({
+            'moustache': moustache_name,
+            'glasses': glasses_name,
+            'moustache_area': moustache_area,
+            'glasses_area': glasses_area,
+            'timings_ms': {'add_moustache': moustache_seconds * 1000, 'add_glasses': glasses_seconds * 1000},
+        })
+
+        if _options['show_landmarks']:
+            server.add_detected_features(image, face_features)
+        tiles.append(make_tile(image, "{} + {}".format(moustache_name, glasses_name), _options['tile_width']))
+    return tiles, combinations
+
+
+def make_tile(image, label, width):
+    height = int(image.shape[0] * (float(width) / image.shape[1]))
+    tile = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    cv2.rectangle(tile, (0, height - 18), (width, height), (0, 0, 0), -1)
+    cv2.putText(tile, label, (4, height - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+    return tile
+
+
+def landmarks(picture, detection):
+    """The landmarks server.py places accessories by, in pixels."""
+    face_features = server.DetectedFace(None, picture, data=detection)
+    return dict((feature, getattr(face_features, feature)) for feature in [
+        'face_x1', 'face_y1', 'face_x2', 'face_y2', 'left_eye_x', 'left_eye_y', 'right_eye_x', 'right_eye_y',
+        'nose_x', 'nose_y', 'mouth_x1', 'mouth_y1', 'mouth_x2', 'mouth_y2'])
+
+
+def summarize_timings(timings):
+    timings = sorted(timings)
+    return {
+        'count': len(timings),
+        'mean_ms': sum(timings) / len(timings),
+        'median_ms': timings[len(timings) // 2],
+        'max_ms': timings[-1],
+    }
+
+
+def parse_width_multi(values):
+    moustache_options, glasses_options = {}, {}
+    for value in values:
+        name, _, multiplier = value.partition('=')
+        if server.accessory_catalog.exists('moustache', name):
+            moustache_options[name] = dict(server.accessory_catalog.options('moustache', name),
+                                           width_multi=float(multiplier))
+        elif server.accessory_catalog.exists('glasses', name):
+            glasses_options[name] = dict(server.accessory_catalog.options('glasses', name),
+                                         width_multi=float(multiplier))
+        else:
+            raise ValueError("There isn't a moustache or glasses with the name {}".format(name))
+    return moustache_options, glasses_options
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render every accessory combination onto a set of pictures.")
+    parser.add_argument('sources', nargs='+', help="Directories of pictures, pictures or picture URLs")
+    parser.add_argument('--output', default='placement', help="Directory to write the contact sheets and report to")
+    parser.add_argument('--canned', action='store_true',
+                        help="Use the canned landmarks for pictures without saved Face++ results instead of calling Face++")
+    parser.add_argument('--width-multi', action='append', default=[], metavar='NAME=VALUE',
+                        help="Try a different width_multi for a moustache or glasses (can be repeated)")
+    parser.add_argument('--show-landmarks', action='store_true', help="Mark the detected landmarks on the tiles")
+    parser.add_argument('--tile-width', type=int, default=240, help="Width of each picture on the contact sheets")
+    parser.add_argument('--processes', type=int, help="Worker processes to render with (default is one per core)")
+    args = parser.parse_args()
+
+    moustache_options, glasses_options = parse_width_multi(args.width_multi)
+    server.moustache_options.update(moustache_options)
+    server.glasses_options.update(glasses_options)
+    _options.update({
+        'show_landmarks': args.show_landmarks,
+        'tile_width': args.tile_width,
+    })
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    loaded = []
+    decode_seconds = []
+    for name, source in find_pictures(args.sources):
+        sys.stderr.write("Loading {}...\n".format(name))
+        picture, seconds = load_picture(source)
+        loaded.append((name, source, picture))
+        decode_seconds.append(seconds)
+
+    sys.stderr.write("Detecting faces...\n")
+    detections = detect_faces(loaded, args.canned)
+    for (name, source, picture), (detection, _, _) in zip(loaded, detections):
+        _pictures.append((name, source, picture, detection))
+
+    # Load the accessories before forking, so every worker starts out with them
+    server.preload_accessories()
+    moustache_names = server.accessory_catalog.names('moustache')
+    jobs = [(index, moustache_name) for index in range(len(_pictures)) for moustache_name in moustache_names]
+    sys.stderr.write("Rendering {} combinations...\n".format(
+        len(jobs) * len(server.accessory_catalog.names('glasses'))))
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        rows = pool.map(render_row, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    report_pictures = []
+    stage_timings = {'decode': [seconds * 1000 for seconds in decode_seconds], 'add_moustache': [], 'add_glasses': []}
+    for index, (name, source, picture, detection) in enumerate(_pictures):
+        picture_rows = rows[index * len(moustache_names):(index + 1) * len(moustache_names)]
+        sheet_path = os.path.join(args.output, "{}.jpg".format(os.path.splitext(name)[0]))
+        cv2.imwrite(sheet_path, numpy.vstack([numpy.hstack(tiles) for tiles, _ in picture_rows]))
+
+        combinations = [combination for _, row_combinations in picture_rows for combination in row_combinations]
+        for combination in combinations:
+            for stage, milliseconds in combination['timings_ms'].items():
+                stage_timings[stage].append(milliseconds)
+        _, detection_source, detect_seconds = detections[index]
+        if detection_source == 'facepp':
+            stage_timings.setdefault('detect', []).append(detect_seconds * 1000)
+
+        report_pictures.append({
+            'name': name,
+            'source': source,
+            'resolution': "{}x{}".format(picture.shape[1], picture.shape[0]),
+            'detection_source': detection_source,
+            'detection': detection,
+            'landmarks': landmarks(picture, detection),
+            'timings_ms': {'decode': decode_seconds[index] * 1000, 'detect': detect_seconds * 1000},
+            'contact_sheet': sheet_path,
+            'combinations': combinations,
+        })
+
+    report = {
+        'meta': {
+            'time': datetime.utcnow().isoformat(),
+            'moustache_options': dict((name, server.accessory_catalog.options('moustache', name))
+                                      for name in moustache_names),
+            'glasses_options': dict((name, server.accessory_catalog.options('glasses', name))
+                                    for name in server.accessory_catalog.names('glasses')),
+        },
+        'timings': dict((stage, summarize_timings(timings)) for stage, timings in stage_timings.items() if timings),
+        'pictures': report_pictures,
+    }
+    report_path = os.path.join(args.output, 'report.json')
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    sys.stderr.write("Wrote {} contact sheets and {}\n".format(len(report_pictures), report_path))
+
+
+if __name__ == '__main__':
+    main()
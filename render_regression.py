@@ -0,0 +1,237 @@
+"""
+Checks that moustaches and glasses still get drawn where, and how, they used
+to, and no slower.
+
+The corpus in regression/ is a set of pictures with canned Face++ landmarks
+(inputs/<picture>.json), a list of the accessory combinations to render onto
+them (corpus.json), the renders they're expected to produce (expected/) and
+how long each render took when those were made (timings.json).
+
+    python render_regression.py
+    python render_regression.py --update            # after a change that's meant to alter renders
+    python render_regression.py --update-timings    # on a new machine, or after a speed up
+
+Every combination is rendered across all the CPU cores and compared with its
+expected render.  The comparison only looks at the parts of the picture an
+accessory covers (in either render), so a moustache moving a few pixels on a
+small face isn't lost in the rest of the picture, and tolerates the tiny
+differences OpenCV builds make when resizing.  Renders that look different,
+or got slower than --slowdown allows, are listed and the script exits with 1;
+side-by-side images (expected, actual, difference) of the ones that look
+different and results.json are written to --output.
+
+Timings depend on the machine, so only compare them against timings.json
+made on the same machine.  Use --processes 1 for the steadiest timings.
+"""
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+import timeit
+from datetime import datetime
+
+import cv2
+import numpy
+
+import server
+
+CORPUS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regression')
+
+# Pixels further apart than this (in any channel) are ones you can see are different
+VISIBLE_DIFFERENCE = 24
+
+# The corpus options, filled in before the worker processes are forked
+_options = {}
+
+
+def load_corpus(directory):
+    with open(os.path.join(directory, 'corpus.json')) as corpus_file:
+        cases = json.load(corpus_file)['cases']
+    timings_path = os.path.join(directory, 'timings.json')
+    timings = {}
+    if os.path.exists(timings_path):
+        with open(timings_path) as timings_file:
+            timings = json.load(timings_file)
+    return cases, timings
+
+
+def case_name(case):
+    return "{}__{}__{}".format(os.path.splitext(case['picture'])[0], case['moustache'] or 'none',
+                               case['glasses'] or 'none')
+
+
+def render_case(case):
+    """
+    Render one combination, timing the best of --repeat renders.  Runs in a worker process.
+    Returns (picture, render, best render time in milliseconds).
+    """
+    picture_path = os.path.join(_options['directory'], 'inputs', case['picture'])
+    picture = cv2.imread(picture_path)
+    if picture is None:
+        raise IOError("Couldn't read the picture {}".format(picture_path))
+    picture = server.resize_image(picture)
+    with open(picture_path + '.json') as detection_file:
+        detection = json.load(detection_file)
+
+    transform_info = {'moustache': case['moustache'], 'glasses': case['glasses']}
+    timings = []
+    for _ in range(_options['repeat']):
+        image = picture.copy()
+        face_features = server.DetectedFace(None, image, data=detection)
+        start_time = timeit.default_timer()
+        server.transform_image(image, transform_info, face_features)
+        timings.append(timeit.default_timer() - start_time)
+    return picture, image, min(timings) * 1000
+
+
+def compare(picture, expected, actual):
+    """
+    Returns (structural similarity, fraction of pixels visibly different) of the two renders,
+    over the parts of the picture either render changed.
+    """
+    if expected.shape != actual.shape:
+        return 0.0, 1.0
+    changed = (numpy.abs(expected.astype(numpy.int16) - picture).max(axis=2) > 0) | \
+              (numpy.abs(actual.astype(numpy.int16) - picture).max(axis=2) > 0)
+    if not changed.any():
+        return 1.0, 0.0
+    # Include a little of what's around the accessories, so one drawn in the wrong place still
+    # counts against the similarity where it should have been
+    changed = cv2.dilate(changed.astype(numpy.uint8), numpy.ones((7, 7), numpy.uint8)) > 0
+
+    visible = numpy.abs(expected.astype(numpy.int16) - actual).max(axis=2) > VISIBLE_DIFFERENCE
+    return float(structural_similarity(expected, actual)[changed].mean()), \
+        float(visible[changed].sum()) / changed.sum()
+
+
+def structural_similarity(image1, image2):
+    """SSIM of each pixel (the lowest of the three channels), with the usual 11x11 Gaussian window."""
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    image1 = image1.astype(numpy.float64)
+    image2 = image2.astype(numpy.float64)
+
+    def blur(image):
+        return cv2.GaussianBlur(image, (11, 11), 1.5)
+
+    mu1 = blur(image1)
+    mu2 = blur(image2)
+    sigma1 = blur(image1 * image1) - mu1 * mu1
+    sigma2 = blur(image2 * image2) - mu2 * mu2
+    sigma12 = blur(image1 * image2) - mu1 * mu2
+    ssim = ((2 * mu1 * mu2 + c1) * (2 * sigma12 + c2)) / ((mu1 * mu1 + mu2 * mu2 + c1) * (sigma1 + sigma2 + c2))
+    return ssim.min(axis=2)
+
+
+def make_diff_image(expected, actual):
+    """Expected, actual and the difference between them (made brighter), side by side."""
+    if expected.shape != actual.shape:
+        actual = cv2.resize(actual, (expected.shape[1], expected.shape[0]))
+    difference = numpy.abs(expected.astype(numpy.int16) - actual).max(axis=2)
+    difference = cv2.applyColorMap(numpy.clip(difference * 4, 0, 255).astype(numpy.uint8), cv2.COLORMAP_JET)
+    return numpy.hstack([expected, actual, difference])
+
+
+def write_json(path, data):
+    with open(path, 'w') as json_file:
+        json.dump(data, json_file, indent=2, sort_keys=True, separators=(',', ': '))
+        json_file.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare accessory renders with the regression corpus.")
+    parser.add_argument('--corpus', default=CORPUS_DIRECTORY, help="The regression corpus directory")
+    parser.add_argument('--output', default='regression-results',
+                        help="Directory to write results.json and the differences to")
+    parser.add_argument('--update', action='store_true',
+                        help="Replace the expected renders and timings with these ones")
+    parser.add_argument('--update-timings', action='store_true', help="Replace the expected timings with these ones")
+    parser.add_argument('--min-similarity', type=float, default=0.98,
+                        help="Lowest structural similarity of the accessories' parts of a render that passes")
+    parser.add_argument('--max-visible', type=float, default=0.01,
+                        help="Highest fraction of the accessories' pixels that can be visibly different")
+    parser.add_argument('--slowdown', type=float, default=0.25,
+                        help="How much slower than its expected timing a render can get (0.25 is 25%%)")
+    parser.add_argument('--min-slowdown-ms', type=float, default=0.5,
+                        help="Slowdowns smaller than this many milliseconds are ignored as noise")
+    parser.add_argument('--repeat', type=int, default=5, help="Renders to time each combination by (the best is kept)")
+    parser.add_argument('--processes', type=int, help="Worker processes to render with (default is one per core)")
+    args = parser.parse_args()
+
+    cases, expected_timings = load_corpus(args.corpus)
+    expected_directory = os.path.join(args.corpus, 'expected')
+    for directory in [expected_directory, args.output]:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    _options.update({
+        'directory': args.corpus,
+        'repeat': args.repeat,
+    })
+
+    # Load the accessories before forking, so every worker starts out with them
+    server.preload_accessories()
+    sys.stderr.write("Rendering {} combinations...\n".format(len(cases)))
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        renders = pool.map(render_case, cases)
+    finally:
+        pool.close()
+        pool.join()
+
+    results = []
+    failures = []
+    timings = {}
+    for case, (picture, actual, render_ms) in zip(cases, renders):
+        name = case_name(case)
+        expected_path = os.path.join(expected_directory, name + '.png')
+        timings[name] = round(render_ms, 3)
+        if args.update:
+            cv2.imwrite(expected_path, actual, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+
+        result = dict(case, name=name, render_ms=render_ms, expected_ms=expected_timings.get(name), problems=[])
+        expected = cv2.imread(expected_path)
+        if expected is None:
+            result['problems'].append("there's no expected render (run with --update)")
+        else:
+            result['similarity'], result['visible'] = compare(picture, expected, actual)
+            if result['similarity'] < args.min_similarity or result['visible'] > args.max_visible:
+                result['problems'].append("looks different (similarity {:.4f}, {:.2%} visibly different)".format(
+                    result['similarity'], result['visible']))
+                result['difference'] = os.path.join(args.output, name + '.png')
+                cv2.imwrite(result['difference'], make_diff_image(expected, actual))
+
+        if not (args.update or args.update_timings) and result['expected_ms'] is not None:
+            slower_ms = render_ms - result['expected_ms']
+            if slower_ms > args.min_slowdown_ms and render_ms > result['expected_ms'] * (1 + args.slowdown):
+                result['problems'].append("slower ({:.2f}ms, expected {:.2f}ms)".format(
+                    render_ms, result['expected_ms']))
+
+        results.append(result)
+        if result['problems']:
+            failures.append(result)
+
+    if args.update or args.update_timings:
+        write_json(os.path.join(args.corpus, 'timings.json'), timings)
+
+    write_json(os.path.join(args.output, 'results.json'), {
+        'meta': {
+            'time': datetime.utcnow().isoformat(),
+            'corpus': args.corpus,
+            'min_similarity': args.min_similarity,
+            'max_visible': args.max_visible,
+            'slowdown': args.slowdown,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    })
+
+    for result in failures:
+        sys.stderr.write("FAIL {}: {}\n".format(result['name'], '; '.join(result['problems'])))
+    sys.stderr.write("{} of {} renders passed, results in {}\n".format(
+        len(results) - len(failures), len(results), os.path.join(args.output, 'results.json')))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+A pool of worker processes for CPU-bound rendering.
+
+OpenCV calls made in the server's own process have to share the GIL with
+every request thread, so a burst of pictures (a whole class sending selfies
+at once) ends up rendering one at a time.  `RenderPool` runs render functions
+in separate processes instead.
+
+Images (numpy arrays) aren't pickled to get to and from the workers, wherever
+they are in a job's arguments or result.  They're copied into files in shared
+memory (/dev/shm) that both processes map, and changes a worker makes to an
+argument's image in place are copied back afterwards:
+
+    pool = RenderPool(processes=4)
+    pool.apply(transform_image, (image, transform_info, face_features))
+    encoded = pool.apply(encode_image, (image,))
+
+Functions have to be module-level functions (workers look them up by name),
+and the pool should be created before the process starts any threads, since
+the workers are forked from it.
+
+A job that takes longer than `timeout` seconds raises `RenderTimeout`, and the
+workers are replaced with new ones so a stuck worker can't hold up every
+later job.  Other jobs the old workers were running also raise
+`RenderTimeout`.
+"""
+import cPickle
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+
+import numpy
+
+SHARED_MEMORY_DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+class RenderTimeout(Exception):
+    """Raised when a job doesn't finish in time, or its worker was replaced while it ran."""
+
+
+class RenderPool(object):
+    """
+    :param processes: Worker processes to start (defaults to the number of CPUs)
+    :param directory: Where the shared image buffers are created; should be a memory-backed
+        file system like /dev/shm
+    :param timeout: Seconds a job can take before its workers are replaced (None to wait forever)
+    :param initializer: Called in each worker process as it starts (including replacements), e.g.
+        to reset logging handlers inherited from the parent
+    """
+    def __init__(self, processes=None, directory=SHARED_MEMORY_DIRECTORY, timeout=None, initializer=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.directory = directory
+        self.timeout = timeout
+        self.initializer = initializer
+        self.pool = multiprocessing.Pool(self.processes, initializer)
+        self.recycled = 0
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+
+    def apply(self, function, args=()):
+        """Run function(*args) in a worker process, wait for it and return what it returned."""
+        shared = _SharedArrays(self.directory)
+        try:
+            job = shared.dumps((function, args))
+            with self.pending_lock:
+                self.pending += 1
+            submitted_at = time.time()
+            try:
+                result, running = self._wait(self.pool, function.__name__, job, submitted_at)
+            finally:
+                with self.pending_lock:
+                    self.pending -= 1
+            self.job_finished(function.__name__, time.time() - submitted_at - running, running)
+            shared.copy_back()
+            return shared.loads(result, copy=True)
+        finally:
+            shared.remove()
+
+    def close(self):
+        """Stop the worker processes once they've finished their jobs."""
+        self.pool.close()
+        self.pool.join()
+
+    def _wait(self, pool, name, job, submitted_at):
+        pending_job = pool.apply_async(_run_job, (job, self.directory))
+        while True:
+            waited = time.time() - submitted_at
+            if self.timeout is not None and waited >= self.timeout:
+                self._recycle(pool)
+                raise RenderTimeout("{} took more than {}s".format(name, self.timeout))
+            # Wake up now and then to check whether the workers were replaced by another job
+            pending_job.wait(1.0 if self.timeout is None else min(1.0, self.timeout - waited))
+            if pending_job.ready():
+                return pending_job.get()
+            if pool is not self.pool:
+                raise RenderTimeout("the workers running {} were replaced".format(name))
+
+    def _recycle(self, pool):
+        # Replace the workers (unless another job already has), then kill the old ones
+        with self.pending_lock:
+            if pool is not self.pool:
+                return
+            self.pool = multiprocessing.Pool(self.processes, self.initializer)
+            self.recycled += 1
+        pool.terminate()
+
+    def job_finished(self, name, queued, running):
+        """
+        Called after every job a worker finishes; override it to record metrics.
+
+        :param name: The name of the function the job ran
+        :param queued: Seconds the job waited for a free worker (plus the time spent handing it over)
+        :param running: Seconds the worker spent running it
+        """
+
+
+def _run_job(job, directory):
+    # Runs in the worker process
+    start_time = time.time()
+    shared = _SharedArrays(directory)
+    function, args = shared.loads(job)
+    result = shared.dumps(function(*args))
+    return result, time.time() - start_time
+
+
+class _SharedArrays(object):
+    """Swaps numpy arrays for shared memory files while pickling, and back again while unpickling."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.arrays = {}
+        self.ids = {}
+        self.created = []
+        self.copy = False
+
+    def dumps(self, obj):
+        output = StringIO()
+        pickler = cPickle.Pickler(output, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self._persistent_id
+        pickler.dump(obj)
+        return output.getvalue()
+
+    def loads(self, data, copy=False):
+        """
+        :param copy: Copy arrays out of shared memory files this object didn't make, so the
+            files can be removed
+        """
+        self.copy = copy
+        unpickler = cPickle.Unpickler(StringIO(data))
+        unpickler.persistent_load = self._persistent_load
+        return unpickler.load()
+
+    def copy_back(self):
+        """Copy any changes made to the shared arrays back into the arrays they were made from."""
+        for path, dtype, shape in self.ids.values():
+            array = self.arrays[path]
+            if array.flags.writeable:
+                array[...] = numpy.memmap(path, numpy.dtype(dtype), 'r', shape=shape)
+
+    def remove(self):
+        for path in self.created:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _persistent_id(self, obj):
+        if not isinstance(obj, numpy.ndarray) or obj.size == 0 or obj.dtype.hasobject:
+            return None
+        if id(obj) not in self.ids:
+            descriptor, path = tempfile.mkstemp(prefix='render-', dir=self.directory)
+            os.close(descriptor)
+            self.created.append(path)
+            shared = numpy.memmap(path, obj.dtype, 'w+', shape=obj.shape)
+            shared[...] = obj
+            del shared
+            self.ids[id(obj)] = (path, obj.dtype.str, obj.shape)
+            self.arrays[path] = obj
+        return self.ids[id(obj)]
+
+    def _persistent_load(self, persistent_id):
+        path, dtype, shape = persistent_id
+        if path not in self.arrays:
+            array = numpy.memmap(path, numpy.dtype(dtype), 'r+', shape=shape)
+            if self.copy:
+                array = numpy.array(array)
+                self.created.append(path)
+            else:
+                # Pickling the array again (e.g. it's returned) should refer to the same file
+                self.ids[id(array)] = persistent_id
+            self.arrays[path] = array
+        return self.arrays[path]
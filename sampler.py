@@ -0,0 +1,79 @@
+"""
+A sampling profiler that can be turned on in a running process.
+
+While it runs, a background thread looks at what every other thread is
+doing (their Python stacks) every `interval` seconds and counts how often
+each stack comes up.  Looking costs about the same however busy the
+threads are, so it's cheap enough to run on a production server for a
+while.  The counts come out in the collapsed stack format flamegraph tools
+(flamegraph.pl, speedscope, ...) read, one stack per line with its count:
+
+    profile = Sampler(interval=0.01, tag=lambda thread_id: routes.get(thread_id))
+    stacks = profile.run(seconds=10)
+    print profile.collapsed(stacks)
+    # get_transformed_picture;server.py:get_transformed_picture;server.py:render;... 42
+
+Each stack starts with the thread's tag (for example the route the thread
+is handling), so the time spent on each route can be told apart.  Threads
+`tag` returns None for are left out.
+
+Only real threads are sampled, so it doesn't work under gevent: every
+greenlet shares one thread, and the stack of whichever greenlet happens to
+be running can't be told apart from the others (or tagged, since
+greenlets' idents aren't thread idents).
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class Sampler(object):
+    """
+    :param interval: Seconds between samples
+    :param tag: Returns the tag for a thread (given its ident), or None to leave it out
+    :param max_depth: Most frames of each stack kept (the innermost ones are dropped)
+    """
+    def __init__(self, interval=0.01, tag=lambda thread_id: 'thread', max_depth=100):
+        self.interval = interval
+        self.tag = tag
+        self.max_depth = max_depth
+        self.samples = 0
+
+    def run(self, seconds):
+        """Sample the other threads for a number of seconds and return a Counter of their stacks."""
+        stacks = Counter()
+        ignored = {threading.current_thread().ident}
+        labels = {}
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in ignored:
+                    continue
+                tag = self.tag(thread_id)
+                if tag is None:
+                    continue
+                stacks[(tag,) + self._stack(frame, labels)] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        return stacks
+
+    def collapsed(self, stacks):
+        """Format stacks in the collapsed format, most common first."""
+        return "".join("{} {}\n".format(";".join(stack), count) for stack, count in stacks.most_common())
+
+    def _stack(self, frame, labels):
+        # The names of the functions on the stack, outermost first
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                # Semicolons separate the frames, and spaces the count
+                label = labels[code] = "{}:{}".format(
+                    os.path.basename(code.co_filename), code.co_name).replace(';', ':').replace(' ', '_')
+            stack.append(label)
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack[:self.max_depth])
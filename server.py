@@ -1,47 +1,111 @@
 import os
 import json
+import math
 import random
 import urllib2
-import uuid
-import cgi
-from datetime import datetime
-from urlparse import urlparse
-import mimetypes
+import hmac
+import hashlib
+from functools import wraps
+from cStringIO import StringIO
 import logging
 import logging.handlers
+import Queue
+import atexit
+import time
+import threading
+import tempfile
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from concurrent import futures
 
-from twilio.rest import TwilioRestClient
 from flask import Flask, request, make_response, redirect
 import dateutil.parser
 import cv2
-import boto3
+import numpy
 import facepp
-
-TWILIO_ACCOUNT_SID = os.environ['TWILIO_ACCOUNT_SID']
-TWILIO_AUTH_TOKEN = os.environ['TWILIO_AUTH_TOKEN']
-FACEPP_API_KEY = os.environ['FACEPP_API_KEY']
-FACEPP_API_SECRET = os.environ['FACEPP_API_SECRET']
-AWS_ACCESS_KEY_ID = os.environ['AWS_ACCESS_KEY_ID']
-AWS_SECRET_ACCESS_KEY = os.environ['AWS_SECRET_ACCESS_KEY']
+import metrics
+import tracing
+import logqueue
+import twiliohistory
+import renderpool
+import admission
+import journal
+import mediacache
+import jpegheader
+import sampler
+
+# Credentials (TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, FACEPP_API_KEY, FACEPP_API_SECRET,
+# AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY) are only read from the environment when
+# the client that needs them is first used, so importing this module stays fast.
+TWILIO_BASE_URL = os.environ.get('TWILIO_BASE_URL', "https://api.twilio.com")
+TWILIO_PHONE_NUMBER = os.environ.get('TWILIO_PHONE_NUMBER', "+12407536527")
+FACEPP_SERVER = os.environ.get('FACEPP_SERVER', "http://api.us.faceplusplus.com/")
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+S3_BUCKET = os.environ.get('S3_BUCKET', "sms-playground")
+S3_PUBLIC_URL = os.environ.get('S3_PUBLIC_URL', "https://s3.amazonaws.com/{}".format(S3_BUCKET))
+PORT = int(os.environ.get('PORT', 5000))
 LOG_PATH = os.environ.get('LOG_PATH', "server.log")
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+PICTURE_MAX_BYTES = int(os.environ.get('PICTURE_MAX_BYTES', 600 * 1024))
+PICTURE_FORMAT = os.environ.get('PICTURE_FORMAT', 'jpeg')
+TRACE_BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER_SIZE', 10000))
+DEBUG_TOKEN = os.environ.get('DEBUG_TOKEN')
+# How often images/ is checked for accessories that were added, changed or removed
+CATALOG_RELOAD_SECONDS = float(os.environ.get('CATALOG_RELOAD_SECONDS', 2))
+# Longest a profile from /debug/profile can run for
+MAX_PROFILE_SECONDS = float(os.environ.get('MAX_PROFILE_SECONDS', 60))
+# Messages asked for in each request when polling Twilio for replies
+TWILIO_PAGE_SIZE = int(os.environ.get('TWILIO_PAGE_SIZE', 20))
+# Most requests for pages of messages each poll of Twilio makes
+TWILIO_MAX_PAGES = int(os.environ.get('TWILIO_MAX_PAGES', 5))
+# How long a request for a transformed picture can spend waiting on Face++, including retries
+PICTURE_REQUEST_BUDGET = float(os.environ.get('PICTURE_REQUEST_BUDGET', 20))
+# Longest side (in pixels) pictures are rendered at, and the copy uploaded to Face++ is sent at.
+# Face++ shrinks anything bigger than 600 pixels itself, so sending more is wasted bandwidth.
+RENDER_MAX_DIMENSION = int(os.environ.get('RENDER_MAX_DIMENSION', 640))
+DETECTION_MAX_DIMENSION = int(os.environ.get('DETECTION_MAX_DIMENSION', 600))
+# Worker processes that render pictures, so rendering doesn't compete for the GIL with the
+# request threads (0 renders on the request threads)
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 0))
+# Seconds a render worker can spend on one job before the workers are replaced
+RENDER_TIMEOUT_SECONDS = float(os.environ.get('RENDER_TIMEOUT_SECONDS', 30))
+# Most accessory combinations a program can ask for in one request for picture variants
+MAX_PICTURE_VARIANTS = int(os.environ.get('MAX_PICTURE_VARIANTS', 16))
+# Polls for replies each phone number and each program (keyword) can make a second, and how many
+# can be made in a burst.  Programs polling faster than that are told to wait instead of Twilio
+# being asked again.
+POLL_RATE_PER_PHONE = float(os.environ.get('POLL_RATE_PER_PHONE', 1))
+POLL_RATE_PER_PROGRAM = float(os.environ.get('POLL_RATE_PER_PROGRAM', 5))
+POLL_BURST = int(os.environ.get('POLL_BURST', 5))
+# Picture requests (downloading, detecting and rendering) handled at once.  More are turned away
+# with a 503 saying how long to wait.
+MAX_RENDER_QUEUE = int(os.environ.get('MAX_RENDER_QUEUE', 32))
+# How long programs are told to wait before polling again, which goes from MIN_WAIT_SECONDS up to
+# MAX_WAIT_SECONDS as the render queue fills up or Twilio slows down (to TWILIO_SLOW_SECONDS)
+MIN_WAIT_SECONDS = float(os.environ.get('MIN_WAIT_SECONDS', 1))
+MAX_WAIT_SECONDS = float(os.environ.get('MAX_WAIT_SECONDS', 30))
+TWILIO_SLOW_SECONDS = float(os.environ.get('TWILIO_SLOW_SECONDS', 5))
+# Where conversations, pictures and handled messages are journaled, so they're still there after
+# a restart.  It's replayed every time the server starts, so give each deployment (or load test
+# run) its own, or set it to an empty string to only keep them in memory.
+STATE_JOURNAL_PATH = os.environ.get('STATE_JOURNAL_PATH', os.path.join("data", "state.jsonl"))
+# Pictures kids send are downloaded into the media cache (in the background, by
+# MEDIA_PREFETCH_THREADS threads) as soon as they arrive, so rendering them doesn't wait on the
+# download.  The least recently used are removed once there's more than MEDIA_CACHE_MAX_BYTES.
+# Set MEDIA_CACHE_PATH to an empty string to download pictures when they're rendered instead.
+MEDIA_CACHE_PATH = os.environ.get('MEDIA_CACHE_PATH', os.path.join("data", "media-cache"))
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+MEDIA_PREFETCH_THREADS = int(os.environ.get('MEDIA_PREFETCH_THREADS', 4))
 
 logger = logging.getLogger('sms-playground')
 logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)-15s %(levelname)-8s %(message)s')
-fileHandler = logging.handlers.RotatingFileHandler(LOG_PATH, maxBytes=10*1024*1024, backupCount=5)
-fileHandler.setLevel(logging.DEBUG)
-fileHandler.setFormatter(formatter)
-logger.addHandler(fileHandler)
-streamHandler = logging.StreamHandler()
-streamHandler.setLevel(logging.DEBUG)
-streamHandler.setFormatter(formatter)
-logger.addHandler(streamHandler)
-
-logger.info("Started server.")
-
-twilio = TwilioRestClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-facepp_api = facepp.API(FACEPP_API_KEY, FACEPP_API_SECRET, 'http://api.us.faceplusplus.com/')
-app = Flask(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Log records get put on a bounded queue and written to the log file and console by a
+# background thread, so slow disks never hold up a request.  If the queue fills up,
+# records get dropped (and counted) instead.
+queueHandler = logqueue.QueueHandler(Queue.Queue(maxsize=LOG_QUEUE_SIZE))
 
 # Keeps track of which text messages we've already handled
 # and shouldn't get processed again
@@ -52,6 +116,326 @@ conversation_to_phone_number = {}
 pictures = {}
 
 
+#-----------------------------------------------------------------------------
+# Metrics (scraped by Prometheus from the /metrics endpoint)
+#-----------------------------------------------------------------------------
+dependency_seconds = metrics.Histogram(
+    'sms_playground_dependency_seconds', "Time spent calling Twilio, Face++, S3 and downloading images.",
+    ['dependency'])
+dependency_calls = metrics.Counter(
+    'sms_playground_dependency_calls_total', "Calls made to Twilio, Face++, S3 and image hosts.",
+    ['dependency', 'outcome'])
+render_seconds = metrics.Histogram(
+    'sms_playground_render_seconds', "Time spent compositing and encoding pictures.", ['stage'])
+detection_upload_bytes = metrics.Histogram(
+    'sms_playground_detection_upload_bytes', "Size of the pictures uploaded to Face++ for detection.",
+    buckets=[16 * 1024, 32 * 1024, 64 * 1024, 128 * 1024, 256 * 1024, 512 * 1024, 1024 * 1024])
+render_queue_depth = metrics.Gauge(
+    'sms_playground_render_queue_depth', "Render jobs waiting for a worker or being rendered.")
+render_job_seconds = metrics.Histogram(
+    'sms_playground_render_job_seconds', "Time each render job took, including waiting for a worker.",
+    ['function'])
+render_worker_seconds = metrics.Histogram(
+    'sms_playground_render_worker_seconds', "Time render jobs spent queued for and running in worker processes.",
+    ['function', 'phase'])
+metrics.Gauge('sms_playground_handled_messages', "Number of messages already handled.",
+              lambda: len(handled_messages))
+metrics.Gauge('sms_playground_conversations', "Number of conversations started.",
+              lambda: len(conversation_to_phone_number))
+metrics.Gauge('sms_playground_pictures', "Number of pictures received.",
+              lambda: len(pictures))
+metrics.Gauge('sms_playground_media_cache_bytes', "Size of the pictures in the media cache.",
+              lambda: media_cache_stat('total_bytes'))
+metrics.Gauge('sms_playground_media_cache_hits', "Pictures found in the media cache when they were rendered.",
+              lambda: media_cache_stat('hits'))
+metrics.Gauge('sms_playground_media_cache_misses', "Pictures not in the media cache when they were rendered.",
+              lambda: media_cache_stat('misses'))
+metrics.Gauge('sms_playground_media_cache_deduplicated', "Pictures that were already in the media cache when stored.",
+              lambda: media_cache_stat('deduplicated'))
+metrics.Gauge('sms_playground_log_records_dropped', "Log records dropped because the log queue was full.",
+              lambda: queueHandler.dropped)
+
+
+@contextmanager
+def track_dependency(dependency):
+    """Record how long the call to a dependency inside the `with` statement takes and if it failed."""
+    start_time = time.time()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'success'
+    finally:
+        dependency_seconds.observe(time.time() - start_time, dependency)
+        dependency_calls.inc(dependency, outcome)
+
+
+class FaceppAPI(facepp.API):
+    """Face++ client that records metrics for every request it makes."""
+    def request_finished(self, name, elapsed, error):
+        dependency = 'facepp_{}'.format(name.replace('/', '_'))
+        dependency_seconds.observe(elapsed, dependency)
+        dependency_calls.inc(dependency, 'success' if error is None else 'error')
+
+    def request_retried(self, name, attempt, error):
+        dependency_retries.inc('facepp_{}'.format(name.replace('/', '_')))
+
+
+class TwilioHistory(twiliohistory.MessageHistory):
+    """Twilio message history that records metrics for every request it makes."""
+    def request_finished(self, name, elapsed, error):
+        dependency = 'twilio_{}'.format(name)
+        dependency_seconds.observe(elapsed, dependency)
+        dependency_calls.inc(dependency, 'success' if error is None else 'error')
+        if name == 'messages_list':
+            twilio_latency.add(elapsed)
+
+
+class RenderWorkers(renderpool.RenderPool):
+    """Render worker processes that record metrics for every job they run."""
+    def job_finished(self, name, queued, running):
+        render_worker_seconds.observe(queued, name, 'queued')
+        render_worker_seconds.observe(running, name, 'running')
+
+
+# Stops calling Face++ for a while when it keeps failing, so requests fail fast
+# instead of piling up behind retries
+facepp_circuit_breaker = facepp.CircuitBreaker()
+
+dependency_retries = metrics.Counter(
+    'sms_playground_dependency_retries_total', "Calls to dependencies that were retried.", ['dependency'])
+metrics.Gauge('sms_playground_facepp_circuit_state', "Face++ circuit breaker state (0 closed, 1 half-open, 2 open).",
+              lambda: [facepp.CircuitBreaker.CLOSED, facepp.CircuitBreaker.HALF_OPEN,
+                       facepp.CircuitBreaker.OPEN].index(facepp_circuit_breaker.state))
+metrics.Gauge('sms_playground_facepp_circuit_rejected', "Face++ calls failed fast because the circuit was open.",
+              lambda: facepp_circuit_breaker.rejected)
+
+
+# Timings for each phase of handling a conversation's messages and pictures,
+# viewable from the /debug/traces endpoint
+tracer = tracing.Tracer(max_spans=TRACE_BUFFER_SIZE)
+
+#-----------------------------------------------------------------------------
+# Admission control (see admission.py)
+#-----------------------------------------------------------------------------
+
+phone_polls = admission.RateLimiter(POLL_RATE_PER_PHONE, POLL_BURST)
+program_polls = admission.RateLimiter(POLL_RATE_PER_PROGRAM, POLL_BURST)
+picture_requests = admission.Limit(MAX_RENDER_QUEUE, lambda: wait_hint())
+# How long polling Twilio for messages has been taking
+twilio_latency = admission.MovingAverage()
+
+
+def wait_hint():
+    # Seconds to tell programs to wait before trying again, longer the busier the server is
+    load = max(picture_requests.load, twilio_latency.value / TWILIO_SLOW_SECONDS)
+    return round(admission.backoff(MIN_WAIT_SECONDS, MAX_WAIT_SECONDS, load), 1)
+
+
+requests_shed = metrics.Counter(
+    'sms_playground_requests_shed_total', "Requests told to wait instead of being handled.", ['reason'])
+metrics.Gauge('sms_playground_picture_requests', "Picture requests being handled.",
+              lambda: picture_requests.in_progress)
+metrics.Gauge('sms_playground_wait_hint_seconds', "How long programs are being told to wait between polls.",
+              lambda: wait_hint())
+
+
+# Runs CPU-bound rendering (decoding, compositing and encoding pictures).  Rendering happens on
+# the request's own thread (or in the RENDER_WORKERS processes) unless a serving mode that
+# mustn't block on the CPU (like async_server.py) sets this to a pool with a
+# multiprocessing-style apply(function, args).
+render_pool = None
+
+app = Flask(__name__)
+
+
+#-----------------------------------------------------------------------------
+# Dependencies (built the first time they're needed)
+#-----------------------------------------------------------------------------
+
+def lazy(function):
+    """Only build what the function returns once, the first time it's needed."""
+    lock = threading.Lock()
+    built = []
+
+    @wraps(function)
+    def get():
+        if not built:
+            with lock:
+                if not built:
+                    built.append(function())
+        return built[0]
+    get.is_built = lambda: bool(built)
+    return get
+
+
+def make_log_formatter():
+    if LOG_FORMAT == 'json':
+        return logqueue.JSONFormatter()
+    return logging.Formatter('%(asctime)-15s %(levelname)-8s %(message)s')
+
+
+@lazy
+def setup_logging():
+    formatter = make_log_formatter()
+    fileHandler = logging.handlers.RotatingFileHandler(LOG_PATH, maxBytes=10*1024*1024, backupCount=5)
+    fileHandler.setLevel(logging.DEBUG)
+    fileHandler.setFormatter(formatter)
+    streamHandler = logging.StreamHandler()
+    streamHandler.setLevel(logging.DEBUG)
+    streamHandler.setFormatter(formatter)
+    logger.addHandler(queueHandler)
+    logListener = logqueue.QueueListener(queueHandler.queue, fileHandler, streamHandler)
+    logListener.start()
+    atexit.register(logListener.stop)
+
+    logger.info("Started server.")
+    return logListener
+
+
+@lazy
+def get_twilio():
+    from twilio.rest import TwilioRestClient
+    return TwilioRestClient(os.environ['TWILIO_ACCOUNT_SID'], os.environ['TWILIO_AUTH_TOKEN'], base=TWILIO_BASE_URL)
+
+
+# Polls Twilio for only the messages it hasn't seen yet, and remembers the media of each message
+message_history = TwilioHistory(get_twilio, page_size=TWILIO_PAGE_SIZE, max_pages=TWILIO_MAX_PAGES)
+
+
+@lazy
+def get_facepp_api():
+    return FaceppAPI(os.environ['FACEPP_API_KEY'], os.environ['FACEPP_API_SECRET'], FACEPP_SERVER,
+                     circuit_breaker=facepp_circuit_breaker)
+
+
+def setup_render_worker_logging():
+    # Runs in each render worker as it starts.  Workers forked after logging was set up inherit
+    # the queue handler, but nothing takes records off their copy of the queue, so they log
+    # straight to stderr instead (the file handler belongs to the server process).
+    for handler in list(logger.handlers):
+        if handler is queueHandler:
+            logger.removeHandler(handler)
+    streamHandler = logging.StreamHandler()
+    streamHandler.setLevel(logging.DEBUG)
+    streamHandler.setFormatter(make_log_formatter())
+    logger.addHandler(streamHandler)
+
+
+@lazy
+def get_render_workers():
+    # Forks the worker processes, so it's best called before any threads are started.  The
+    # accessories are loaded first so every worker starts out with them.
+    if RENDER_WORKERS:
+        preload_accessories()
+        return RenderWorkers(RENDER_WORKERS, timeout=RENDER_TIMEOUT_SECONDS,
+                             initializer=setup_render_worker_logging)
+    return None
+
+
+@lazy
+def get_s3():
+    # Unlike resources, boto3 clients can be shared between threads
+    import boto3
+    from botocore.client import Config
+    config = None
+    if S3_ENDPOINT_URL:
+        # Otherwise botocore puts DNS-compatible bucket names in the host name
+        # (sms-playground.s3.amazonaws.com) and the endpoint is ignored
+        config = Config(s3={'addressing_style': 'path'})
+    return boto3.client('s3', verify=False, endpoint_url=S3_ENDPOINT_URL, config=config,
+                        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
+
+
+@lazy
+def get_media_cache():
+    if not MEDIA_CACHE_PATH:
+        return None
+    return mediacache.MediaCache(MEDIA_CACHE_PATH, MEDIA_CACHE_MAX_BYTES)
+
+
+def media_cache_stat(name):
+    # For the metrics, which shouldn't create the cache (and its directory) just to report on it
+    if not get_media_cache.is_built() or get_media_cache() is None:
+        return None
+    return getattr(get_media_cache(), name)
+
+
+@lazy
+def get_media_prefetcher():
+    return futures.ThreadPoolExecutor(MEDIA_PREFETCH_THREADS)
+
+
+@lazy
+def get_state_journal():
+    # Rebuilds the conversations, pictures and handled messages from before the last restart
+    if not STATE_JOURNAL_PATH:
+        return None
+    directory = os.path.dirname(STATE_JOURNAL_PATH)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    state_journal = journal.Journal(STATE_JOURNAL_PATH, snapshot_state)
+    start_time = time.time()
+    replayed = 0
+    for record in state_journal.replay():
+        apply_state_change(record)
+        replayed += 1
+    state_journal.compact()
+    logger.info("Replayed %d state changes from %s in %.3fs (%d unreadable)",
+                replayed, STATE_JOURNAL_PATH, time.time() - start_time, state_journal.skipped)
+    return state_journal
+
+
+# Start logging to the log file and load the state from before the last restart before the
+# first request when running under a WSGI server (running server.py directly does it right away)
+app.before_first_request(setup_logging)
+app.before_first_request(get_state_journal)
+
+
+#-----------------------------------------------------------------------------
+# State (kept in memory, and journaled so it survives restarts)
+#-----------------------------------------------------------------------------
+
+def record_state_change(change_type, **change):
+    # Apply a change to the state and add it to the journal
+    change['type'] = change_type
+    apply_state_change(change)
+    state_journal = get_state_journal()
+    if state_journal is not None:
+        state_journal.append(change)
+
+
+def apply_state_change(change):
+    # Applying the same change twice has to be the same as applying it once (see journal.py)
+    if change['type'] == 'conversation':
+        conversation_to_phone_number[change['code']] = change['phone']
+    elif change['type'] == 'claimed':
+        handled_messages.add(change['sid'])
+    elif change['type'] == 'picture':
+        pictures[change['code']] = change['picture']
+    elif change['type'] == 'accessory':
+        if change['picture'] in pictures:
+            pictures[change['picture']][change['area']] = change['name']
+    elif change['type'] == 'media':
+        if change['picture'] in pictures:
+            pictures[change['picture']]['media_key'] = change['key']
+    elif change['type'] == 'snapshot':
+        conversation_to_phone_number.update(change['conversations'])
+        handled_messages.update(change['handled_messages'])
+        pictures.update(change['pictures'])
+
+
+def snapshot_state():
+    # A change that rebuilds the whole current state.  Copies are taken first, since requests
+    # can change the state while the journal is being compacted.
+    return {
+        'type': 'snapshot',
+        'conversations': dict(conversation_to_phone_number),
+        'handled_messages': list(handled_messages),
+        'pictures': dict((code, dict(picture)) for code, picture in pictures.items()),
+    }
+
+
 #-----------------------------------------------------------------------------
 # Configure how different stuff gets added to a face
 #-----------------------------------------------------------------------------
@@ -97,6 +481,11 @@ glasses_options = {
     },
 }
 
+# Options for accessories in images/ that aren't listed above
+DEFAULT_ACCESSORY_OPTIONS = {
+    'width_multi': 2,
+}
+
 #-----------------------------------------------------------------------------
 # API Endpoints
 #-----------------------------------------------------------------------------
@@ -114,6 +503,27 @@ def kidmuseum_py():
     return response
 
 
+@app.route("/catalog", methods=['GET'])
+def get_catalog():
+    """
+    The moustaches and glasses that can be added to pictures, with their options, so programs
+    can check names before asking for them.  It only changes when accessories are added, changed
+    or removed, so clients can send its ETag back in If-None-Match to check whether it has.
+    """
+    catalog = {
+        'moustaches': dict((name, accessory_catalog.options('moustache', name))
+                           for name in accessory_catalog.names('moustache')),
+        'glasses': dict((name, accessory_catalog.options('glasses', name))
+                        for name in accessory_catalog.names('glasses')),
+    }
+    body = json.dumps(catalog, sort_keys=True)
+    response = make_response(body)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    return response.make_conditional(request)
+
+
 @app.route("/conversation/start", methods=['POST'])
 def start_a_conversation():
     response = None
@@ -122,38 +532,46 @@ def start_a_conversation():
     keyword = request_data['keyword']
     oldest_message_time = dateutil.parser.parse(request_data['messages_must_be_older_than'])
 
+    # Programs (or lots of copies of the same program) polling too fast get told to slow down
+    wait_for_seconds = program_polls.wait_time(keyword.strip().lower())
+    if wait_for_seconds:
+        requests_shed.inc('program_rate')
+        return wait_response(wait_for_seconds)
+
     # Check if any users have sent a text to the server with the keyword used to start the conversation,
     # making sure the message wasn't already handled earlier and isn't from a long time ago
-    for message in twilio.messages.list(date_sent=datetime.utcnow().date()):
+    with tracer.span('poll', keyword=keyword):
+        messages = message_history.recent(since=oldest_message_time)
+    for message in messages:
         if message.sid not in handled_messages and message.date_created >= oldest_message_time:
 
             # If this message doesn't match our keyword, try the next message
             if message.body.strip().lower() != keyword.strip().lower():
                 continue
 
-            # Remember this message so we won't process it a second time later
-            handled_messages.add(message.sid)
-
             # Create a new special code for the conversation
             conversation_code = make_unique_id()
 
+            # Remember this message so we won't process it a second time later
+            claim_message(message, conversation_code)
+
             # Link the new special code to this phone number so any future messages
             # from this phone number will be associated with this conversation.
-            conversation_to_phone_number[conversation_code] = message.from_
+            record_state_change('conversation', code=conversation_code, phone=message.from_)
 
             # Tell the program to use the special conversation code when it wants
             # to send this user any text messages and get replies
             response = {'conversation_code': conversation_code}
 
-            logger.info("Created conversation for {} via keyword {} ({})".format(
-                conversation_to_phone_number[conversation_code], keyword, conversation_code))
+            logger.info("Created conversation for %s via keyword %s (%s)",
+                        conversation_to_phone_number[conversation_code], keyword, conversation_code)
 
             break
 
     # if we didn't find any messages that are starting a conversation,
     # tell the program to wait a little bit and check again
     if response is None:
-        response = {'wait_for_seconds': 1}
+        return wait_response()
 
     return json.dumps(response), 200, {'Content-Type': 'application/json'}
 
@@ -183,17 +601,27 @@ def get_response_message(conversation_code, expected_response_type):
     # and hasn't already been handled earlier
     if conversation_code in conversation_to_phone_number:
         users_phone_number = conversation_to_phone_number[conversation_code]
-        for message in twilio.messages.list(from_=users_phone_number):
+        wait_for_seconds = phone_polls.wait_time(users_phone_number)
+        if wait_for_seconds:
+            requests_shed.inc('phone_rate')
+            return wait_response(wait_for_seconds)
+        with tracer.span('poll', conversation_code):
+            messages = message_history.recent(users_phone_number, since=oldest_message_time)
+        for message in messages:
             if message.sid not in handled_messages and message.date_created >= oldest_message_time:
 
-                logger.info("Received {} message from {}: {}{} ({})".format(
-                    expected_response_type, users_phone_number, "'{}'".format(message.body),
-                    "|{}".format(message.media_list.list()[0].uri) if expected_response_type == "picture" and int(message.num_media) > 0 else "",
+                media_url = None
+                if expected_response_type == "picture" and int(message.num_media) > 0:
+                    media_url = message_history.media(message)[0].uri
+
+                logger.info("Received %s message from %s: '%s'%s (%s)",
+                    expected_response_type, users_phone_number, message.body,
+                    "|{}".format(media_url) if media_url else "",
                     conversation_code
-                ))
+                )
 
                 # Remember this message so we won't process it a second time later
-                handled_messages.add(message.sid)
+                claim_message(message, conversation_code)
 
                 # Make sure the message sent from the user matches what the program
                 # was expecting (e.g. a number or a picture). If it's not, ask the
@@ -221,23 +649,24 @@ def get_response_message(conversation_code, expected_response_type):
                         _send_message(conversation_code, "Numbers only, please. Try again.")
 
                 elif expected_response_type == "picture":
-                    if int(message.num_media) > 0:
+                    if media_url:
                         picture_code = make_unique_id()
-                        pictures[picture_code] = {
-                            'url': message.media_list.list()[0].uri,
+                        record_state_change('picture', code=picture_code, picture={
+                            'url': media_url,
                             'moustache': None,
                             'glasses': None,
                             'lefteye': None,
                             'righteye': None,
                             'leftcheek': None,
                             'rightcheeck': None,
-                        }
+                        })
                         response = {
                             'picture_code': picture_code,
                         }
+                        prefetch_picture(conversation_code, picture_code)
 
-                        logger.info("Created picture for {} ({}) ({})".format(
-                            conversation_to_phone_number[conversation_code], conversation_code, picture_code))
+                        logger.info("Created picture for %s (%s) (%s)",
+                                    conversation_to_phone_number[conversation_code], conversation_code, picture_code)
                     else:
                         _send_message(conversation_code, "Please reply with a picture.")
 
@@ -246,7 +675,7 @@ def get_response_message(conversation_code, expected_response_type):
     # If the user didn't reply to our last message yet,
     # tell the program to wait a little bit and check again
     if response is None:
-        response = {'wait_for_seconds': 1}
+        return wait_response()
 
     return json.dumps(response), 200, {'Content-Type': 'application/json'}
 
@@ -254,22 +683,24 @@ def get_response_message(conversation_code, expected_response_type):
 @app.route("/conversation/<conversation_code>/picture/<picture_code>/<area>", methods=['POST'])
 def add_to_picture(conversation_code, picture_code, area):
     request_data = request.get_json()
+    if picture_code not in pictures:
+        return "No picture found with specified code", 404
 
     if area == "moustache":
         moustache_name = request_data['moustache_name']
-        if not os.path.exists(get_moustache_path(moustache_name)):
+        if not accessory_catalog.exists('moustache', moustache_name):
             return "There isn't a moustache with the name {}".format(moustache_name), 404
-        pictures[picture_code][area] = moustache_name
-        logger.info("Added {} to {} ({}) ({})".format(
-            request_data['moustache_name'], area, conversation_code, picture_code))
+        record_state_change('accessory', picture=picture_code, area=area, name=moustache_name)
+        logger.info("Added %s to %s (%s) (%s)",
+                    request_data['moustache_name'], area, conversation_code, picture_code)
 
     elif area == "glasses":
         glasses_name = request_data['glasses_name']
-        if not os.path.exists(get_glasses_path(glasses_name)):
+        if not accessory_catalog.exists('glasses', glasses_name):
             return "There aren't glasses with the name {}".format(glasses_name), 404
-        pictures[picture_code][area] = glasses_name
-        logger.info("Added {} to {} ({}) ({})".format(
-            request_data['glasses_name'], area, conversation_code, picture_code))
+        record_state_change('accessory', picture=picture_code, area=area, name=glasses_name)
+        logger.info("Added %s to %s (%s) (%s)",
+                    request_data['glasses_name'], area, conversation_code, picture_code)
 
     else:
         return "Area {} is not supported".format(area), 404
@@ -279,40 +710,231 @@ def add_to_picture(conversation_code, picture_code, area):
 
 @app.route("/conversation/<conversation_code>/picture/<picture_code>/", methods=['GET'])
 def get_transformed_picture(conversation_code, picture_code):
-    # Download the picture
-    original_image_path = None
-    transformed_image_path = None
-    url = pictures[picture_code]['url']
-    try:
-        image, original_image_path = get_image(url)
-        face_features = DetectedFace(facepp.File(original_image_path), image)
-        _send_message(conversation_code, "...one sec...")
-    finally:
-        if original_image_path and os.path.exists(original_image_path):
-            os.remove(original_image_path)
+    with picture_requests.admit():
+        image, face_features = get_picture_and_face(conversation_code, picture_code)
 
-    try:
         # Apply all the transforms queued up by earlier API calls (i.e. add_to_picture calls)
-        transform_image(image, pictures[picture_code], face_features)
+        with tracer.span('composite', conversation_code, picture_code), render_seconds.time('composite'):
+            render(transform_image, image, pictures[picture_code], face_features)
+
+        # Encode the transformed picture small enough for MMS
+        with tracer.span('encode', conversation_code, picture_code) as span, render_seconds.time('encode'):
+            encoded = render(encode_image, image)
+            span['bytes'] = len(encoded.data)
+
+        return json.dumps({'url': save_picture(encoded, conversation_code, picture_code)})
+
+
+@app.route("/conversation/<conversation_code>/picture/<picture_code>/variants", methods=['POST'])
+def get_picture_variants(conversation_code, picture_code):
+    """
+    Render the picture with several combinations of accessories at once, e.g.
+
+        {"variants": [{"moustache": "handlebar", "glasses": "shades"}, {"moustache": "walrus"}],
+         "contact_sheet": true}
+
+    and reply with the URL of each variant (in the same order), plus the URL of one picture
+    showing all of them if a contact sheet was asked for.  The picture is only downloaded
+    and sent to Face++ once, however many variants there are.  Accessories added with
+    add_to_picture calls aren't included.
+    """
+    request_data = request.get_json()
+    if picture_code not in pictures:
+        return "No picture found with specified code", 404
+
+    requested_variants = request_data.get('variants') if isinstance(request_data, dict) else None
+    if not isinstance(requested_variants, list):
+        return "Send a JSON object with a list of variants", 400
+
+    variants = []
+    for variant in requested_variants:
+        if not isinstance(variant, dict):
+            return "Each variant has to be a JSON object, like {\"moustache\": \"walrus\"}", 400
+        moustache_name = variant.get('moustache')
+        glasses_name = variant.get('glasses')
+        if not all(name is None or isinstance(name, basestring) for name in [moustache_name, glasses_name]):
+            return "Accessory names have to be strings", 400
+        if moustache_name and not accessory_catalog.exists('moustache', moustache_name):
+            return "There isn't a moustache with the name {}".format(moustache_name), 404
+        if glasses_name and not accessory_catalog.exists('glasses', glasses_name):
+            return "There aren't glasses with the name {}".format(glasses_name), 404
+        variants.append({'moustache': moustache_name, 'glasses': glasses_name})
+    if not 0 < len(variants) <= MAX_PICTURE_VARIANTS:
+        return "Ask for between 1 and {} variants".format(MAX_PICTURE_VARIANTS), 400
+
+    with picture_requests.admit():
+        image, face_features = get_picture_and_face(conversation_code, picture_code)
+
+        with tracer.span('render_variants', conversation_code, picture_code, variants=len(variants)) as span, \
+                render_seconds.time('variants'):
+            encoded_variants, encoded_contact_sheet = render(render_variants, image, variants, face_features,
+                                                             bool(request_data.get('contact_sheet')))
+            span['bytes'] = sum(len(encoded.data) for encoded in encoded_variants)
+
+        response = {'urls': [save_picture(encoded, conversation_code, picture_code) for encoded in encoded_variants]}
+        if encoded_contact_sheet is not None:
+            response['contact_sheet_url'] = save_picture(encoded_contact_sheet, conversation_code, picture_code)
+        return json.dumps(response), 200, {'Content-Type': 'application/json'}
+
+
+def get_picture_and_face(conversation_code, picture_code):
+    # Download the picture and find the face in it
+    deadline = time.time() + PICTURE_REQUEST_BUDGET
+    with tracer.span('download', conversation_code, picture_code):
+        image = load_image(get_picture_data(conversation_code, picture_code), pictures[picture_code]['url'])
+    with tracer.span('detect', conversation_code, picture_code) as span:
+        detection_file = make_detection_file(image)
+        span['bytes'] = len(detection_file.content)
+        face_features = DetectedFace(detection_file, image, budget=deadline - time.time())
+    _send_message(conversation_code, "...one sec...")
+    return image, face_features
+
+
+def wait_response(wait_for_seconds=0):
+    # Tell the program to wait a bit and check again, for longer when the server is busy
+    response = {'wait_for_seconds': max(round(wait_for_seconds, 1), wait_hint())}
+    return json.dumps(response), 200, {'Content-Type': 'application/json'}
+
+
+def save_picture(encoded, conversation_code, picture_code):
+    # Upload an encoded picture to S3 (file storage in the cloud) and return its URL
+    filename = '{}{}'.format(make_unique_id(), encoded.extension)
+    with tracer.span('upload', conversation_code, picture_code), track_dependency('s3_put'):
+        get_s3().put_object(Bucket=S3_BUCKET, Key=filename, Body=encoded.data, ACL='public-read',
+                            ContentType=encoded.content_type)
+
+    logger.info("Transformed picture and saved to %s (%d bytes, quality %d, scale %.2f, encoded in %.3fs) (%s) (%s)",
+                filename, len(encoded.data), encoded.quality, encoded.scale, encoded.seconds,
+                conversation_code, picture_code)
+
+    return '{}/{}'.format(S3_PUBLIC_URL, filename)
+
+
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.route("/warmup", methods=['GET'])
+def warmup():
+    """
+    Build the clients for every dependency, open connections to Face++ and load the accessories,
+    so the first real requests don't pay for it.  Load balancers should call this before routing
+    traffic here.
+    """
+    timings = {}
+    for name, step in [('logging', setup_logging), ('twilio', get_twilio), ('facepp', get_facepp_api),
+                       ('facepp_connections', lambda: get_facepp_api().transport.preconnect(FACEPP_SERVER)),
+                       ('s3', get_s3), ('render_workers', get_render_workers), ('media_cache', get_media_cache),
+                       ('accessories', preload_accessories)]:
+        start_time = time.time()
+        step()
+        timings[name] = time.time() - start_time
+    return json.dumps({'seconds': timings}), 200, {'Content-Type': 'application/json'}
+
+
+def requires_debug_token(function):
+    """
+    Only allow requests with the DEBUG_TOKEN in the X-Debug-Token header (or the token query argument).
+    Debug endpoints are turned off entirely when DEBUG_TOKEN isn't set.
+    """
+    @wraps(function)
+    def check_debug_token(*args, **kwargs):
+        token = request.headers.get('X-Debug-Token') or request.args.get('token') or ""
+        if not DEBUG_TOKEN or not hmac.compare_digest(str(token), DEBUG_TOKEN):
+            return "Not found", 404
+        return function(*args, **kwargs)
+    return check_debug_token
+
+
+@app.route("/debug/traces", methods=['GET'])
+@requires_debug_token
+def get_traces():
+    conversation_code = request.args.get('conversation_code')
+    picture_code = request.args.get('picture_code')
+
+    # JSON lines are easier to append together and analyze offline
+    if request.args.get('format') == 'jsonl':
+        output = StringIO()
+        tracer.dump(output, conversation_code, picture_code)
+        return output.getvalue(), 200, {'Content-Type': 'application/x-ndjson'}
+
+    spans = tracer.find(conversation_code, picture_code, limit=request.args.get('limit', type=int))
+    return json.dumps({'spans': spans}), 200, {'Content-Type': 'application/json'}
+
 
-        # Save the transformed picture and upload it to S3 (file storage in the cloud)
-        file_extension = get_file_extension_from_url(url)
-        file_extension = ".{}".format(file_extension) if file_extension else ""
-        filename = '{}{}'.format(make_unique_id(), file_extension)
-        transformed_image_path = 'images/{}'.format(filename)
-        cv2.imwrite(transformed_image_path, image)
-        s3file = boto3.resource('s3', verify=False).Object('sms-playground', filename)
-        s3file.put(Body=open(transformed_image_path, 'rb'), ACL='public-read',
-                   ContentType=mimetypes.guess_type(filename)[0])
+# Maps the ident of each thread handling a request to the request's route, so profiles can be
+# split up by route
+request_routes = {}
+# Only one profile runs at a time
+profile_lock = threading.Lock()
 
-        logger.info("Transformed picture and saved to {} ({}) ({})".format(
-            filename, conversation_code, picture_code))
 
+@app.before_request
+def remember_route():
+    request_routes[threading.current_thread().ident] = request.endpoint or 'unknown'
+
+
+@app.teardown_request
+def forget_route(exception):
+    request_routes.pop(threading.current_thread().ident, None)
+
+
+@app.route("/debug/profile", methods=['GET'])
+@requires_debug_token
+def get_profile():
+    """
+    Sample what every thread handling a request is doing for a while, e.g.
+
+        /debug/profile?seconds=30&interval=0.005
+
+    and reply with how often each stack came up, in the collapsed format flamegraph tools read
+    (see sampler.py).  Each stack starts with the route the thread was handling.  With
+    threads=all, threads that aren't handling a request are included too, under their names,
+    and route=get_transformed_picture only keeps that route's stacks.
+
+    Only servers that handle each request in its own thread can be profiled, so this replies
+    409 from a single threaded server or from async_server.py, whose greenlets all share one.
+    """
+    if not request.environ.get('wsgi.multithread'):
+        return "This server doesn't handle requests in their own threads, so there's nothing to sample", 409
+    seconds = min(request.args.get('seconds', 10, type=float), MAX_PROFILE_SECONDS)
+    interval = max(request.args.get('interval', 0.01, type=float), 0.001)
+    all_threads = request.args.get('threads') == 'all'
+    only_route = request.args.get('route')
+    thread_names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+
+    def tag(thread_id):
+        route = request_routes.get(thread_id)
+        if only_route:
+            return route if route == only_route else None
+        if route is None and all_threads:
+            return thread_names.get(thread_id, 'thread')
+        return route
+
+    if not profile_lock.acquire(False):
+        return "A profile is already running", 409
+    try:
+        profile = sampler.Sampler(interval, tag)
+        stacks = profile.run(seconds)
     finally:
-        if transformed_image_path and os.path.exists(transformed_image_path):
-            os.remove(transformed_image_path)
+        profile_lock.release()
+    logger.info("Profiled for %.1fs (%d samples)", seconds, profile.samples)
+    return profile.collapsed(stacks), 200, {'Content-Type': 'text/plain', 'X-Profile-Samples': str(profile.samples)}
+
+
+@app.errorhandler(facepp.CircuitOpenError)
+def facepp_unavailable(exception):
+    logger.warning("Face++ is unavailable: %s", exception)
+    return "Face detection is temporarily unavailable", 503
 
-    return json.dumps({'url': 'https://s3.amazonaws.com/sms-playground/{}'.format(filename)})
+
+@app.errorhandler(admission.Overloaded)
+def overloaded(exception):
+    requests_shed.inc('render_queue')
+    logger.warning("Turned away a request: %s", exception)
+    return json.dumps({'wait_for_seconds': exception.wait_for_seconds}), 503, {
+        'Content-Type': 'application/json', 'Retry-After': str(int(math.ceil(exception.wait_for_seconds)))}
 
 
 @app.errorhandler(500)
@@ -329,8 +951,16 @@ class DetectedFace(object):
     """
     Information for detected facial features in an image.
     """
-    def __init__(self, file, image):
-        self.data = facepp_api.detection.detect(img=file, mode="oneface")
+    def __init__(self, file, image, data=None, budget=None):
+        """
+        :param file: The facepp.File to detect the face in
+        :param image: The loaded image the features get mapped onto
+        :param data: Face++ detection results to use instead of calling Face++ (e.g. canned results)
+        :param budget: The most seconds detection can take, including retries
+        """
+        if data is None:
+            data = get_facepp_api().detection.detect(img=file, mode="oneface", budget=budget)
+        self.data = data
         self.position = self.data['face'][0]['position']
         self.image = image
 
@@ -427,120 +1057,190 @@ def add_detected_features(image, face_features):
 
 
 def add_moustache(image, face_features, moustache_name):
-    # Load the moustache image we're adding to the image
-    imgMustache = cv2.imread(get_moustache_path(moustache_name), -1)
-
-    # Create the mask for the moustache
-    orig_mask = imgMustache[:,:,3]
-
-    # Create the inverted mask for the moustache
-    orig_mask_inv = cv2.bitwise_not(orig_mask)
-
-    # Convert moustache image to BGR
-    # and save the original image size (used later when re-sizing the image)
-    imgMustache = imgMustache[:,:,0:3]
-    origMustacheHeight, origMustacheWidth = imgMustache.shape[:2]
+    # Load the moustache we're adding to the image
+    moustache = load_accessory(get_moustache_path(moustache_name))
 
     # Calculate the size the moustache should be on the person's face
-    moustacheWidth =  int(face_features.mouth_width * moustache_options[moustache_name]['width_multi'])
-    moustacheHeight = int(origMustacheHeight * (float(moustacheWidth) / origMustacheWidth))
+    width_multi = accessory_catalog.options('moustache', moustache_name)['width_multi']
+    moustacheWidth =  int(face_features.mouth_width * width_multi)
+    moustacheHeight = int(moustache.height * (float(moustacheWidth) / moustache.width))
 
     # Calculate the position for the moustache on the person's face
     x1 = face_features.mouth_x1 - ((moustacheWidth - face_features.mouth_width) / 2)
-    x2 = x1 + moustacheWidth
     y1 = face_features.mouth_y1 - (((face_features.mouth_y1 - face_features.nose_y) / 8) * 5)
-    y2 = y1 + moustacheHeight
-
-    # Check for clipping
-    if x1 < 0:
-        x1 = 0
-    if y1 < 0:
-        y1 = 0
-    if x2 > face_features.image_width:
-        x2 = face_features.image_width
-    if y2 > face_features.image_height:
-        y2 = face_features.image_height
-
-    # Re-size the original image and the masks to the moustache sizes
-    # calcualted above
-    moustache = cv2.resize(imgMustache, (moustacheWidth,moustacheHeight), interpolation=cv2.INTER_AREA)
-    mask = cv2.resize(orig_mask, (moustacheWidth,moustacheHeight), interpolation=cv2.INTER_AREA)
-    mask_inv = cv2.resize(orig_mask_inv, (moustacheWidth,moustacheHeight), interpolation=cv2.INTER_AREA)
-
-    # take ROI for moustache from background equal to size of moustache image
-    roi = image[y1:y2, x1:x2]
-
-    # roi_bg contains the original image only where the moustache is not
-    # in the region that is the size of the moustache.
-    roi_bg = cv2.bitwise_and(roi,roi,mask = mask_inv)
 
-    # roi_fg contains the image of the moustache only where the moustache is
-    roi_fg = cv2.bitwise_and(moustache,moustache,mask = mask)
-
-    # join the roi_bg and roi_fg
-    dst = cv2.add(roi_bg,roi_fg)
-
-    # place the joined image, saved to dst back over the original image
-    image[y1:y2, x1:x2] = dst
+    # Blend the moustache, re-sized to the size calculated above, onto the image
+    return overlay_accessory(image, moustache.scaled(moustacheWidth, moustacheHeight), x1, y1)
 
 
 def add_glasses(image, face_features, glasses_name):
     # Load glasses we're adding to the image
-    imgGlasses = cv2.imread(get_glasses_path(glasses_name), -1)
-
-    # Create the mask for the glasses
-    orig_mask_sg = imgGlasses[:,:,3]
-
-    # Create the inverted mask for the glasses
-    orig_mask_inv_sg = cv2.bitwise_not(orig_mask_sg)
-
-    # Convert glasses image to BGR
-    # and save the original image size (used later when re-sizing the image)
-    imgGlasses = imgGlasses[:,:,0:3]
-    origGlassesHeight, origGlassesWidth = imgGlasses.shape[:2]
+    glasses = load_accessory(get_glasses_path(glasses_name))
 
     # The glasses should overlap the eyes a little bit
     eyes_width = face_features.right_eye_x - face_features.left_eye_x
-    glassesWidth =  int(eyes_width * glasses_options[glasses_name]['width_multi'])
-    glassesHeight = int(origGlassesHeight * (float(glassesWidth) / origGlassesWidth))
+    width_multi = accessory_catalog.options('glasses', glasses_name)['width_multi']
+    glassesWidth =  int(eyes_width * width_multi)
+    glassesHeight = int(glasses.height * (float(glassesWidth) / glasses.width))
 
     # Center the glasses over the eyes
     x1 = face_features.left_eye_x - ((glassesWidth - eyes_width) / 2)
-    x2 = x1 + glassesWidth
     y1 = face_features.left_eye_y - (glassesHeight / 2)
-    y2 = y1 + glassesHeight
-
-    # Check for clipping
-    if x1 < 0:
-        x1 = 0
-    if y1 < 0:
-        y1 = 0
-    if x2 > face_features.image_width:
-        x2 = face_features.image_width
-    if y2 > face_features.image_height:
-        y2 = face_features.image_height
-
-    # Re-size the original image and the masks to the glasses sizes
-    # calcualted above
-    glasses = cv2.resize(imgGlasses, (glassesWidth,glassesHeight), interpolation=cv2.INTER_AREA)
-    mask = cv2.resize(orig_mask_sg, (glassesWidth,glassesHeight), interpolation=cv2.INTER_AREA)
-    mask_inv = cv2.resize(orig_mask_inv_sg, (glassesWidth,glassesHeight), interpolation=cv2.INTER_AREA)
-
-    # take ROI for glasses from background equal to size of glasses image
+
+    # Blend the glasses, re-sized to the size calculated above, onto the image
+    return overlay_accessory(image, glasses.scaled(glassesWidth, glassesHeight), x1, y1)
+
+
+def overlay_accessory(image, accessory, x, y):
+    """
+    Blend a premultiplied BGRA accessory (see AccessoryPyramid) onto the image with its top left
+    corner at (x, y), cutting off whatever hangs over the edges of the image.  Returns the area
+    of the image that changed as (x1, y1, x2, y2), or None if the accessory is off the image.
+    """
+    height, width = accessory.shape[:2]
+    x1, y1 = max(x, 0), max(y, 0)
+    x2, y2 = min(x + width, image.shape[1]), min(y + height, image.shape[0])
+    if x1 >= x2 or y1 >= y2:
+        return None
+    accessory = accessory[y1 - y:y2 - y, x1 - x:x2 - x]
+
+    # The accessory's colors are already multiplied by its alpha, so blending only needs
+    # to dim the background by how see-through the accessory is and add the two together
     roi = image[y1:y2, x1:x2]
+    transparency = cv2.merge([255 - accessory[:, :, 3]] * 3)
+    background = cv2.multiply(roi, transparency, scale=1.0 / 255)
+    image[y1:y2, x1:x2] = cv2.add(background, numpy.ascontiguousarray(accessory[:, :, :3]))
+    return x1, y1, x2, y2
+
+
+# ----------------------------------------------------------------------------
+# Picture encoding
+# ----------------------------------------------------------------------------
+
+# Formats the transformed pictures can be encoded as for MMS delivery
+encoding_formats = {
+    'jpeg': {
+        'extension': '.jpg',
+        'content_type': 'image/jpeg',
+        'quality_flag': cv2.IMWRITE_JPEG_QUALITY,
+    },
+    'webp': {
+        'extension': '.webp',
+        'content_type': 'image/webp',
+        'quality_flag': getattr(cv2, 'IMWRITE_WEBP_QUALITY', None),
+    },
+}
+
+# Range of qualities searched when fitting a picture into the byte budget
+MIN_ENCODE_QUALITY = 40
+MAX_ENCODE_QUALITY = 90
+
+# Remembers the quality and scale that fit the byte budget for the last picture with each
+# source resolution, most recently used last, so the search for the next one can start there
+_encoding_cache = OrderedDict()
+ENCODING_CACHE_SIZE = 256
+# Only tried, never waited on, since encoding happens while rendering (see render())
+_encoding_cache_lock = threading.Lock()
+
+EncodedPicture = namedtuple('EncodedPicture', ['data', 'extension', 'content_type', 'quality', 'scale', 'seconds'])
+
+
+def encode_image(image, max_bytes=None, format_name=None):
+    """
+    Encode an image so it fits in the MMS byte budget, lowering the quality first
+    and shrinking the dimensions only if the lowest quality is still too big.
+    """
+    max_bytes = max_bytes or PICTURE_MAX_BYTES
+    encoding_format = encoding_formats[format_name or PICTURE_FORMAT]
+    if encoding_format['quality_flag'] is None:
+        raise ValueError("This version of OpenCV can't encode {}".format(format_name or PICTURE_FORMAT))
+
+    start_time = time.time()
+    cache_key = (format_name or PICTURE_FORMAT, max_bytes) + image.shape[:2]
+
+    # Start looking near the quality that worked for the last picture with this resolution.
+    # If that picture had to be shrunk, start by checking the lowest quality is still too big.
+    start_quality = None
+    previous = _encoding_cache.get(cache_key)
+    if previous is not None:
+        previous_quality, previous_scale = previous
+        start_quality = previous_quality if previous_scale >= 1.0 else MIN_ENCODE_QUALITY
+
+    scale = 1.0
+    while True:
+        quality, data = _search_quality(_scale_image(image, scale), encoding_format, max_bytes, start_quality)
+        if len(data) <= max_bytes or min(image.shape[:2]) * scale < 16:
+            break
+        # Even the lowest quality is too big, so shrink the picture by about as
+        # much as it's over budget and try again
+        scale *= max(0.5, min(0.9, (float(max_bytes) / len(data)) ** 0.5))
+        start_quality = None
+
+    if _encoding_cache_lock.acquire(False):
+        try:
+            _encoding_cache.pop(cache_key, None)
+            _encoding_cache[cache_key] = (quality, scale)
+            while len(_encoding_cache) > ENCODING_CACHE_SIZE:
+                _encoding_cache.popitem(last=False)
+        finally:
+            _encoding_cache_lock.release()
+
+    return EncodedPicture(data, encoding_format['extension'], encoding_format['content_type'],
+                          quality, scale, time.time() - start_time)
+
+
+def _search_quality(image, encoding_format, max_bytes, start_quality=None):
+    # Binary search for the highest quality that fits in the budget.  If nothing fits,
+    # the encoding at the lowest quality is returned so the caller can shrink the picture.
+    low, high = MIN_ENCODE_QUALITY, MAX_ENCODE_QUALITY
+    encoded = {}
+    best = None
+    if start_quality is not None:
+        # Step away from the starting quality, further each time, until the highest quality
+        # that fits is between two that were tried; then the binary search only has a few
+        # qualities left
+        quality = max(low, min(start_quality, high))
+        step = 4
+        fitted = None
+        while low <= high:
+            data = encoded[quality] = _encode_at(image, encoding_format, quality)
+            fits = len(data) <= max_bytes
+            if fits:
+                best = (quality, data)
+                low = quality + 1
+            else:
+                high = quality - 1
+            if fitted is not None and fits != fitted:
+                break
+            fitted = fits
+            quality = max(low, min(quality + step if fits else quality - step, high))
+            step *= 2
+    while low <= high:
+        quality = (low + high) // 2
+        data = encoded[quality] = _encode_at(image, encoding_format, quality)
+        if len(data) <= max_bytes:
+            best = (quality, data)
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        best = (MIN_ENCODE_QUALITY, encoded.get(MIN_ENCODE_QUALITY) or
+                _encode_at(image, encoding_format, MIN_ENCODE_QUALITY))
+    return best
 
-    # roi_bg contains the original image only where the glasses is not
-    # in the region that is the size of the glasses.
-    roi_bg = cv2.bitwise_and(roi,roi,mask = mask_inv)
 
-    # roi_fg contains the image of the glasses only where the glasses is
-    roi_fg = cv2.bitwise_and(glasses,glasses,mask = mask)
+def _scale_image(image, scale):
+    if scale >= 1.0:
+        return image
+    height, width = image.shape[:2]
+    return cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
 
-    # join the roi_bg and roi_fg
-    dst = cv2.add(roi_bg,roi_fg)
 
-    # place the joined image, saved to dst back over the original image
-    image[y1:y2, x1:x2] = dst
+def _encode_at(image, encoding_format, quality):
+    success, data = cv2.imencode(encoding_format['extension'], image, [encoding_format['quality_flag'], quality])
+    if not success:
+        raise ValueError("Failed to encode picture as {}".format(encoding_format['extension']))
+    return data.tostring()
 
 
 # ----------------------------------------------------------------------------
@@ -555,6 +1255,143 @@ def get_glasses_path(glasses_name):
     return 'images/glasses/{}.png'.format(glasses_name)
 
 
+# Accessory images (with their alpha channel), only read from disk the first time they're used
+class AccessoryPyramid(object):
+    """
+    An accessory's picture (a PNG with an alpha channel), with its colors premultiplied by its
+    alpha and shrunk by half over and over down to MIN_LEVEL_WIDTH pixels wide.  It can then be
+    scaled to any size with one small resize of the nearest bigger level, instead of resizing
+    the full-size colors and masks separately every time.
+    """
+    MIN_LEVEL_WIDTH = 16
+
+    def __init__(self, accessory):
+        premultiplied = accessory.astype(numpy.float32)
+        premultiplied[:, :, :3] *= premultiplied[:, :, 3:] / 255
+        level = numpy.rint(premultiplied).astype(numpy.uint8)
+        self.levels = [level]
+        while level.shape[1] / 2 >= self.MIN_LEVEL_WIDTH and level.shape[0] / 2 >= 1:
+            level = cv2.resize(level, (level.shape[1] / 2, level.shape[0] / 2), interpolation=cv2.INTER_AREA)
+            self.levels.append(level)
+
+    @property
+    def width(self):
+        return self.levels[0].shape[1]
+
+    @property
+    def height(self):
+        return self.levels[0].shape[0]
+
+    def scaled(self, width, height):
+        """The accessory at the given size, as premultiplied BGRA (don't change it, it may be cached)."""
+        source = self.levels[0]
+        for level in self.levels[1:]:
+            if level.shape[1] < width or level.shape[0] < height:
+                break
+            source = level
+        if source.shape[1] == width and source.shape[0] == height:
+            return source
+        interpolation = cv2.INTER_AREA if source.shape[1] > width else cv2.INTER_LINEAR
+        return cv2.resize(source, (width, height), interpolation=interpolation)
+
+
+_accessories = {}
+
+
+def load_accessory(path):
+    # Accessories that changed since they were loaded get dropped by the catalog
+    accessory_catalog.refresh()
+    if path not in _accessories:
+        accessory = cv2.imread(path, -1)
+        if accessory is None:
+            raise IOError("Couldn't load accessory image {}".format(path))
+        _accessories[path] = AccessoryPyramid(accessory)
+    return _accessories[path]
+
+
+def preload_accessories():
+    for moustache_name in accessory_catalog.names('moustache'):
+        load_accessory(get_moustache_path(moustache_name))
+    for glasses_name in accessory_catalog.names('glasses'):
+        load_accessory(get_glasses_path(glasses_name))
+
+
+class AccessoryCatalog(object):
+    """
+    The moustaches and glasses that can be added to pictures: every PNG in images/moustaches and
+    images/glasses.  The directories are checked again whenever the catalog is used, at most
+    every reload_seconds, so accessories can be added, changed or removed without restarting;
+    the loaded pictures of any that changed are dropped so they get loaded again.
+
+    Every process (including render workers) keeps its own catalog.  It's used while rendering
+    (see render()), where waiting on a lock isn't allowed, so while one thread checks the
+    directories the others carry on with what was there before rather than waiting.
+    """
+    def __init__(self, reload_seconds=CATALOG_RELOAD_SECONDS):
+        self.reload_seconds = reload_seconds
+        self.paths = {'moustache': get_moustache_path, 'glasses': get_glasses_path}
+        # Maps each kind of accessory to the modification time of each accessory's picture
+        self.accessories = self._scan()
+        self.checked = time.time()
+        self.lock = threading.Lock()
+
+    def exists(self, kind, name):
+        self.refresh()
+        return name in self.accessories[kind]
+
+    def names(self, kind):
+        self.refresh()
+        return sorted(self.accessories[kind])
+
+    def options(self, kind, name):
+        listed = moustache_options if kind == 'moustache' else glasses_options
+        return dict(DEFAULT_ACCESSORY_OPTIONS, **listed.get(name, {}))
+
+    def refresh(self):
+        if time.time() - self.checked < self.reload_seconds:
+            return
+        if not self.lock.acquire(False):
+            # Another thread is checking
+            return
+        try:
+            if time.time() - self.checked < self.reload_seconds:
+                return
+            accessories = self._scan()
+            previous = self.accessories
+            if accessories != previous:
+                self.accessories = accessories
+                for kind, get_path in self.paths.items():
+                    for name, modified in previous[kind].items():
+                        if accessories[kind].get(name) != modified:
+                            _accessories.pop(get_path(name), None)
+                logger.info("Reloaded the accessory catalog (%d moustaches, %d glasses)",
+                            len(accessories['moustache']), len(accessories['glasses']))
+            # Only once the accessories are up to date, so other threads don't skip checking
+            # and use the old ones
+            self.checked = time.time()
+        finally:
+            self.lock.release()
+
+    def _scan(self):
+        accessories = {}
+        for kind, get_path in self.paths.items():
+            directory = os.path.dirname(get_path(''))
+            accessories[kind] = {}
+            for filename in os.listdir(directory):
+                name, extension = os.path.splitext(filename)
+                if extension != '.png':
+                    continue
+                try:
+                    accessories[kind][name] = os.stat(os.path.join(directory, filename)).st_mtime
+                except OSError:
+                    # Removed since it was listed
+                    pass
+        return accessories
+
+
+accessory_catalog = AccessoryCatalog()
+
+
 def make_unique_id():
     return "%032x" % random.getrandbits(128)
 
@@ -563,67 +1400,230 @@ def _send_message(conversation_code, message, picture_url=None):
     args = {
         'body': message,
         'to': conversation_to_phone_number[conversation_code],
-        'from_': "+12407536527",
+        'from_': TWILIO_PHONE_NUMBER,
     }
     if picture_url:
         args['media_url'] = picture_url
-    twilio.messages.create(**args)
-    logger.info("Sent message to {}: {}{} ({})".format(
-        conversation_to_phone_number[conversation_code], message,
-        "|{}".format(picture_url) if picture_url else "", conversation_code))
+    with tracer.span('send', conversation_code), track_dependency('twilio_messages_create'):
+        get_twilio().messages.create(**args)
+    logger.info("Sent message to %s: %s%s (%s)",
+                conversation_to_phone_number[conversation_code], message,
+                "|{}".format(picture_url) if picture_url else "", conversation_code)
 
 
-def get_file_extension_from_url(url):
-    request = urllib2.Request(url, headers={ 'User-Agent': 'Mozilla/5.0' })
-    response = urllib2.urlopen(request)
-    if 'content-disposition' in response.headers and 'filename=' in response.headers['content-disposition']:
-        file_name = cgi.parse_header(response.headers['content-disposition'])[1]['filename']
-        file_extension = os.path.splitext(file_name)[1]
-        if file_extension.startswith("."):
-            file_extension = file_extension[1:]
-    elif 'content-type' in response.headers:
-        file_extension = response.headers['content-type'].split("/")[1]
-    else:
-        file_extension = os.path.splitext(urlparse(url).path)[1]
-    return file_extension
+def claim_message(message, conversation_code):
+    with tracer.span('claim', conversation_code, message_sid=message.sid):
+        record_state_change('claimed', sid=message.sid)
 
 
 def get_image(url):
-    # Download the image to the server's hard drive and load it so we can manipulate it
-    file_extension = get_file_extension_from_url(url)
-    file_extension = ".{}".format(file_extension) if file_extension else ""
-    image_path = "images/{}{}".format(str(uuid.uuid4()).replace("-", ""), file_extension)
+    # Download the image and decode it straight from memory, at the size it gets rendered at
+    return load_image(download_media(url), url)
+
+
+def load_image(image_data, url):
+    image = render(decode_image, image_data)
+    if image is None:
+        raise ValueError("Couldn't decode the image at {}".format(url))
+    return image
+
+
+def download_media(url):
+    request = urllib2.Request(url, headers={ 'User-Agent': 'Mozilla/5.0' })
+    with track_dependency('image_download'):
+        return urllib2.urlopen(request).read()
+
+
+# Maps a picture code to the Future of its download while it's being prefetched
+media_downloads = {}
+media_downloads_lock = threading.Lock()
+
+
+def prefetch_picture(conversation_code, picture_code):
+    # Start downloading a picture into the media cache in the background
+    if get_media_cache() is None:
+        return
+    with media_downloads_lock:
+        download = get_media_prefetcher().submit(_prefetch_picture, conversation_code, picture_code)
+        media_downloads[picture_code] = download
+    download.add_done_callback(lambda _: _forget_download(picture_code))
+
+
+def _prefetch_picture(conversation_code, picture_code):
     try:
-        request = urllib2.Request(url, headers={ 'User-Agent': 'Mozilla/5.0' })
-        response = urllib2.urlopen(request)
-        with open(image_path, "w") as saved_image:
-            saved_image.write(response.read())
-        image = resize_image(cv2.imread(image_path))
-    except:
-        if image_path and os.path.exists(image_path):
-            os.remove(image_path)
-        raise
-
-    return image, image_path
-
-
-def resize_image(image):
-    # Make sure the image is a small enough size for the detection algoritms
-    # to work with an acceptable accuracy
+        with tracer.span('prefetch', conversation_code, picture_code):
+            return fetch_picture_data(picture_code)
+    except Exception as e:
+        # The picture gets downloaded again when it's rendered
+        logger.warning("Failed to prefetch picture: %s (%s) (%s)", e, conversation_code, picture_code)
+        return None
+
+
+def _forget_download(picture_code):
+    with media_downloads_lock:
+        media_downloads.pop(picture_code, None)
+
+
+def get_picture_data(conversation_code, picture_code):
+    # The picture's content, waiting for it to finish being prefetched if it's being prefetched
+    with media_downloads_lock:
+        download = media_downloads.get(picture_code)
+    image_data = download.result() if download is not None else None
+    if image_data is None:
+        image_data = fetch_picture_data(picture_code)
+    return image_data
+
+
+def fetch_picture_data(picture_code):
+    # The picture's content from the media cache, downloading it into the cache if it isn't there
+    picture = pictures[picture_code]
+    media_cache = get_media_cache()
+    if media_cache is not None and picture.get('media_key'):
+        image_data = media_cache.get(picture['media_key'])
+        if image_data is not None:
+            return image_data
+    image_data = download_media(picture['url'])
+    if media_cache is not None:
+        record_state_change('media', picture=picture_code, key=media_cache.put(image_data))
+    return image_data
+
+
+# OpenCV flags for decoding JPEGs at 1/2, 1/4 and 1/8 of their size (which libjpeg does while
+# decoding, so the full size picture is never made), biggest reduction first
+REDUCED_DECODE_FLAGS = [(scale, getattr(cv2, 'IMREAD_REDUCED_COLOR_{}'.format(scale), None)) for scale in [8, 4, 2]]
+# Orientation is applied by orient_image, whatever OpenCV version is installed
+IGNORE_ORIENTATION_FLAG = getattr(cv2, 'IMREAD_IGNORE_ORIENTATION', 0)
+
+
+def decode_image(image_data):
+    # Decode the picture at the size it gets rendered at, turned the right way up.  Phone photos
+    # are usually many times bigger than that, so JPEGs are decoded at a fraction of their size.
+    header = jpegheader.read_jpeg_header(image_data)
+    flags = cv2.IMREAD_COLOR
+    if header is not None:
+        for scale, reduced_flags in REDUCED_DECODE_FLAGS:
+            if reduced_flags is not None and max(header.width, header.height) // scale >= RENDER_MAX_DIMENSION:
+                flags = reduced_flags
+                break
+
+    if flags == cv2.IMREAD_COLOR:
+        image = cv2.imdecode(numpy.frombuffer(image_data, numpy.uint8), flags | IGNORE_ORIENTATION_FLAG)
+    else:
+        # cv2.imdecode ignores the reduced flags (only cv2.imread uses them), so decode it from
+        # a file in shared memory instead
+        with tempfile.NamedTemporaryFile(suffix='.jpg', dir=renderpool.SHARED_MEMORY_DIRECTORY) as image_file:
+            image_file.write(image_data)
+            image_file.flush()
+            image = cv2.imread(image_file.name, flags | IGNORE_ORIENTATION_FLAG)
+
+    if image is None:
+        return None
+    return resize_image(orient_image(image, header.orientation if header is not None else 1))
+
+
+def orient_image(image, orientation):
+    # Turn (and/or flip) the image the way its EXIF orientation says it should be shown
+    if orientation == 2:
+        return cv2.flip(image, 1)
+    if orientation == 3:
+        return cv2.flip(image, -1)
+    if orientation == 4:
+        return cv2.flip(image, 0)
+    if orientation == 5:
+        return cv2.transpose(image)
+    if orientation == 6:
+        return cv2.flip(cv2.transpose(image), 1)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(image), -1)
+    if orientation == 8:
+        return cv2.flip(cv2.transpose(image), 0)
+    return image
+
+
+def make_detection_file(image):
+    """
+    Encode the one copy of the picture that's uploaded to Face++, already small enough that
+    Face++ won't shrink it again.  The landmarks Face++ finds are percentages of the picture's
+    size, so they map straight back onto the picture being rendered, whatever its size.
+    """
+    with render_seconds.time('detection_encode'):
+        encoded = render(_encode_for_detection, image)
+    detection_upload_bytes.observe(len(encoded))
+    return facepp.File('picture.jpg', encoded)
+
+
+def _encode_for_detection(image):
+    detection_image = resize_image(image, DETECTION_MAX_DIMENSION)
+    return cv2.imencode('.jpg', detection_image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tostring()
+
+
+def resize_image(image, max_dimension=RENDER_MAX_DIMENSION):
+    # Shrink the image so its longest side is at most max_dimension pixels
     original_height, original_width = image.shape[:2]
-    if max(original_height, original_width) > 640:
+    if max(original_height, original_width) > max_dimension:
         if original_height > original_width:
-            image = cv2.resize(image, (int(original_width * (640.0 / original_height)), 640))
+            image = cv2.resize(image, (int(original_width * (float(max_dimension) / original_height)), max_dimension))
         else:
-            image = cv2.resize(image, (640, int(original_height * (640.0 / original_width))))
+            image = cv2.resize(image, (max_dimension, int(original_height * (float(max_dimension) / original_width))))
     return image
 
 
+def render(function, *args):
+    # Functions run this way can't use locks (or anything else that waits on other requests),
+    # since they might be running on a thread of their own outside the serving mode's control
+    pool = render_pool if render_pool is not None else get_render_workers()
+    render_queue_depth.inc()
+    try:
+        with render_job_seconds.time(function.__name__):
+            if pool is None:
+                return function(*args)
+            return pool.apply(function, args)
+    finally:
+        render_queue_depth.dec()
+
+
 def transform_image(image, transform_info, face_features):
+    # Returns the areas of the image that changed, as (x1, y1, x2, y2)
+    changed = []
     if transform_info['moustache']:
-        add_moustache(image, face_features, transform_info['moustache'])
+        changed.append(add_moustache(image, face_features, transform_info['moustache']))
     if transform_info['glasses']:
-        add_glasses(image, face_features, transform_info['glasses'])
+        changed.append(add_glasses(image, face_features, transform_info['glasses']))
+    return [area for area in changed if area is not None]
+
+
+def render_variants(image, variants, face_features, contact_sheet=False):
+    """
+    Transform and encode the picture once for each variant (a transform_info dict), putting
+    back only the areas each variant changed instead of starting from a fresh copy of the
+    whole picture every time.  The picture is left the way it was.
+
+    :param contact_sheet: Also make a picture of all the variants side by side
+    :return: The list of EncodedPictures for the variants, and the EncodedPicture of the
+        contact sheet (or None)
+    """
+    sheet = None
+    if contact_sheet:
+        # Shrink the variants so the sheet is about as wide as the picture
+        columns = int(math.ceil(math.sqrt(len(variants))))
+        rows = int(math.ceil(len(variants) / float(columns)))
+        cell_width, cell_height = image.shape[1] / columns, image.shape[0] / columns
+        sheet = numpy.zeros((cell_height * rows, cell_width * columns, 3), numpy.uint8)
+
+    # Only the areas the accessories cover get put back from this, after each variant
+    base = image.copy()
+    encoded_variants = []
+    for index, transform_info in enumerate(variants):
+        changed = transform_image(image, transform_info, face_features)
+        encoded_variants.append(encode_image(image))
+        if sheet is not None:
+            row, column = divmod(index, columns)
+            sheet[row * cell_height:(row + 1) * cell_height, column * cell_width:(column + 1) * cell_width] = \
+                cv2.resize(image, (cell_width, cell_height), interpolation=cv2.INTER_AREA)
+        for x1, y1, x2, y2 in changed:
+            image[y1:y2, x1:x2] = base[y1:y2, x1:x2]
+
+    return encoded_variants, encode_image(sheet) if sheet is not None else None
 
 
 # ----------------------------------------------------------------------------
@@ -631,4 +1631,8 @@ def transform_image(image, transform_info, face_features):
 # ----------------------------------------------------------------------------
 
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=5000)
+    get_render_workers()
+    setup_logging()
+    get_state_journal()
+    # A thread per request, so slow requests don't hold up the rest (and can be profiled)
+    app.run(host="0.0.0.0", port=PORT, threaded=True)
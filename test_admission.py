@@ -0,0 +1,75 @@
+"""
+Tests for admission.py, run with
+
+    python -m unittest test_admission
+"""
+import unittest
+
+import admission
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_allows_a_burst_then_the_rate(self):
+        bucket = admission.TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.take() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.take(), 0.5, delta=0.05)
+
+    def test_refills_over_time(self):
+        bucket = admission.TokenBucket(rate=1, burst=1)
+        bucket.take()
+        bucket.updated -= 1
+        self.assertEqual(bucket.take(), 0)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_limits_each_key_separately(self):
+        limiter = admission.RateLimiter(rate=1, burst=1)
+        self.assertEqual(limiter.wait_time('+15555550100'), 0)
+        self.assertGreater(limiter.wait_time('+15555550100'), 0)
+        self.assertEqual(limiter.wait_time('+15555550101'), 0)
+
+    def test_forgets_the_least_recently_used_keys(self):
+        limiter = admission.RateLimiter(rate=1, burst=1, max_keys=2)
+        for key in ['a', 'b', 'c']:
+            limiter.wait_time(key)
+        self.assertEqual(list(limiter.buckets), ['b', 'c'])
+        # A forgotten key starts again with a full bucket
+        self.assertEqual(limiter.wait_time('a'), 0)
+
+
+class LimitTest(unittest.TestCase):
+    def test_turns_away_work_past_capacity(self):
+        limit = admission.Limit(2, wait_for_seconds=lambda: 7.0)
+        with limit.admit():
+            with limit.admit():
+                self.assertEqual(limit.load, 1.0)
+                with self.assertRaises(admission.Overloaded) as raised:
+                    with limit.admit():
+                        pass
+                self.assertEqual(raised.exception.wait_for_seconds, 7.0)
+        self.assertEqual(limit.in_progress, 0)
+
+    def test_frees_its_place_when_the_work_fails(self):
+        limit = admission.Limit(1)
+        with self.assertRaises(ValueError):
+            with limit.admit():
+                raise ValueError()
+        self.assertEqual(limit.in_progress, 0)
+
+
+class BackoffTest(unittest.TestCase):
+    def test_rises_from_minimum_to_maximum(self):
+        self.assertEqual(admission.backoff(1, 30, 0), 1)
+        self.assertEqual(admission.backoff(1, 30, 1), 30)
+        self.assertEqual(admission.backoff(1, 30, 5), 30)
+        self.assertLess(admission.backoff(1, 30, 0.5), 15.5)
+
+    def test_moving_average_follows_values(self):
+        average = admission.MovingAverage(weight=0.5)
+        average.add(4)
+        average.add(4)
+        self.assertEqual(average.value, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+"""
+Tests for facepp.py's circuit breaker, transports and multipart forms, run with
+
+    python -m unittest test_facepp
+"""
+import json
+import socket
+import threading
+import unittest
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import numpy
+
+import facepp
+
+# Don't print every retry
+facepp.DEBUG_LEVEL = 0
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.failures_left = 0
+        self.transport = facepp.FakeTransport(self.respond)
+        self.breaker = facepp.CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        self.api = facepp.API('key', 'secret', max_retries=3, retry_delay=0, circuit_breaker=self.breaker,
+                              transport=self.transport)
+
+    def respond(self, request):
+        if self.failures_left:
+            self.failures_left -= 1
+            raise socket.error('connection refused')
+        return json.dumps({'face': []})
+
+    def detect(self):
+        return self.api.detection.detect(url='http://example.com/picture.jpg')
+
+    def test_retried_call_counts_as_one_failure(self):
+        self.failures_left = 4
+        self.assertRaises(socket.error, self.detect)
+        self.assertEqual(len(self.transport.requests), 4)
+        self.assertEqual(self.breaker.failures, 1)
+        self.assertEqual(self.breaker.state, facepp.CircuitBreaker.CLOSED)
+
+    def test_call_that_recovers_after_retries_is_a_success(self):
+        self.failures_left = 3
+        self.detect()
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_opens_and_closes_again(self):
+        self.failures_left = 8
+        self.assertRaises(socket.error, self.detect)
+        self.assertRaises(socket.error, self.detect)
+        self.assertEqual(self.breaker.state, facepp.CircuitBreaker.OPEN)
+        self.assertRaises(facepp.CircuitOpenError, self.detect)
+        self.assertEqual(len(self.transport.requests), 8)
+        self.breaker.opened_at -= 1
+        self.detect()
+        self.assertEqual(self.breaker.state, facepp.CircuitBreaker.CLOSED)
+
+    def test_any_exception_ends_the_trial(self):
+        self.breaker.state = facepp.CircuitBreaker.OPEN
+        self.breaker.opened_at = 0
+        self.transport.handler = lambda request: 1 / 0
+        self.assertRaises(ZeroDivisionError, self.detect)
+        self.assertEqual(self.breaker.state, facepp.CircuitBreaker.OPEN)
+        self.breaker.opened_at = 0
+        self.transport.handler = self.respond
+        self.detect()
+        self.assertEqual(self.breaker.state, facepp.CircuitBreaker.CLOSED)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UploadHandler(BaseHTTPRequestHandler):
+    """Replies with how many bytes were uploaded; drops the connection halfway through an upload
+    whenever the server's drop_next_reused flag is set and the connection was used before."""
+    protocol_version = 'HTTP/1.1'
+    timeout = 5
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.requests_handled = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        if self.requests_handled and self.server.drop_next_reused:
+            self.server.drop_next_reused = False
+            self.rfile.read(length // 2)
+            self.close_connection = 1
+            return
+        self.requests_handled += 1
+        received = len(self.rfile.read(length))
+        self.server.received.append(received)
+        body = str(received)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PooledTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), _UploadHandler)
+        self.httpd.drop_next_reused = False
+        self.httpd.received = []
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:{}/upload".format(self.httpd.server_address[1])
+        self.transport = facepp.PooledTransport()
+
+    def tearDown(self):
+        self.transport.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def upload(self, content):
+        form = facepp._MultiPartForm()
+        form.add_file('img', 'picture.jpg', content)
+        body = form.get_body()
+        request = urllib2.Request(self.url, body, {'Content-Type': form.get_content_type()})
+        return len(body), self.transport.send(request, 3)
+
+    def test_reuses_connections(self):
+        self.upload('x' * 1000)
+        self.upload('x' * 1000)
+        self.assertEqual(len(self.transport._idle.values()[0]), 1)
+
+    def test_resends_the_whole_form_when_a_reused_connection_drops(self):
+        self.upload('x' * 1000)
+        self.httpd.drop_next_reused = True
+        length, response = self.upload('x' * 100000)
+        self.assertEqual(int(response), length)
+        self.assertEqual(self.httpd.received[-1], length)
+
+
+class MultiPartBodyTest(unittest.TestCase):
+    def make_body(self, content):
+        form = facepp._MultiPartForm()
+        form.add_field('api_key', 'key')
+        form.add_file('img', 'picture.jpg', content)
+        return form.get_body()
+
+    def read_in_pieces(self, body, size):
+        pieces = []
+        while True:
+            piece = body.read(size)
+            if not len(piece):
+                return ''.join(facepp._as_bytes(piece) for piece in pieces)
+            pieces.append(piece)
+
+    def test_length_matches_what_is_read(self):
+        for content in ['abc' * 1000, bytearray('abc' * 1000), numpy.arange(600, dtype=numpy.uint16).reshape(20, 30)]:
+            body = self.make_body(content)
+            data = self.read_in_pieces(body, 100)
+            self.assertEqual(len(body), len(data))
+            self.assertIn(content.tobytes() if hasattr(content, 'tobytes') else str(content), data)
+
+    def test_seek_starts_again(self):
+        body = self.make_body('abc' * 1000)
+        first = str(body)
+        body.read(50)
+        body.seek(0)
+        self.assertEqual(self.read_in_pieces(body, 7), first)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Tests for journal.py, run with
+
+    python -m unittest test_journal
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import journal
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state.jsonl')
+        self.handled = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_journal(self, snapshot=None, compact_every=100000):
+        snapshot = snapshot or (lambda: {'type': 'snapshot', 'handled': sorted(self.handled)})
+        return journal.Journal(self.path, snapshot, compact_every)
+
+    def handle(self, state_journal, sid):
+        self.handled.add(sid)
+        state_journal.append({'type': 'claimed', 'sid': sid})
+
+    def rebuild(self):
+        handled = set()
+        for record in self.make_journal().replay():
+            if record['type'] == 'snapshot':
+                handled.update(record['handled'])
+            else:
+                handled.add(record['sid'])
+        return handled
+
+    def lines(self):
+        with open(self.path) as journal_file:
+            return journal_file.readlines()
+
+    def test_replays_what_was_appended(self):
+        state_journal = self.make_journal()
+        for sid in ['a', 'b', 'c']:
+            self.handle(state_journal, sid)
+        state_journal.close()
+        self.assertEqual(self.rebuild(), {'a', 'b', 'c'})
+
+    def test_skips_records_cut_off_by_a_crash(self):
+        state_journal = self.make_journal()
+        self.handle(state_journal, 'a')
+        state_journal.close()
+        with open(self.path, 'a') as journal_file:
+            journal_file.write('{"type": "clai')
+        replaying = self.make_journal()
+        self.assertEqual(len(list(replaying.replay())), 1)
+        self.assertEqual(replaying.skipped, 1)
+
+    def test_compact_leaves_one_snapshot(self):
+        state_journal = self.make_journal()
+        for sid in ['a', 'b', 'c']:
+            self.handle(state_journal, sid)
+        state_journal.compact()
+        self.handle(state_journal, 'd')
+        state_journal.close()
+        self.assertEqual(len(self.lines()), 2)
+        self.assertEqual(self.rebuild(), {'a', 'b', 'c', 'd'})
+
+    def test_compacts_in_the_background_without_holding_up_appends(self):
+        snapshot_started = threading.Event()
+        finish_snapshot = threading.Event()
+
+        def slow_snapshot():
+            handled = sorted(self.handled)
+            snapshot_started.set()
+            finish_snapshot.wait(5)
+            return {'type': 'snapshot', 'handled': handled}
+
+        state_journal = self.make_journal(slow_snapshot, compact_every=3)
+        for sid in ['a', 'b', 'c']:
+            self.handle(state_journal, sid)
+        self.assertTrue(snapshot_started.wait(5))
+        # The snapshot is still being made, but appends go ahead
+        start_time = time.time()
+        self.handle(state_journal, 'd')
+        self.handle(state_journal, 'e')
+        self.assertLess(time.time() - start_time, 1)
+        finish_snapshot.set()
+        state_journal.close()
+        # The snapshot, then the records appended while it was made
+        self.assertEqual(len(self.lines()), 3)
+        self.assertEqual(self.rebuild(), {'a', 'b', 'c', 'd', 'e'})
+        self.assertEqual(state_journal.appended, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+Tests for mediacache.py, run with
+
+    python -m unittest test_mediacache
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import mediacache
+
+
+class MediaCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_cache(self, max_bytes=100):
+        return mediacache.MediaCache(os.path.join(self.directory, 'media'), max_bytes)
+
+    def test_gets_what_was_put(self):
+        cache = self.make_cache()
+        key = cache.put('picture')
+        self.assertEqual(cache.get(key), 'picture')
+        self.assertIsNone(cache.get('0' * 64))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_stores_identical_media_once(self):
+        cache = self.make_cache()
+        self.assertEqual(cache.put('picture'), cache.put('picture'))
+        self.assertEqual(cache.deduplicated, 1)
+        self.assertEqual(cache.total_bytes, len('picture'))
+
+    def test_evicts_the_least_recently_used(self):
+        cache = self.make_cache(max_bytes=100)
+        first = cache.put('a' * 40)
+        second = cache.put('b' * 40)
+        cache.get(first)
+        third = cache.put('c' * 40)
+        self.assertIsNone(cache.get(second))
+        self.assertEqual(cache.get(first), 'a' * 40)
+        self.assertEqual(cache.get(third), 'c' * 40)
+        self.assertEqual(cache.evicted, 1)
+        self.assertEqual(cache.total_bytes, 80)
+
+    def test_keeps_the_newest_even_if_too_big(self):
+        cache = self.make_cache(max_bytes=10)
+        key = cache.put('a' * 40)
+        self.assertEqual(cache.get(key), 'a' * 40)
+
+    def test_finds_what_is_stored_after_a_restart(self):
+        cache = self.make_cache()
+        key = cache.put('picture')
+        restarted = self.make_cache()
+        self.assertEqual(restarted.get(key), 'picture')
+        self.assertEqual(restarted.total_bytes, len('picture'))
+
+
+if __name__ == '__main__':
+    unittest.main()
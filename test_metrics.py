@@ -0,0 +1,61 @@
+"""
+Tests for metrics.py's Prometheus text output, run with
+
+    python -m unittest test_metrics
+"""
+import unittest
+
+import metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def render(self):
+        return metrics.render(self.registry)
+
+    def test_counter(self):
+        requests = metrics.Counter('requests_total', "Requests handled.", ['route'], registry=self.registry)
+        requests.inc('index')
+        requests.inc('index', amount=2)
+        requests.inc('say "hi"\n')
+        self.assertEqual(self.render(), "\n".join([
+            '# HELP requests_total Requests handled.',
+            '# TYPE requests_total counter',
+            'requests_total{route="index"} 3',
+            'requests_total{route="say \\"hi\\"\\n"} 1',
+        ]) + "\n")
+
+    def test_gauges(self):
+        queued = metrics.Gauge('queued', "Jobs queued.", registry=self.registry)
+        queued.inc()
+        queued.inc()
+        queued.dec()
+        metrics.Gauge('size', "Size of things.", lambda: 2.5, registry=self.registry)
+        metrics.Gauge('missing', "Not there yet.", lambda: None, registry=self.registry)
+        lines = self.render().splitlines()
+        self.assertIn('queued 1', lines)
+        self.assertIn('size 2.5', lines)
+        self.assertFalse([line for line in lines if line.startswith('missing')])
+
+    def test_histogram(self):
+        seconds = metrics.Histogram('seconds', "Time taken.", buckets=(0.1, 1), registry=self.registry)
+        for value in [0.05, 0.1, 0.5, 5]:
+            seconds.observe(value)
+        self.assertEqual(self.render().splitlines()[2:], [
+            'seconds_bucket{le="0.1"} 2',
+            'seconds_bucket{le="1"} 3',
+            'seconds_bucket{le="+Inf"} 4',
+            'seconds_sum 5.65',
+            'seconds_count 4',
+        ])
+
+    def test_label_values_are_checked(self):
+        requests = metrics.Counter('requests_total', "Requests handled.", ['route'], registry=self.registry)
+        self.assertRaises(ValueError, requests.inc)
+        self.assertRaises(ValueError, requests.inc, 'index', 'extra')
+
+
+if __name__ == '__main__':
+    unittest.main()
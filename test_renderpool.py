@@ -0,0 +1,91 @@
+"""
+Tests for renderpool.py, run with
+
+    python -m unittest test_renderpool
+"""
+import os
+import threading
+import time
+import unittest
+
+import numpy
+
+import renderpool
+
+_initialized = []
+
+
+def initialize():
+    _initialized.append(os.getpid())
+
+
+def was_initialized():
+    return _initialized == [os.getpid()]
+
+
+def darken(image):
+    image //= 2
+    return image.sum()
+
+
+def flipped(image):
+    return image[::-1].copy()
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def fail():
+    raise ValueError("failed in the worker")
+
+
+class RenderPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = renderpool.RenderPool(2, timeout=1, initializer=initialize)
+
+    def tearDown(self):
+        self.pool.pool.terminate()
+
+    def test_changes_to_images_are_copied_back(self):
+        image = numpy.full((4, 4, 3), 200, numpy.uint8)
+        self.assertEqual(self.pool.apply(darken, (image,)), 100 * image.size)
+        self.assertTrue((image == 100).all())
+
+    def test_returns_images(self):
+        image = numpy.arange(12, dtype=numpy.uint8).reshape(4, 3)
+        self.assertTrue((self.pool.apply(flipped, (image,)) == image[::-1]).all())
+
+    def test_exceptions_are_raised_in_the_caller(self):
+        self.assertRaises(ValueError, self.pool.apply, fail)
+
+    def test_slow_jobs_time_out_and_the_workers_are_replaced(self):
+        old_pids = set(self.pool.apply(sleep, (0,)) for _ in range(4))
+        results = []
+
+        def render(seconds):
+            try:
+                results.append(self.pool.apply(sleep, (seconds,)))
+            except renderpool.RenderTimeout:
+                results.append('timed out')
+
+        threads = [threading.Thread(target=render, args=(seconds,)) for seconds in (5, 0.1)]
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(time.time() - start_time, 3)
+        self.assertEqual(results.count('timed out'), 1)
+        self.assertEqual(self.pool.recycled, 1)
+        self.assertFalse(self.pool.apply(sleep, (0,)) in old_pids)
+
+    def test_initializer_runs_in_every_worker(self):
+        self.assertTrue(all(self.pool.apply(was_initialized) for _ in range(4)))
+        self.pool._recycle(self.pool.pool)
+        self.assertTrue(all(self.pool.apply(was_initialized) for _ in range(4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
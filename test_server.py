@@ -0,0 +1,84 @@
+"""
+Tests for server.py's endpoints, run with
+
+    python -m unittest test_server
+"""
+import json
+import math
+import os
+import unittest
+
+os.environ.setdefault('STATE_JOURNAL_PATH', '')
+os.environ.setdefault('MEDIA_CACHE_PATH', '')
+os.environ.setdefault('LOG_PATH', os.devnull)
+
+import server
+
+PICTURE_CODE = 'test-picture'
+
+
+class PictureTest(unittest.TestCase):
+    def setUp(self):
+        self.client = server.app.test_client()
+        # The way a picture a kid sent is stored (see get_response_message)
+        server.record_state_change('picture', code=PICTURE_CODE, picture={
+            'url': 'http://example.com/picture.jpg',
+            'moustache': None,
+            'glasses': None,
+        })
+
+    def tearDown(self):
+        server.pictures.pop(PICTURE_CODE, None)
+
+    def post_json(self, url, data):
+        return self.client.post(url, data=json.dumps(data), content_type='application/json')
+
+    def post_variants(self, picture_code, variants):
+        return self.post_json("/conversation/unknown/picture/{}/variants".format(picture_code),
+                              {'variants': variants})
+
+    def test_add_to_picture(self):
+        response = self.post_json("/conversation/unknown/picture/{}/moustache".format(PICTURE_CODE),
+                                  {'moustache_name': 'handlebar'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(server.pictures[PICTURE_CODE]['moustache'], 'handlebar')
+
+    def test_add_unknown_accessory_to_picture(self):
+        response = self.post_json("/conversation/unknown/picture/{}/glasses".format(PICTURE_CODE),
+                                  {'glasses_name': 'no such glasses'})
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(server.pictures[PICTURE_CODE]['glasses'])
+
+    def test_variants_of_unknown_picture_are_not_found(self):
+        response = self.post_variants('unknown', [{'moustache': 'handlebar'}])
+        self.assertEqual(response.status_code, 404)
+
+    def test_variants_with_unknown_accessory_are_not_found(self):
+        response = self.post_variants(PICTURE_CODE, [{'moustache': 'no such moustache'}])
+        self.assertEqual(response.status_code, 404)
+
+    def test_malformed_variants_are_bad_requests(self):
+        for variants in [None, "handlebar", ["handlebar"], [{'moustache': ['handlebar']}], []]:
+            response = self.post_variants(PICTURE_CODE, variants)
+            self.assertEqual(response.status_code, 400, variants)
+        response = self.client.post("/conversation/unknown/picture/{}/variants".format(PICTURE_CODE),
+                                    data="variants", content_type='text/plain')
+        self.assertEqual(response.status_code, 400)
+
+
+class AdmissionTest(unittest.TestCase):
+    def test_overloaded_picture_requests_are_told_when_to_retry(self):
+        limit = server.picture_requests
+        limit.in_progress += limit.capacity
+        try:
+            response = server.app.test_client().get("/conversation/unknown/picture/unknown/")
+        finally:
+            limit.in_progress -= limit.capacity
+        self.assertEqual(response.status_code, 503)
+        wait_for_seconds = json.loads(response.data)['wait_for_seconds']
+        self.assertGreater(wait_for_seconds, 0)
+        self.assertEqual(response.headers['Retry-After'], str(int(math.ceil(wait_for_seconds))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+Tests for twiliohistory.py, against the fake Twilio API in fakes.py, run with
+
+    python -m unittest test_twiliohistory
+"""
+import datetime
+import time
+import unittest
+from email.utils import formatdate
+
+from twilio.rest import TwilioRestClient
+
+import fakes
+import twiliohistory
+
+PHONE_NUMBER = '+15551234567'
+
+
+class MessageHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.services = fakes.FakeServices()
+        self.services.start()
+        client = TwilioRestClient(self.services.twilio.account_sid, 'fake', base=self.services.url)
+        self.history = twiliohistory.MessageHistory(lambda: client, page_size=3, max_pages=4)
+
+    def tearDown(self):
+        self.services.stop()
+
+    def receive(self, count, seconds_ago=0):
+        for index in range(count):
+            message = self.services.twilio.receive(PHONE_NUMBER, "message {}".format(index))
+            message['date_sent'] = message['date_created'] = formatdate(time.time() - seconds_ago)
+
+    def requests(self):
+        return self.services.reset_counts().get('twilio_messages_list', 0)
+
+    def bodies(self, messages):
+        return [message.body for message in messages]
+
+    def test_pages_until_messages_already_fetched(self):
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=5)
+        self.receive(5)
+        self.assertEqual(len(self.history.recent(PHONE_NUMBER, since)), 5)
+        self.requests()
+        self.receive(7)
+        messages = self.history.recent(PHONE_NUMBER, since)
+        self.assertEqual(len(messages), 12)
+        self.assertEqual(len(set(message.sid for message in messages)), 12)
+        # Two pages of only new messages, then one that reaches the first poll's
+        self.assertEqual(self.requests(), 3)
+
+    def test_stops_at_messages_older_than_since(self):
+        self.receive(40, seconds_ago=60)
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=5)
+        self.receive(2)
+        messages = self.history.recent(PHONE_NUMBER, since)
+        self.assertEqual(self.requests(), 1)
+        self.assertEqual(self.bodies(messages[:2]), ["message 1", "message 0"])
+
+    def test_stops_at_the_newest_message_already_fetched(self):
+        self.receive(2, seconds_ago=60)
+        self.history.recent(PHONE_NUMBER)
+        self.receive(40, seconds_ago=30)
+        self.history.cursors[PHONE_NUMBER].sids.clear()
+        self.requests()
+        self.history.recent(PHONE_NUMBER)
+        # The 40 messages are newer than the cursor, so they take all four pages
+        self.assertEqual(self.requests(), 4)
+
+    def test_limits_pages_without_moving_the_cursor(self):
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=5)
+        self.receive(20)
+        messages = self.history.recent(PHONE_NUMBER, since)
+        self.assertEqual(self.requests(), 4)
+        self.assertEqual(len(messages), 12)
+        cursor = self.history.cursors[PHONE_NUMBER]
+        self.assertEqual(len(cursor.messages), 0)
+        self.assertIsNone(cursor.newest)
+
+    def test_media_is_only_listed_once(self):
+        self.services.twilio.receive(PHONE_NUMBER, "", picture='picture')
+        message = self.history.recent(PHONE_NUMBER)[0]
+        self.assertEqual(len(self.history.media(message)), 1)
+        self.assertEqual(len(self.history.media(message)), 1)
+        self.assertEqual(self.services.reset_counts().get('twilio_media_list'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+Span-style tracing for the picture pipeline.
+
+Each span records how long one phase (poll, download, detect, ...) took for
+a conversation and/or picture.  Spans are kept in a bounded in-memory ring
+buffer, so the oldest ones are dropped once it's full:
+
+    tracer = Tracer(max_spans=10000)
+    with tracer.span('download', conversation_code, picture_code):
+        image = download()
+
+    tracer.find(conversation_code=conversation_code)
+    tracer.dump(open('traces.jsonl', 'w'))
+"""
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    def __init__(self, max_spans=10000):
+        self.spans = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, conversation_code=None, picture_code=None, **tags):
+        """
+        Time the block of code inside the `with` statement.  The span's dict is
+        given to the block so it can add more tags before the span is recorded.
+        """
+        span = {
+            'name': name,
+            'conversation_code': conversation_code,
+            'picture_code': picture_code,
+            'thread': threading.current_thread().name,
+            'start': time.time(),
+            'error': None,
+        }
+        span.update(tags)
+        try:
+            yield span
+        except Exception as e:
+            span['error'] = "{}: {}".format(type(e).__name__, e)
+            raise
+        finally:
+            span['seconds'] = time.time() - span['start']
+            with self.lock:
+                self.spans.append(span)
+
+    def find(self, conversation_code=None, picture_code=None, limit=None):
+        """Return the recorded spans, oldest first, optionally only for one conversation or picture."""
+        with self.lock:
+            spans = list(self.spans)
+        if conversation_code:
+            spans = [span for span in spans if span['conversation_code'] == conversation_code]
+        if picture_code:
+            spans = [span for span in spans if span['picture_code'] == picture_code]
+        if limit:
+            spans = spans[-limit:]
+        return spans
+
+    def dump(self, fileobj, conversation_code=None, picture_code=None):
+        """Write the recorded spans to a file as JSON lines for offline analysis."""
+        for span in self.find(conversation_code, picture_code):
+            fileobj.write(json.dumps(span, sort_keys=True) + "\n")
@@ -0,0 +1,199 @@
+"""
+Incremental reads of the SMS Playground's Twilio message history.
+
+Asking Twilio for a phone number's messages normally returns everything it
+has ever sent, so polling for a kid's next reply gets slower the longer they
+use the SMS Playground.  `MessageHistory` keeps a cursor for each phone number
+(the newest day it has seen messages on, and the messages it already has),
+so each poll only asks for that day's messages, following Twilio's pages
+(newest first) until it reaches one it has seen before or one older than
+the poll needs, and never more than `max_pages` pages.  The media of each
+message is only listed once:
+
+    history = MessageHistory(get_twilio)
+    for message in history.recent('+15555550100', since=oldest_message_time):
+        ...
+    media = history.media(message)
+"""
+import threading
+import time
+import urlparse
+from collections import OrderedDict, deque
+
+from twilio import TwilioRestException
+
+
+class MessageHistory(object):
+    """
+    :param get_client: Returns the TwilioRestClient to read messages with
+    :param page_size: Messages asked for in each request to Twilio
+    :param max_pages: Most requests a single poll makes, however many new messages there are
+    :param max_messages: Messages remembered for each phone number
+    :param max_media: Messages whose media lists are remembered
+    """
+    def __init__(self, get_client, page_size=20, max_pages=5, max_messages=100, max_media=1000):
+        self.get_client = get_client
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.max_messages = max_messages
+        self.max_media = max_media
+        self.cursors = {}
+        self.cursors_lock = threading.Lock()
+        self.media_lists = OrderedDict()
+        self.media_lock = threading.Lock()
+
+    def recent(self, phone_number=None, since=None):
+        """
+        Return the messages sent by the phone number (or by anyone, if it's None), newest first.
+        Messages older than the `since` datetime are only asked for as far as they're on the same
+        page as newer ones, but messages fetched by earlier polls are included, so callers still
+        need to skip the ones they've handled or that are too old.
+        """
+        cursor = self._get_cursor(phone_number)
+
+        # Polls that come in while another poll for the same phone number is waiting on Twilio
+        # share its results instead of asking Twilio again
+        with cursor.lock:
+            fetch = cursor.fetch
+            waiting = fetch is not None
+            if not waiting:
+                fetch = cursor.fetch = _Fetch()
+                after = cursor.date
+                if since is not None and (after is None or since.date() > after):
+                    after = since.date()
+                newest = cursor.newest
+        if waiting:
+            fetch.done.wait()
+            if fetch.error is not None:
+                raise fetch.error
+            with cursor.lock:
+                return list(cursor.messages)
+
+        new_messages = []
+        complete = False
+        try:
+            params = {'PageSize': self.page_size}
+            if phone_number is not None:
+                params['From'] = phone_number
+            if after is not None:
+                params['DateSent>'] = str(after)
+            for page in range(self.max_pages):
+                messages, params = self._request('messages_list', self._list_messages, params=params)
+                unseen = [message for message in messages if message.sid not in cursor.sids]
+                new_messages.extend(unseen)
+                # Stop once this page reached messages we already have, or ones older than we need
+                oldest = _sent(messages[-1]) if messages else None
+                if params is None or len(unseen) < len(messages) or (oldest is not None and (
+                        (since is not None and oldest < since) or (newest is not None and oldest < newest))):
+                    complete = True
+                    break
+        except Exception as e:
+            fetch.error = e
+            raise
+        finally:
+            with cursor.lock:
+                # Unless every message the poll needs was fetched, the cursor is left alone, so it
+                # doesn't move past messages that weren't (the next poll asks for them again)
+                if complete:
+                    for message in reversed(new_messages):
+                        cursor.add(message)
+                    messages = list(cursor.messages)
+                else:
+                    messages = new_messages + list(cursor.messages)
+                cursor.fetch = None
+            fetch.done.set()
+        return messages
+
+    def media(self, message):
+        """Return the message's media, only asking Twilio the first time."""
+        with self.media_lock:
+            if message.sid in self.media_lists:
+                media_list = self.media_lists.pop(message.sid)
+                self.media_lists[message.sid] = media_list
+                return media_list
+
+        media_list = self._request('media_list', message.media_list.list)
+        with self.media_lock:
+            self.media_lists[message.sid] = media_list
+            while len(self.media_lists) > self.max_media:
+                self.media_lists.popitem(last=False)
+        return media_list
+
+    def request_finished(self, name, elapsed, error):
+        """
+        Called after every request to Twilio (whether or not it worked); override it to
+        record metrics.
+
+        :param name: The request, 'messages_list' or 'media_list'
+        :param elapsed: Seconds the request took
+        :param error: The exception the request raised, or None if it worked
+        """
+
+    def _get_cursor(self, phone_number):
+        with self.cursors_lock:
+            if phone_number not in self.cursors:
+                self.cursors[phone_number] = _Cursor(self.max_messages)
+            return self.cursors[phone_number]
+
+    def _list_messages(self, params):
+        # Return a page of messages and the parameters that ask for the next page, or None if
+        # it's the last one
+        resource = self.get_client().messages
+        try:
+            _, page = resource.request("GET", resource.uri, params=params)
+        except TwilioRestException as e:
+            # A next page that's gone (e.g. the messages on it were deleted) is the same as no next page
+            if e.status == 404 and ('Page' in params or 'PageToken' in params):
+                return [], None
+            raise
+        messages = [resource.load_instance(data) for data in page.get(resource.key, [])]
+        next_page_uri = page.get('next_page_uri')
+        if not messages or not next_page_uri:
+            return messages, None
+        next_params = dict(params)
+        next_params.update(urlparse.parse_qsl(urlparse.urlparse(next_page_uri).query))
+        return messages, next_params
+
+    def _request(self, name, function, **kwargs):
+        start_time = time.time()
+        error = None
+        try:
+            return function(**kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.request_finished(name, time.time() - start_time, error)
+
+
+class _Cursor(object):
+    """The messages already fetched for one phone number, newest first."""
+    def __init__(self, max_messages):
+        self.date = None
+        self.newest = None
+        self.fetch = None
+        self.messages = deque()
+        self.sids = set()
+        self.max_messages = max_messages
+        self.lock = threading.Lock()
+
+    def add(self, message):
+        if len(self.messages) >= self.max_messages:
+            self.sids.discard(self.messages.pop().sid)
+        self.messages.appendleft(message)
+        self.sids.add(message.sid)
+        sent = _sent(message)
+        if sent is not None and (self.newest is None or sent > self.newest):
+            self.newest = sent
+            self.date = sent.date()
+
+
+def _sent(message):
+    return message.date_sent or message.date_created
+
+
+class _Fetch(object):
+    """A poll of Twilio that's in progress, which other polls can wait for."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None